@@ -11,14 +11,238 @@ http://nl.mathworks.com/matlabcentral/fileexchange/38841-matlab-implementation-o
 """
 from __future__ import division
 from copy import deepcopy
+import os
+import sys
+import time
+import argparse
 import numpy as np
 import math
 import matplotlib.pyplot as plt
 import warnings
+from osgeo import gdal, osr
+gdal.UseExceptions()
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'raster'))
+from block_io import DEFAULT_BLOCK_SIZE, block_windows, read_block
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='HANTS for single pixel (demo) or image stack')
+    parser.add_argument('--src-stack', required=False, type=str, default=None,
+                        help='multi-band GeoTIFF, one band for each date; the demo runs if not given')
+    parser.add_argument('--target-prefix', required=False, type=str, default="./data/hants",
+                        help='prefix of output rasters (_amp.tif, _phi.tif, _rec.tif)')
+    parser.add_argument('--nb', required=False, type=int, default=365,
+                        help='length of the base period')
+    parser.add_argument('--nf', required=False, type=int, default=3,
+                        help='number of frequencies')
+    parser.add_argument('--ts', required=False, type=str, default=None,
+                        help='comma separated time samples, default 0..bands-1')
+    parser.add_argument('--hilo', required=False, type=str, default='Lo',
+                        help='outlier rejection in [Hi, Lo, None]')
+    parser.add_argument('--low', required=False, type=float, default=-1.0,
+                        help='valid range minimum')
+    parser.add_argument('--high', required=False, type=float, default=1.0,
+                        help='valid range maximum')
+    parser.add_argument('--fet', required=False, type=float, default=0.05,
+                        help='fit error tolerance')
+    parser.add_argument('--dod', required=False, type=int, default=1,
+                        help='degree of overdeterminedness')
+    parser.add_argument('--delta', required=False, type=float, default=0.1,
+                        help='small positive number to suppress high amplitudes')
+    parser.add_argument('--block-size', required=False, type=int, default=512,
+                        help='window edge in pixels')
+    opts = parser.parse_args()
+    return opts
+
+
+def hants_design_matrix(ni, nb, nf, ts):
+    """
+    Design matrix mat (nr, ni) of HANTS, rows are 1, cos(f*t), sin(f*t), ... for f = 1..nf.
+    It only depends on the time axis, so it is built once for all pixels.
+    """
+    nr = min(2*nf+1, ni)
+    mat = np.zeros((2*nf+1, ni))
+    mat[0, :] = 1.0
+
+    ang = 2 * math.pi * np.arange(nb) / nb
+    cs = np.cos(ang)
+    sn = np.sin(ang)
+
+    i = np.arange(1, nf+1)
+    for j in np.arange(ni):
+        index = np.mod(i*ts[j], nb)
+        mat[2 * i-1, j] = cs.take(index)
+        mat[2 * i, j] = sn.take(index)
+    #for
 
+    return mat[:nr]
+
+
+def hants_pixels(y, nb, nf, ts, HiLo, low, high, fet, dod, delta):
+    """
+    HANTS for many pixels at once, same algorithm as hants().
+    The normal equations of all pixels are built with one matmul against the
+    outer products of the design matrix and solved with a batched np.linalg.solve,
+    outliers are rejected with masks, pixels drop out of the loop once they are ready.
+
+    y     = np.array (npix, ni) of sample values, NaN is treated as out of range
+    other inputs as hants()
+
+    Outputs:
+    yr    = np.array (npix, ni) reconstructed time series
+    amp   = np.array (npix, nf+1) amplitudes, first column is the average
+    phi   = np.array (npix, nf+1) phases in degree, first column is zero
+    valid = np.array (npix) of bool, False for pixels without enough data points
+            (hants() raises for those), their outputs are NaN
+    """
+    npix, ni = y.shape
+    mat = hants_design_matrix(ni, nb, nf, ts)
+    nr = mat.shape[0]
+    # (ni, nr*nr) so that p @ mat_outer gives the flattened mat*diag(p)*mat' of every pixel
+    mat_outer = (mat.T[:, :, np.newaxis] * mat.T[:, np.newaxis, :]).reshape(ni, nr * nr)
+    damping = np.identity(nr) * delta
+    damping[0, 0] = 0
+
+    sHiLo = 0
+    if HiLo == 'Hi':
+        sHiLo = -1
+    elif HiLo == 'Lo':
+        sHiLo = 1
+
+    noutmax = ni - nr - dod
 
-def hants_image(img_array3d,):
-    pass
+    p = ((y >= low) & (y <= high)).astype(np.float64)
+    y = np.where(np.isnan(y), 0.0, y).astype(np.float64)
+    nout = ni - p.sum(axis=1).astype(np.int64)
+    valid = nout <= noutmax
+
+    zr = np.full((npix, nr), np.nan)
+    yr = np.full((npix, ni), np.nan)
+
+    active = np.flatnonzero(valid)
+    nloop = 0
+    while (active.size > 0) & (nloop < ni):
+        nloop += 1
+        pa, ya = p[active], y[active]
+
+        za = np.matmul(pa * ya, mat.T)
+        A = np.matmul(pa, mat_outer).reshape(-1, nr, nr) + damping
+        zra = np.linalg.solve(A, za[:, :, np.newaxis])[:, :, 0]
+        yra = np.matmul(zra, mat)
+        zr[active], yr[active] = zra, yra
+
+        diffVec = sHiLo * (yra - ya)
+        err = pa * diffVec
+        maxerr = err.max(axis=1)
+        ready = (maxerr <= fet) | (nout[active] == noutmax)
+
+        # reject points in descending error while they exceed half of the maximum error
+        not_ready = ~ready
+        if not_ready.any():
+            err_nr = err[not_ready]
+            order = np.argsort(-err_nr, axis=1)
+            rank = np.empty_like(order)
+            np.put_along_axis(rank, order, np.arange(ni)[np.newaxis, :].repeat(order.shape[0], axis=0), axis=1)
+            budget = (noutmax - nout[active][not_ready])[:, np.newaxis]
+            reject = (err_nr > 0.5 * maxerr[not_ready, np.newaxis]) & (rank < budget)
+
+            rows = active[not_ready]
+            p[rows] = np.where(reject, 0.0, p[rows])
+            nout[rows] += reject.sum(axis=1)
+        #if
+
+        active = active[not_ready]
+    #while
+
+    ## compute the amplitudes and phases for reconstruction
+    amp = np.full((npix, nf + 1), np.nan)
+    phi = np.full((npix, nf + 1), np.nan)
+    amp[:, 0] = zr[:, 0]
+    phi[valid, 0] = 0.0
+
+    i = np.arange(1, nr-1, 2)
+    ifr = (i + 1) // 2
+    ra = zr[:, i]
+    rb = zr[:, i+1]
+
+    amp[:, ifr] = np.sqrt(ra * ra + rb * rb)
+    phase = np.arctan2(rb, ra) * 180.0 / math.pi
+    phi[:, ifr] = np.where(phase < 0, phase + 360, phase)
+
+    return [yr, amp, phi, valid]
+
+
+def hants_image(img_array3d, nb, nf, ts=None, HiLo='None', low=-1, high=1, fet=0.05, dod=1, delta=0.1):
+    """
+    HANTS of an image stack.
+
+    img_array3d = np.array (ni, rows, cols), one layer for each date as read by gdal
+    ts          = time samples, default 0..ni-1
+    other inputs as hants()
+
+    Outputs (NaN where there are not enough data points):
+    yr  = np.array (ni, rows, cols) reconstructed stack
+    amp = np.array (nf+1, rows, cols)
+    phi = np.array (nf+1, rows, cols)
+    """
+    ni, rows, cols = img_array3d.shape
+    if ts is None:
+        ts = np.arange(ni)
+
+    y = img_array3d.reshape(ni, rows * cols).T
+    yr, amp, phi, valid = hants_pixels(y, nb, nf, ts, HiLo, low, high, fet, dod, delta)
+
+    return [yr.T.reshape(ni, rows, cols), amp.T.reshape(-1, rows, cols), phi.T.reshape(-1, rows, cols)]
+
+
+def create_hants_image(save_path, src_ds, bands):
+    file_driver = gdal.GetDriverByName('GTiff')
+    dst_ds = file_driver.Create(save_path, xsize=src_ds.RasterXSize, ysize=src_ds.RasterYSize, bands=bands,
+                                eType=gdal.GDT_Float32, options=['TILED=YES', 'COMPRESS=DEFLATE'])
+    if not dst_ds:
+        raise Exception("Fail to create image {}".format(save_path))
+    dst_ds.SetProjection(src_ds.GetProjection())
+    dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    for bb in range(1, bands + 1):
+        dst_ds.GetRasterBand(bb).SetNoDataValue(np.nan)
+    return dst_ds
+
+
+def hants_raster(src_stack, target_prefix, nb, nf, ts=None, HiLo='None', low=-1, high=1, fet=0.05, dod=1,
+                 delta=0.1, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    HANTS of a GeoTIFF stack (one band for each date), window by window.
+    Writes <target_prefix>_amp.tif, _phi.tif (nf+1 bands) and _rec.tif (one band for each date).
+    """
+    src_ds = gdal.Open(src_stack, gdal.GA_ReadOnly)
+    if not src_ds:
+        print('Unable to open image {}'.format(src_stack))
+        sys.exit(1)
+    ni = src_ds.RasterCount
+
+    amp_ds = create_hants_image(target_prefix + '_amp.tif', src_ds, nf + 1)
+    phi_ds = create_hants_image(target_prefix + '_phi.tif', src_ds, nf + 1)
+    rec_ds = create_hants_image(target_prefix + '_rec.tif', src_ds, ni)
+
+    start_time = time.time()
+    for window in block_windows(src_ds, block_size):
+        img_array3d = read_block(src_ds, window, with_halo=False).astype(np.float64)
+        yr, amp, phi = hants_image(img_array3d, nb, nf, ts, HiLo, low, high, fet, dod, delta)
+        for target_ds, result in ((amp_ds, amp), (phi_ds, phi), (rec_ds, yr)):
+            for bb in range(result.shape[0]):
+                target_ds.GetRasterBand(bb + 1).WriteArray(result[bb].astype(np.float32), window.xoff, window.yoff)
+        # for
+    # for
+
+    seconds = time.time() - start_time
+    num_pixels = src_ds.RasterXSize * src_ds.RasterYSize
+    print("### HANTS of {} pixels x {} dates in {:.1f}s ({:.0f} pixels/s)".format(
+        num_pixels, ni, seconds, num_pixels / max(seconds, 1e-6)))
+
+    for target_ds in (amp_ds, phi_ds, rec_ds):
+        target_ds.FlushCache()
+    del amp_ds, phi_ds, rec_ds, src_ds
 
 
 def hants(ni, nb, nf, y, ts, HiLo, low, high, fet, dod, delta):
@@ -105,7 +329,7 @@ def hants(ni, nb, nf, y, ts, HiLo, low, high, fet, dod, delta):
         za = np.matmul(mat, p * y)
 
         # multiply mat with the multiplication of multiply diagonal of p with transpose of mat
-        A = np.matmul(np.matmul(mat, np.diag(p)), np.transpose(mat))
+        A = np.matmul(mat * p, np.transpose(mat))
         # add delta to suppress high amplitudes but not for [0,0]
         A = A + np.identity(nr)*delta
         A[0, 0] = A[0, 0] - delta
@@ -130,10 +354,7 @@ def hants(ni, nb, nf, y, ts, HiLo, low, high, fet, dod, delta):
                 p[j] = 0
                 nout += 1
                 i -= 1
-                if i == 0:
-                    j = 0
-                else:
-                    j = 1
+                j = rankVec[i]
             #while
         #if
     #while
@@ -182,6 +403,14 @@ def hants_reconstruct(amp, phi, nbase):
 def main():
     print("### hants.main() ###########################################")
 
+    opts = parse_args()
+    if opts.src_stack:
+        ts = None if opts.ts is None else np.array([int(t) for t in opts.ts.split(',')])
+        hants_raster(opts.src_stack, opts.target_prefix, opts.nb, opts.nf, ts, opts.hilo, opts.low, opts.high,
+                     opts.fet, opts.dod, opts.delta, (opts.block_size, opts.block_size))
+        print("### Task over #############################################")
+        return
+
     # Run HANTS for a single point
 
     # sample 1
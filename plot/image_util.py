@@ -157,31 +157,114 @@ def copy_spatialref(img_path4, img_path2):
     return True
 
 
-def overwrite_pixelvalues(img_path4, img_path2, pvcsv_path, band_index=0):
-    img4_array = load_gdalimage(img_path4)
-    img4_array = img4_array.transpose(2, 0, 1)
-    img4_array = img4_array.astype(float)
-
-    band4_array = img4_array[band_index]
-    band2_array = np.zeros_like(band4_array)
-
-    csv_pd = pd.read_csv(pvcsv_path, header=None)
+def read_pixelvalues(pvcsv_path, value_dtype=np.float64):
+    """
+    Pixel values of a CSV without header, columns x (column), y (row), value, coordinates 1-based.
+    Empty cells are read as 0 as before.
+    :return: (rows, cols, values) np.arrays, 0-based
+    """
+    csv_pd = pd.read_csv(pvcsv_path, header=None, usecols=[0, 1, 2],
+                         dtype={0: np.float64, 1: np.float64, 2: value_dtype})
     csv_pd = csv_pd.fillna(0)
-    for index, row in csv_pd.iterrows():
-        xx, yy, vv = int(row[0]), int(row[1]), row[2]
-        band2_array[yy - 1][xx - 1] = vv
+    cols = csv_pd[0].to_numpy().astype(np.int64) - 1
+    rows = csv_pd[1].to_numpy().astype(np.int64) - 1
+    return rows, cols, csv_pd[2].to_numpy()
 
-    # with open(pvcsv_path) as pvscv_f:
-    #     csv_data = np.loadtxt(pvscv_f, delimiter=",")
-    #     for pp in range(0, csv_data.shape[0]):
-    #         xx, yy, vv = int(csv_data[pp][0]), int(csv_data[pp][1]), csv_data[pp][2]
-    #         band2_array[yy-1][xx-1] = vv
 
-    img4_array[band_index] = band2_array
-    img4_array = img4_array.transpose(1, 2, 0)
-    ret = saveas_gdalimage(img4_array, img_path2)
-    ret = copy_spatialref(img_path4, img_path2)
+def aggregate_pixelvalues(rows, cols, values, width, how='last'):
+    """
+    One value for each pixel hit by the points.
+    :param how: 'last' (the later point wins, as when writing one by one), 'mean' or 'max'
+    :return: (flat pixel index row * width + col, values), sorted by pixel
+    """
+    flat_index = rows * width + cols
+    if how == 'last':
+        # the first occurrence in the reversed order is the last one
+        pixels, first = np.unique(flat_index[::-1], return_index=True)
+        return pixels, values[::-1][first]
+    elif how == 'mean':
+        pixels, inverse = np.unique(flat_index, return_inverse=True)
+        sums = np.bincount(inverse, weights=values.astype(np.float64), minlength=len(pixels))
+        return pixels, sums / np.bincount(inverse, minlength=len(pixels))
+    elif how == 'max':
+        order = np.lexsort((values, flat_index))
+        pixels, last = np.unique(flat_index[order][::-1], return_index=True)
+        return pixels, values[order][::-1][last]
+    raise Exception("Aggregation {} not supported, use one of [last, mean, max]".format(how))
+
+
+def burn_pixelvalues(img_path, pvcsv_path, band_index=0, how='last', strip_rows=1024):
+    """
+    Write the pixel values of a CSV into one band of an existing image, in place.
+    Only strips of rows with points are read and written, each limited to the columns its points touch.
+    :param band_index: 0-based band
+    :param how: aggregation of points on the same pixel, 'last', 'mean' or 'max'
+    :return: number of pixels written
+    """
+    image_ds = gdal.Open(img_path, gdal.GA_Update)
+    if not image_ds:
+        raise Exception("Fail to open image {}".format(img_path))
+    width, height = image_ds.RasterXSize, image_ds.RasterYSize
+    band = image_ds.GetRasterBand(band_index + 1)
+
+    rows, cols, values = read_pixelvalues(pvcsv_path)
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    if not inside.all():
+        print("### Skip {} points outside the image".format(int((~inside).sum())))
+    pixels, values = aggregate_pixelvalues(rows[inside], cols[inside], values[inside], width, how)
+    rows, cols = pixels // width, pixels % width
+
+    # points are sorted by pixel, so by row, and each strip is a contiguous slice
+    strip_starts = np.searchsorted(rows, np.arange(0, height + strip_rows, strip_rows))
+    for ss in range(len(strip_starts) - 1):
+        begin, end = strip_starts[ss], strip_starts[ss + 1]
+        if begin == end:
+            continue
+        yoff, ysize = rows[begin], rows[end - 1] - rows[begin] + 1
+        xoff = cols[begin:end].min()
+        xsize = cols[begin:end].max() - xoff + 1
+
+        strip_array = band.ReadAsArray(int(xoff), int(yoff), int(xsize), int(ysize))
+        strip_array[rows[begin:end] - yoff, cols[begin:end] - xoff] = values[begin:end]
+        band.WriteArray(strip_array, int(xoff), int(yoff))
+    # for
+
+    image_ds.FlushCache()
+    del image_ds
+    print("### Burn {} pixels into band {} of {}".format(len(pixels), band_index + 1, img_path))
+    return len(pixels)
+
+
+def overwrite_pixelvalues(img_path4, img_path2, pvcsv_path, band_index=0, how='last'):
+    """
+    Copy of img_path4 as float32, with band band_index cleared and set to the pixel values of the CSV.
+    Bands are copied one at a time, then the values are burnt in place.
+    """
+    image_ds4 = gdal.Open(img_path4, gdal.GA_ReadOnly)
+    if not image_ds4:
+        print("Fail to open image {}".format(img_path4))
+        return False
 
+    file_driver = gdal.GetDriverByName('GTiff')
+    image_ds2 = file_driver.Create(img_path2, xsize=image_ds4.RasterXSize, ysize=image_ds4.RasterYSize,
+                                   bands=image_ds4.RasterCount, eType=gdal.GDT_Float32)
+    if not image_ds2:
+        print("Fail to create image {}".format(img_path2))
+        return False
+    image_ds2.SetProjection(image_ds4.GetProjection())
+    image_ds2.SetGeoTransform(image_ds4.GetGeoTransform())
+
+    for bb in range(image_ds4.RasterCount):
+        if bb == band_index:
+            image_ds2.GetRasterBand(bb + 1).Fill(0)
+        else:
+            band_array = image_ds4.GetRasterBand(bb + 1).ReadAsArray().astype(np.float32)
+            image_ds2.GetRasterBand(bb + 1).WriteArray(band_array)
+    # for
+    image_ds2.FlushCache()
+    del image_ds2, image_ds4
+
+    burn_pixelvalues(img_path2, pvcsv_path, band_index, how)
     return True
 
 
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+"""
+Level-of-detail plotting of large time series tables
+
+Envelopes (min, max, mean) of row groups and a value histogram of each time step are computed in one
+pass over the table, plots are drawn from these summaries so that drawing time depends on the number of
+time steps and screen pixels, not on the number of rows. Rows of interest are drawn from a memmap cache.
+
+Author: Zhou Ya'nan
+Date: 2021-10-16
+"""
+import os
+import time
+import datetime
+import argparse
+import numpy as np
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+
+from timeseries_plot import read_tsdata_chunks
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Level-of-detail plots of a time series table')
+    parser.add_argument('--src-file', required=False, type=str, default="./data/pixel_tsattri_2020.csv",
+                        help='CSV or Parquet table, prefix columns followed by the time series')
+    parser.add_argument('--target-png', required=False, type=str, default=None,
+                        help='save the figure to this file instead of showing it')
+    parser.add_argument('--cache-path', required=False, type=str, default=None,
+                        help='float32 cache of the series for drill-down, default <src-file>.f32')
+    parser.add_argument('--prefix-columns', required=False, type=int, default=7,
+                        help='leading non time series columns of the table')
+    parser.add_argument('--group-rows', required=False, type=int, default=1024,
+                        help='rows of one envelope group')
+    parser.add_argument('--bins', required=False, type=int, default=1024,
+                        help='value bins of the density histogram')
+    parser.add_argument('--value-range', required=False, type=str, default="0,255",
+                        help='value range of the density histogram, min,max')
+    parser.add_argument('--rows', required=False, type=str, default=None,
+                        help='drill down to rows start:end')
+    opts = parser.parse_args()
+    return opts
+
+
+class timeseries_lod(object):
+    """
+    Summaries of a (rows, time) table, built block by block with add().
+    - group_min / group_max / group_sum / group_count: (groups, time), one group for every group_rows rows
+    - histogram: (bins, time) counts of values in value_range
+    Blocks added should be multiples of group_rows, the last group of each block may be smaller.
+    """
+    def __init__(self, num_time, group_rows=1024, bins=1024, value_range=(0, 255)):
+        self.num_time = num_time
+        self.group_rows = group_rows
+        self.bins = bins
+        self.value_range = value_range
+
+        self.num_rows = 0
+        self.group_start = []
+        self.group_min, self.group_max, self.group_sum, self.group_count = [], [], [], []
+        self.histogram = np.zeros((bins, num_time), dtype=np.int64)
+        self.data = None
+
+    def add(self, block_array):
+        block_array = np.asarray(block_array, dtype=np.float64)
+        num_rows = block_array.shape[0]
+        num_groups = -(-num_rows // self.group_rows)
+
+        # pad to whole groups with NaN, so that all groups reduce in one call
+        padded = np.full((num_groups * self.group_rows, self.num_time), np.nan)
+        padded[:num_rows] = block_array
+        groups = padded.reshape(num_groups, self.group_rows, self.num_time)
+        valid = ~np.isnan(groups)
+        with np.errstate(invalid='ignore'):
+            self.group_min.append(np.where(valid, groups, np.inf).min(axis=1))
+            self.group_max.append(np.where(valid, groups, -np.inf).max(axis=1))
+        self.group_sum.append(np.where(valid, groups, 0).sum(axis=1))
+        self.group_count.append(valid.sum(axis=1))
+        self.group_start.extend(self.num_rows + np.arange(0, num_rows, self.group_rows))
+
+        low, high = self.value_range
+        valid = np.isfinite(block_array) & (block_array >= low) & (block_array <= high)
+        scaled = (np.where(valid, block_array, low) - low) / (high - low) * self.bins
+        bin_index = np.minimum(scaled.astype(np.int64), self.bins - 1)
+        flat_index = bin_index * self.num_time + np.arange(self.num_time)[np.newaxis, :]
+        self.histogram += np.bincount(flat_index[valid], minlength=self.bins * self.num_time).reshape(
+            self.bins, self.num_time)
+
+        self.num_rows += num_rows
+
+    def finish(self):
+        """
+        Stack the group summaries added so far.
+        """
+        for name in ('group_min', 'group_max', 'group_sum', 'group_count'):
+            parts = getattr(self, name)
+            if isinstance(parts, list):
+                setattr(self, name, np.concatenate(parts, axis=0) if parts else np.zeros((0, self.num_time)))
+        # for
+        self.group_start = np.append(np.asarray(self.group_start, dtype=np.int64), self.num_rows)
+        return self
+
+    def groups_of_rows(self, row_start=0, row_end=None):
+        row_end = self.num_rows if row_end is None else row_end
+        first = np.searchsorted(self.group_start, row_start, side='right') - 1
+        last = np.searchsorted(self.group_start, row_end, side='left')
+        return np.arange(max(first, 0), last)
+
+    def envelope(self, groups=None):
+        """
+        (min, max, mean) of each time step over the groups (all by default).
+        """
+        if groups is None:
+            groups = slice(None)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ts_min = self.group_min[groups].min(axis=0)
+            ts_max = self.group_max[groups].max(axis=0)
+            ts_mean = self.group_sum[groups].sum(axis=0) / self.group_count[groups].sum(axis=0)
+        ts_min[np.isinf(ts_min)], ts_max[np.isinf(ts_max)] = np.nan, np.nan
+        return ts_min, ts_max, ts_mean
+
+    def select_groups(self, time_index, low, high):
+        """
+        Groups with values in [low, high] at time_index, candidates for a drill-down.
+        """
+        return np.flatnonzero((self.group_max[:, time_index] >= low) & (self.group_min[:, time_index] <= high))
+
+    def rows_of_groups(self, groups):
+        return np.concatenate([np.arange(self.group_start[g], self.group_start[g + 1]) for g in groups]) \
+            if len(groups) else np.zeros(0, dtype=np.int64)
+
+    def density(self, num_bins=None):
+        """
+        Histogram rebinned to at most num_bins value bins (by summing neighbours).
+        :return: (counts (bins, time), bin edges)
+        """
+        factor = 1 if not num_bins else max(1, -(-self.bins // num_bins))
+        num_bins = -(-self.bins // factor)
+        # pad with empty bins above the range to a multiple of the factor
+        padded = np.zeros((num_bins * factor, self.num_time), dtype=np.int64)
+        padded[:self.bins] = self.histogram
+        counts = padded.reshape(num_bins, factor, self.num_time).sum(axis=1)
+        low, high = self.value_range
+        edges = low + np.arange(num_bins + 1) * factor * (high - low) / self.bins
+        return counts, edges
+
+
+def build_lod(data_file, prefix_columns=7, group_rows=1024, bins=1024, value_range=(0, 255), cache_path=None,
+              chunk_rows=None):
+    """
+    Summaries of a CSV or Parquet table in one streamed pass.
+    With cache_path the series are also written as raw float32, lod.data is then a read-only memmap of them.
+    """
+    chunk_rows = chunk_rows or group_rows * 256
+    chunk_rows = max(group_rows, chunk_rows // group_rows * group_rows)
+
+    start_time = time.time()
+    lod = None
+    cache_file = open(cache_path, 'wb') if cache_path else None
+    for prefix_pd, tsdata_array in read_tsdata_chunks(data_file, prefix_columns, chunk_rows):
+        if lod is None:
+            lod = timeseries_lod(tsdata_array.shape[1], group_rows, bins, value_range)
+        lod.add(tsdata_array)
+        if cache_file is not None:
+            cache_file.write(tsdata_array.astype(np.float32).tobytes())
+        print("### {} rows, {:.0f} rows/s".format(lod.num_rows, lod.num_rows / max(time.time() - start_time, 1e-6)))
+    # for
+    if lod is None:
+        raise Exception("No rows in {}".format(data_file))
+    lod.finish()
+
+    if cache_file is not None:
+        cache_file.close()
+        lod.data = np.memmap(cache_path, dtype=np.float32, mode='r', shape=(lod.num_rows, lod.num_time))
+    return lod
+
+
+def axes_pixel_size(ax):
+    bbox = ax.get_window_extent()
+    return max(1, int(bbox.width)), max(1, int(bbox.height))
+
+
+def plot_envelope(ax, lod, groups=None, ts_x=None, color='tab:blue', label='all'):
+    ts_min, ts_max, ts_mean = lod.envelope(groups)
+    ts_x = np.arange(lod.num_time) if ts_x is None else ts_x
+    ax.fill_between(ts_x, ts_min, ts_max, color=color, alpha=0.25, linewidth=0, label=label + ' min-max')
+    ax.plot(ts_x, ts_mean, color=color, linestyle='-', linewidth=1, label=label + ' mean')
+
+
+def plot_density(ax, lod, cmap='viridis'):
+    """
+    Density of all series, one value bin for each pixel row of the axes at most.
+    """
+    counts, edges = lod.density(axes_pixel_size(ax)[1])
+    image = ax.imshow(counts, origin='lower', aspect='auto', cmap=cmap, interpolation='nearest',
+                      extent=(-0.5, lod.num_time - 0.5, edges[0], edges[-1]),
+                      norm=mpl.colors.LogNorm(vmin=1, vmax=max(counts.max(), 1)))
+    return image
+
+
+def plot_rows(ax, lod, rows, max_lines=200, color='deeppink', seed=0):
+    """
+    Drill down: envelope of the selected rows from the cache, and at most max_lines of them as lines.
+    """
+    if lod.data is None:
+        raise Exception("No cached series, build the summaries with a cache_path")
+    rows = np.sort(np.asarray(rows, dtype=np.int64))
+    subset = np.asarray(lod.data[rows], dtype=np.float64)
+    ts_x = np.arange(lod.num_time)
+
+    with np.errstate(invalid='ignore'):
+        ax.fill_between(ts_x, np.nanmin(subset, axis=0), np.nanmax(subset, axis=0), color=color, alpha=0.2,
+                        linewidth=0, label='subset min-max')
+    if len(rows) > max_lines:
+        subset = subset[np.random.default_rng(seed).choice(len(rows), max_lines, replace=False)]
+    ax.plot(ts_x, subset.T, color=color, linewidth=0.5, alpha=min(1.0, 20.0 / max(len(subset), 1)))
+    return len(rows)
+
+
+def plot_lod(lod, rows=None, ts_x=None, target_png=None):
+    """
+    Envelope and density of all series, and the selected rows if given.
+    """
+    fig, (ax_env, ax_den) = plt.subplots(2, 1, figsize=(12, 8), sharex=True)
+    plot_envelope(ax_env, lod)
+    if rows is not None:
+        plot_rows(ax_env, lod, rows)
+    ax_env.legend()
+    ax_env.set_title("{} series".format(lod.num_rows))
+
+    fig.canvas.draw()
+    image = plot_density(ax_den, lod)
+    fig.colorbar(image, ax=[ax_env, ax_den], label='count')
+    if ts_x is not None:
+        ax_den.set_xticks(np.arange(lod.num_time))
+        ax_den.set_xticklabels(ts_x, rotation=90)
+
+    if target_png:
+        fig.savefig(target_png, dpi=100)
+        plt.close(fig)
+    else:
+        plt.show()
+
+
+def main():
+    now = datetime.datetime.now()
+    print("###########################################################")
+    print("### Time series level-of-detail plot ######################")
+    print("### ", now)
+    print("###########################################################")
+
+    opts = parse_args()
+    if opts.target_png:
+        plt.switch_backend('Agg')
+    cache_path = opts.cache_path or opts.src_file + '.f32'
+    value_range = [float(v) for v in opts.value_range.split(',')]
+
+    start_time = time.time()
+    lod = build_lod(opts.src_file, opts.prefix_columns, opts.group_rows, opts.bins, value_range, cache_path)
+    print("### Summaries of {} rows in {:.1f}s".format(lod.num_rows, time.time() - start_time))
+
+    rows = None
+    if opts.rows:
+        row_start, row_end = [int(r) for r in opts.rows.split(':')]
+        rows = np.arange(row_start, min(row_end, lod.num_rows))
+
+    start_time = time.time()
+    plot_lod(lod, rows, target_png=opts.target_png)
+    print("### Plot in {:.1f}s".format(time.time() - start_time))
+
+    print("### Task over #############################################")
+
+
+if __name__ == "__main__":
+    main()
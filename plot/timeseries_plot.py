@@ -16,138 +16,169 @@ import matplotlib as mpl
 from scipy.signal import savgol_filter
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='YIGE detection of pixel time series')
+    parser.add_argument('--src-file', required=False, type=str,
+                        default="I:/FF/application-project/2021-africagrass/PROBAV/6/PROBAV_S10_TOC_X21Y06/shp/csv/pixel_tsattri_2020.csv",
+                        help='CSV or Parquet table, prefix columns followed by the time series')
+    parser.add_argument('--target-file', required=False, type=str,
+                        default="I:/FF/application-project/2021-africagrass/PROBAV/6/PROBAV_S10_TOC_X21Y06/shp/csv/pixel_tsattri_2020_yige.csv",
+                        help='CSV of the table with a yige column, or of (row, index) detections with --sparse')
+    parser.add_argument('--version', required=False, type=int, default=2,
+                        help='2 for yige_detection, 1 for yige_detection_1')
+    parser.add_argument('--sparse', required=False, action='store_true',
+                        help='stream the table chunk by chunk and write only the detections')
+    parser.add_argument('--chunk-rows', required=False, type=int, default=200000,
+                        help='rows read in one chunk with --sparse')
+    opts = parser.parse_args()
+    return opts
+
+
 def sg_filter(src_timeseries):
     filtered_timeseries = savgol_filter(src_timeseries, window_length=7, polyorder=3)
     return filtered_timeseries
 
 
-def yige_detection_1(tsdata):
+def sg_filter_block(block_array):
     """
-    PROBAV_S10_TOC_X17Y04
-    PROBAV_S10_TOC_X21Y04
+    Savitzky-Golay filter of all rows of a block at once, same settings as sg_filter().
     """
-    column = tsdata.columns.values
-    column = [col[1:] for col in column]
+    return savgol_filter(block_array, window_length=7, polyorder=3, axis=1)
 
-    results_arr = []
 
-    for index, row in tsdata.iterrows():
-        src_data = row
-        yige_locations = []
-        sgfiltered_data = sg_filter(src_data)
+def yige_detect_block(block_array, version=2, with_filtered=False):
+    """
+    YIGE (abrupt drop after a peak) of a block of rows, as 2-D array operations.
+    A peak p (x[p-1] < x[p] > x[p+1]) with x[p] >= 60 and 3 <= p <= 27 is a YIGE if
+    it is followed by a trough at p+1 with d[p-1] < 5, d[p] < -15 and d[p+1] > 5, or if d[p] < -35 and 12 < p < 25,
+    d the first difference along time.
+    Rows are only searched if they look like grass land:
+    version 2 (yige_detection) max > 80 and less than two values below 10, version 1 (yige_detection_1) max > 60.
+    :param block_array: np.array (rows, time)
+    :param with_filtered: also return the Savitzky-Golay filtered block (for plotting, the rules use raw values)
+    :return: (row index, time index) np.arrays of the detections, in row-major order
+    """
+    block_array = np.asarray(block_array, dtype=np.float64)
+    num_rows, num_time = block_array.shape
+
+    with np.errstate(invalid='ignore'):
+        row_max = np.nanmax(np.where(np.isnan(block_array), -np.inf, block_array), axis=1)
+        if version == 2:
+            row_gate = (row_max > 80) & (np.sum(block_array < 10, axis=1) < 2)
+        else:
+            row_gate = row_max > 60
+
+        # d_prev = d[p-1], d_curr = d[p], d_next = d[p+1] for p in 1..time-2, d_next is NaN at the last p
+        diff_data = np.diff(block_array, axis=1)
+        d_prev, d_curr = diff_data[:, :-1], diff_data[:, 1:]
+        d_next = np.concatenate((diff_data[:, 2:], np.full((num_rows, 1), np.nan)), axis=1)
+        peak = np.arange(1, num_time - 1)[np.newaxis, :]
+
+        is_peak = (d_prev > 0) & (d_curr < 0)
+        valid_peak = is_peak & (block_array[:, 1:-1] >= 60) & (peak >= 3) & (peak <= 27)
+        # a trough at p+1 is implied by d[p] < -15 and d[p+1] > 5
+        rule_trough = (d_prev < 5) & (d_curr < -15) & (d_next > 5)
+        rule_drop = (d_curr < -35) & (peak > 12) & (peak < 25)
+        yige_mask = valid_peak & (rule_trough | rule_drop) & row_gate[:, np.newaxis]
+    # with
+
+    rows, cols = np.nonzero(yige_mask)
+    if with_filtered:
+        return rows, cols + 1, sg_filter_block(block_array)
+    return rows, cols + 1
+
+
+def yige_locations_sparse(tsdata_array, version=2, block_rows=100000):
+    """
+    YIGE of all rows, block by block.
+    :return: (row index, time index) np.arrays
+    """
+    row_list, index_list = [], []
+    for start in range(0, tsdata_array.shape[0], block_rows):
+        rows, indices = yige_detect_block(tsdata_array[start:start + block_rows], version)
+        row_list.append(rows + start)
+        index_list.append(indices)
+    # for
+    if not row_list:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(row_list), np.concatenate(index_list)
 
-        # is grass land or not?
-        row_max = np.max(src_data)
-
-        if row_max>60:
-
-            # 计算波峰波谷, 二次差分
-            doublediff = np.diff(np.sign(np.diff(src_data)))
-            peak_locations = np.where(doublediff == -2)[0] + 1
-            doublediff = np.diff(np.sign(np.diff(-1 * src_data)))
-            trough_locations = np.where(doublediff == -2)[0] + 1
-
-            diff_data = np.diff(src_data)
-            for peak in peak_locations:
-                if (src_data[peak]<60) or (peak>27) or (peak<3):
-                    continue
-                if (peak+1) in trough_locations:
-                    if (diff_data[peak-1]<5) and (diff_data[peak]<-15) and (diff_data[peak+1]>5):
-                        yige_locations = np.append(yige_locations, peak)
-                        continue
-                if (diff_data[peak]<-35) and (peak>12) and (peak<25):
-                    yige_locations = np.append(yige_locations, peak)
-                    continue
-            # for
-        # if
-
-        # store string
-        yege_str = ','.join(str(i) for i in yige_locations)
-        results_arr = np.append(results_arr, yege_str)
-
-        # flot
-        if len(yige_locations) > 0:
-            print("### YIGE @ {}".format(yige_locations))
-        # fig = plt.figure(figsize=(12, 4))
-        # plt.plot(column, src_data, color='tab:blue', label="src", linestyle='-', linewidth=1)
-        # plt.plot(column, sgfiltered_data, color='deeppink', label="s-g", linestyle='-', linewidth=1)
-        # if len(yige_locations) > 0:
-        #     locations = np.array(yige_locations, dtype=int)
-        #     plt.scatter(np.array(column)[locations], np.array(src_data)[locations],
-        #                 marker=mpl.markers.CARETUPBASE, color='tab:green', s=32, label='YG')
-        # plt.legend()
-        # plt.show()
+
+def yige_strings(rows, indices, num_rows):
+    """
+    Comma separated locations for each row, in the format of the former per-row loop (e.g. '15.0,22.0').
+    """
+    results_arr = np.full(num_rows, '', dtype=object)
+    if len(rows) == 0:
+        return results_arr
+    boundaries = np.flatnonzero(np.diff(rows)) + 1
+    for row_indices, row in zip(np.split(indices, boundaries), rows[np.concatenate(([0], boundaries))]):
+        results_arr[row] = ','.join(str(float(i)) for i in row_indices)
     # for
+    return results_arr
+
+
+def yige_detection_1(tsdata):
+    """
+    PROBAV_S10_TOC_X17Y04
+    PROBAV_S10_TOC_X21Y04
+    """
+    rows, indices = yige_locations_sparse(tsdata.to_numpy(dtype=np.float64), version=1)
+    print("### YIGE: {} detections in {} of {} rows".format(len(rows), len(np.unique(rows)), len(tsdata)))
+
     # insert one column
-    tsdata["yige"] = results_arr
+    tsdata["yige"] = yige_strings(rows, indices, len(tsdata))
 
     # return
     return tsdata
 
 
 def yige_detection(tsdata):
-    column = tsdata.columns.values
-    column = [col[1:] for col in column]
-
-    results_arr = []
+    rows, indices = yige_locations_sparse(tsdata.to_numpy(dtype=np.float64), version=2)
+    print("### YIGE: {} detections in {} of {} rows".format(len(rows), len(np.unique(rows)), len(tsdata)))
 
-    for index, row in tsdata.iterrows():
-        src_data = row
-        yige_locations = []
-        sgfiltered_data = sg_filter(src_data)
-
-        # is grass land or not?
-        row_max = np.max(src_data)
-
-        # number of elements with value == 0
-        zero_num = np.sum(src_data<10)
-
-        if (row_max>80) and (zero_num<2):
-
-            # 计算波峰波谷, 二次差分
-            doublediff = np.diff(np.sign(np.diff(src_data)))
-            peak_locations = np.where(doublediff == -2)[0] + 1
-            doublediff = np.diff(np.sign(np.diff(-1 * src_data)))
-            trough_locations = np.where(doublediff == -2)[0] + 1
-
-            diff_data = np.diff(src_data)
-            for peak in peak_locations:
-                if (src_data[peak]<60) or (peak>27) or (peak<3):
-                    continue
-                if (peak+1) in trough_locations:
-                    if (diff_data[peak-1]<5) and (diff_data[peak]<-15) and (diff_data[peak+1]>5):
-                        yige_locations = np.append(yige_locations, peak)
-                        continue
-                if (diff_data[peak]<-35) and (peak>12) and (peak<25):
-                    yige_locations = np.append(yige_locations, peak)
-                    continue
-            # for
-        # if
-
-        # store string
-        yege_str = ','.join(str(i) for i in yige_locations)
-        results_arr = np.append(results_arr, yege_str)
-
-        # flot
-        if len(yige_locations) > 0:
-            print("### YIGE @ {} @ {}".format(index, yige_locations))
-        # fig = plt.figure(figsize=(12, 4))
-        # plt.plot(column, src_data, color='tab:blue', label="src", linestyle='-', linewidth=1)
-        # plt.plot(column, sgfiltered_data, color='deeppink', label="s-g", linestyle='-', linewidth=1)
-        # if len(yige_locations) > 0:
-        #     locations = np.array(yige_locations, dtype=int)
-        #     plt.scatter(np.array(column)[locations], np.array(src_data)[locations],
-        #                 marker=mpl.markers.CARETUPBASE, color='tab:green', s=32, label='YG')
-        # plt.legend()
-        # plt.show()
-    # for
     # insert one column
-    tsdata["yige"] = results_arr
+    tsdata["yige"] = yige_strings(rows, indices, len(tsdata))
 
     # return
     return tsdata
 
 
+def read_tsdata_chunks(data_file, prefix_columns=7, chunk_rows=200000):
+    """
+    Time series blocks of a CSV or Parquet table, (prefix dataframe, np.array (rows, time)) for each chunk.
+    """
+    if data_file.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(data_file).iter_batches(batch_size=chunk_rows):
+            data_pd = batch.to_pandas()
+            yield data_pd.iloc[:, :prefix_columns], data_pd.iloc[:, prefix_columns:].to_numpy(dtype=np.float64)
+        # for
+    else:
+        for data_pd in pd.read_csv(data_file, header=0, chunksize=chunk_rows):
+            yield data_pd.iloc[:, :prefix_columns], data_pd.iloc[:, prefix_columns:].to_numpy(dtype=np.float64)
+        # for
+
+
+def yige_detection_file(data_file, target_file, version=2, prefix_columns=7, chunk_rows=200000):
+    """
+    YIGE of a whole table streamed chunk by chunk, written as sparse CSV (row, index) of the detections.
+    :return: number of detections
+    """
+    num_rows, num_detections = 0, 0
+    with open(target_file, 'w') as target:
+        target.write("row,index\n")
+        for prefix_pd, tsdata_array in read_tsdata_chunks(data_file, prefix_columns, chunk_rows):
+            rows, indices = yige_locations_sparse(tsdata_array, version)
+            np.savetxt(target, np.column_stack((rows + num_rows, indices)), fmt='%d', delimiter=',')
+            num_rows += tsdata_array.shape[0]
+            num_detections += len(rows)
+            print("### {} rows, {} detections".format(num_rows, num_detections))
+        # for
+    # with
+    return num_detections
+
+
 def read_tsdata(data_file):
     data_pd = pd.read_csv(data_file, header=0)
     tsprefix_pd = data_pd.iloc[:, :7]
@@ -192,17 +223,16 @@ def main():
     print("### ", now)
     print("###########################################################")
 
-    csvdata_file = "I:/FF/application-project/2021-africagrass/PROBAV/6/PROBAV_S10_TOC_X21Y06/shp/csv/pixel_tsattri_2020.csv"
-    target_file = "I:/FF/application-project/2021-africagrass/PROBAV/6/PROBAV_S10_TOC_X21Y06/shp/csv/pixel_tsattri_2020_yige.csv"
-
-    tsprefix_pd, tsdata_pd = read_tsdata(csvdata_file)
-
-    # plot_tsdata(tsdata_pd)
-    yige_pd = yige_detection(tsdata_pd)
-
-    yige_pd.to_csv(target_file)
+    opts = parse_args()
+    if opts.sparse:
+        yige_detection_file(opts.src_file, opts.target_file, opts.version, chunk_rows=opts.chunk_rows)
+    else:
+        tsprefix_pd, tsdata_pd = read_tsdata(opts.src_file)
 
+        # plot_tsdata(tsdata_pd)
+        yige_pd = yige_detection(tsdata_pd) if opts.version == 2 else yige_detection_1(tsdata_pd)
 
+        yige_pd.to_csv(opts.target_file)
 
     print("### Task over #############################################")
 
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""
+YIGE (abrupt drop) detection over a multi-date NDVI stack, window by window on a process pool
+
+Author: Zhou Ya'nan
+Date: 2021-10-16
+"""
+import os
+import sys
+import time
+import datetime
+import argparse
+import concurrent.futures
+import numpy as np
+from osgeo import gdal
+gdal.UseExceptions()
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'raster'))
+from block_io import DEFAULT_BLOCK_SIZE, block_windows, read_block
+from batch_runner import bounded_completed
+from timeseries_plot import yige_detect_block
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='YIGE detection of a NDVI stack')
+    parser.add_argument('--src-stack', required=False, type=str, default="./data/ndvi_stack.tif",
+                        help='multi-band GeoTIFF (or VRT), one band for each date in time order')
+    parser.add_argument('--target-prefix', required=False, type=str, default="./data/yige",
+                        help='prefix of output rasters (_count.tif, _first.tif)')
+    parser.add_argument('--version', required=False, type=int, default=2,
+                        help='2 for the rules of yige_detection, 1 for yige_detection_1')
+    parser.add_argument('--scale', required=False, type=float, default=1.0,
+                        help='factor bringing the stack to the units of the thresholds (PROBAV NDVI digital numbers)')
+    parser.add_argument('--dates', required=False, type=str, default=None,
+                        help='comma separated date codes of the bands (e.g. 20200101), default band numbers')
+    parser.add_argument('--workers', required=False, type=int, default=4,
+                        help='processes, each working on one window at a time')
+    parser.add_argument('--block-size', required=False, type=int, default=DEFAULT_BLOCK_SIZE[0],
+                        help='window edge in pixels')
+    opts = parser.parse_args()
+    return opts
+
+
+def yige_window(block_array, version=2, scale=1.0, nodata=None):
+    """
+    YIGE of all pixels of one window.
+    :param block_array: np.array (dates, ysize, xsize)
+    :param nodata: value of missing observations, skipped by the rules
+    :return: (count, first event index) np.arrays (ysize, xsize) of uint8 (capped at 255) and int16,
+             first event is -1 where nothing was found
+    """
+    num_dates, ysize, xsize = block_array.shape
+    tsdata_array = block_array.reshape(num_dates, -1).T.astype(np.float64)
+    if nodata is not None:
+        tsdata_array[tsdata_array == nodata] = np.nan
+    if scale != 1:
+        tsdata_array *= scale
+
+    rows, indices = yige_detect_block(tsdata_array, version)
+    count = np.bincount(rows, minlength=tsdata_array.shape[0])
+    first = np.full(tsdata_array.shape[0], -1, dtype=np.int64)
+    # detections are in row-major order, the first of each row is its earliest event
+    event_rows, first_pos = np.unique(rows, return_index=True)
+    first[event_rows] = indices[first_pos]
+
+    # small types, the results travel back from the workers
+    count = np.minimum(count, 255).astype(np.uint8)
+    return count.reshape(ysize, xsize), first.astype(np.int16).reshape(ysize, xsize)
+
+
+def _yige_window_job(src_stack, window, version, scale):
+    # datasets can not be pickled, each task opens the stack itself
+    src_ds = gdal.Open(src_stack, gdal.GA_ReadOnly)
+    nodata = src_ds.GetRasterBand(1).GetNoDataValue()
+    block_array = read_block(src_ds, window, with_halo=False)
+    del src_ds
+    count, first = yige_window(block_array, version, scale, nodata)
+    return window, count, first
+
+
+def create_yige_image(save_path, src_ds, data_type, nodata):
+    file_driver = gdal.GetDriverByName('GTiff')
+    dst_ds = file_driver.Create(save_path, xsize=src_ds.RasterXSize, ysize=src_ds.RasterYSize, bands=1,
+                                eType=data_type, options=['TILED=YES', 'COMPRESS=DEFLATE'])
+    if not dst_ds:
+        raise Exception("Fail to create image {}".format(save_path))
+    dst_ds.SetProjection(src_ds.GetProjection())
+    dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    if nodata is not None:
+        dst_ds.GetRasterBand(1).SetNoDataValue(nodata)
+    return dst_ds
+
+
+def yige_raster(src_stack, target_prefix, version=2, scale=1.0, dates=None, workers=4,
+                block_size=DEFAULT_BLOCK_SIZE):
+    """
+    YIGE of every pixel of a stack, windows aligned to the stack blocks are processed in parallel.
+    Writes <target_prefix>_count.tif (number of events) and <target_prefix>_first.tif
+    (date code of the first event, 0 for none).
+    :param dates: date code for each band (e.g. 20200101), default 1-based band numbers
+    :return: dict with counts and seconds of the run
+    """
+    src_ds = gdal.Open(src_stack, gdal.GA_ReadOnly)
+    if not src_ds:
+        raise Exception("Unable to open image {}".format(src_stack))
+    num_dates = src_ds.RasterCount
+    if dates is None:
+        dates = range(1, num_dates + 1)
+    date_codes = np.append(np.asarray(dates, dtype=np.int32), 0)
+    if len(date_codes) != num_dates + 1:
+        raise Exception("{} dates given for {} bands".format(len(date_codes) - 1, num_dates))
+
+    count_ds = create_yige_image(target_prefix + '_count.tif', src_ds, gdal.GDT_Byte, None)
+    first_ds = create_yige_image(target_prefix + '_first.tif', src_ds, gdal.GDT_Int32, 0)
+    num_windows = len(list(block_windows(src_ds, block_size)))
+
+    start_time = time.time()
+    num_done, num_failed, num_pixels, num_events = 0, 0, 0, 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # a few windows in flight for each worker, results are released once written
+        jobs = ((src_stack, window, version, scale) for window in block_windows(src_ds, block_size))
+        for job, future in bounded_completed(executor, _yige_window_job, jobs, 2 * workers):
+            try:
+                window, count, first = future.result()
+            except Exception as e:
+                print("### Error @ window {}: {}".format(job[1], e))
+                num_failed += 1
+                continue
+            count_ds.GetRasterBand(1).WriteArray(count, window.xoff, window.yoff)
+            first_ds.GetRasterBand(1).WriteArray(date_codes[first], window.xoff, window.yoff)
+
+            num_done += 1
+            num_pixels += count.size
+            num_events += int(count.sum(dtype=np.int64))
+            if num_done % 50 == 0:
+                print("### [{}/{}] windows, {:.0f} pixels/s".format(
+                    num_done, num_windows, num_pixels / max(time.time() - start_time, 1e-6)))
+        # for
+    # with
+    elapsed = max(time.time() - start_time, 1e-6)
+
+    count_ds.FlushCache()
+    first_ds.FlushCache()
+    del count_ds, first_ds, src_ds
+
+    print("### YIGE over: {} windows, {} failed, {} events in {} pixels x {} dates, {:.1f}s ({:.0f} pixels/s)".format(
+        num_done, num_failed, num_events, num_pixels, num_dates, elapsed, num_pixels / elapsed))
+    return {'done': num_done, 'failed': num_failed, 'pixels': num_pixels, 'events': num_events, 'seconds': elapsed}
+
+
+def main():
+    now = datetime.datetime.now()
+    print("###########################################################")
+    print("### YIGE detection of NDVI stack ##########################")
+    print("### ", now)
+    print("###########################################################")
+
+    opts = parse_args()
+    dates = [int(d) for d in opts.dates.split(',')] if opts.dates else None
+    yige_raster(opts.src_stack, opts.target_prefix, opts.version, opts.scale, dates, opts.workers,
+                (opts.block_size, opts.block_size))
+
+    print("### Task over #############################################")
+
+
+if __name__ == "__main__":
+    main()
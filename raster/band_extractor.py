@@ -14,6 +14,9 @@ import numpy as np
 from osgeo import gdal, osr
 gdal.UseExceptions()
 
+from block_io import DEFAULT_BLOCK_SIZE, process_blocks
+from batch_runner import is_up_to_date, run_batch
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Band extractor for Raster dataset')
@@ -26,17 +29,30 @@ def parse_args():
     parser.add_argument('--band-list', required=False, type=str,
                         default=[0],
                         help='which bands to be extracted')
+    parser.add_argument('--streaming', action='store_true',
+                        help='extract block by block with bounded memory')
+    parser.add_argument('--src-folder', required=False, type=str, default=None,
+                        help='folder of source rasters for batch extraction')
+    parser.add_argument('--suffix', required=False, type=str, default="_1",
+                        help='suffix appended to the name of target rasters in batch mode')
+    parser.add_argument('--workers', required=False, type=int, default=os.cpu_count(),
+                        help='number of processes in batch mode')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='re-extract targets that are up to date')
     opts = parser.parse_args()
     return opts
 
 
-def raster_band_extractor(src_raster, target_raster, band_list=[0], file_format='GTiff'):
+def raster_band_extractor(src_raster, target_raster, band_list=[0], file_format='GTiff', streaming=False,
+                          block_size=DEFAULT_BLOCK_SIZE):
     """
 
     :param src_raster:
     :param target_raster:
     :param band_list:
     :param file_format:
+    :param streaming: copy window by window instead of whole bands
+    :param block_size: window size (x, y) for streaming mode
     :return:
     """
     print("### Band extractor for []".format(src_raster))
@@ -74,19 +90,71 @@ def raster_band_extractor(src_raster, target_raster, band_list=[0], file_format=
     if metadata.get(gdal.DCAP_CREATE) == "YES":
         print("Driver {} supports CreateCopy() method.".format(file_format))
 
-    target_ds = file_driver.Create(target_raster, xsize=src_wid, ysize=src_hei, bands=target_band, eType=data_type)
-    target_ds.SetProjection(src_ds.GetProjection())
-    target_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    # GTiff is written to a temporary file first, so that a failed run leaves no complete-looking target;
+    # other drivers may write sidecars (.aux.xml, .hdr) named after the file and write the target directly
+    temp_raster = target_raster + '.part' if file_format == 'GTiff' else target_raster
+    target_ds = file_driver.Create(temp_raster, xsize=src_wid, ysize=src_hei, bands=target_band, eType=data_type)
     if not target_ds:
         raise Exception("Wrong target raster @{}".format(target_raster))
+    try:
+        target_ds.SetProjection(src_ds.GetProjection())
+        target_ds.SetGeoTransform(src_ds.GetGeoTransform())
+
+        if streaming:
+            process_blocks(src_ds, target_ds, None, block_size, src_bands=[channel + 1 for channel in band_list])
+        else:
+            for idx, channel in enumerate(band_list):
+                band_array = src_ds.GetRasterBand(channel + 1).ReadAsArray()
+                target_ds.GetRasterBand(idx + 1).WriteArray(band_array)
+
+        # print("### Building overviews")
+        # dst_ds.BuildOverviews("NEAREST")
+        target_ds.FlushCache()
+        target_ds = None
+        if temp_raster != target_raster:
+            os.replace(temp_raster, target_raster)
+    finally:
+        target_ds = None
+        if (temp_raster != target_raster) and os.path.exists(temp_raster):
+            os.remove(temp_raster)
+    # try
+
+
+def _band_extractor_job(job):
+    """
+    Run one extraction in a worker process, return (src_raster, size in bytes, seconds).
+    """
+    src_raster, target_raster, band_list, streaming = job
+    start_time = time.time()
+    raster_band_extractor(src_raster, target_raster, band_list, streaming=streaming)
+    return src_raster, os.path.getsize(src_raster), time.time() - start_time
 
-    for idx, channel in enumerate(band_list):
-        band_array = src_ds.GetRasterBand(channel + 1).ReadAsArray()
-        target_ds.GetRasterBand(idx + 1).WriteArray(band_array)
 
-    # print("### Building overviews")
-    # dst_ds.BuildOverviews("NEAREST")
-    # target_ds.FlushCache()
+def batch_band_extractor(srcraster_list, targetraster_list, band_list=[0], workers=None, streaming=False,
+                         overwrite=False):
+    """
+    Run raster_band_extractor over many files in a process pool.
+    :param srcraster_list: source rasters
+    :param targetraster_list: target rasters, one for each source
+    :param band_list:
+    :param workers: number of processes, default os.cpu_count()
+    :param streaming: streaming mode of raster_band_extractor
+    :param overwrite: also re-extract targets that are up to date
+    :return: dict with counts, bytes and seconds of the run
+    """
+    assert (len(srcraster_list) == len(targetraster_list))
+
+    jobs = []
+    num_skipped = 0
+    for srcr, targetr in zip(srcraster_list, targetraster_list):
+        if (not overwrite) and is_up_to_date(srcr, targetr):
+            print("### Skip up-to-date {}".format(targetr))
+            num_skipped += 1
+            continue
+        jobs.append((srcr, targetr, band_list, streaming))
+    # for
+
+    return run_batch(_band_extractor_job, jobs, num_skipped, workers)
 
 
 def main():
@@ -117,10 +185,15 @@ def main():
         'i:\sentinel2-2021\L1C_T48RWU\index\ireci\S2B_MSIL2A_20210819T033539_N0301_R061_T48RWU_ireci.tif'
     ]
 
-    for srcr in srcraster_list:
-        targetr = srcr[:-4] + '_1.tif'
-        raster_band_extractor(srcr, targetr)
-        pass
+    opts = parse_args()
+    suffix = opts.suffix
+    if opts.src_folder:
+        srcraster_list = [os.path.join(opts.src_folder, f) for f in sorted(os.listdir(opts.src_folder))
+                          if f.endswith('.tif') and not f.endswith(suffix + '.tif')]
+
+    targetraster_list = [srcr[:-4] + suffix + '.tif' for srcr in srcraster_list]
+    batch_band_extractor(srcraster_list, targetraster_list, workers=opts.workers, streaming=opts.streaming,
+                         overwrite=opts.overwrite)
 
     print("### Task is over!")
 
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+"""
+File-by-file batch conversion in a process pool, with skipping of up-to-date targets
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import time
+import itertools
+import concurrent.futures
+
+
+def is_up_to_date(src_file, target_file):
+    """
+    Target is up to date if it exists, is not empty and is not older than the source.
+    """
+    if not os.path.exists(target_file):
+        return False
+    target_stat = os.stat(target_file)
+    return (target_stat.st_size > 0) and (target_stat.st_mtime >= os.stat(src_file).st_mtime)
+
+
+def bounded_completed(executor, job_func, jobs, max_in_flight):
+    """
+    Submit job_func(*job) for each job, keeping at most max_in_flight of them pending,
+    and yield (job, future) as they complete. Finished futures are not kept, so the memory of the
+    results is bounded by max_in_flight, not by the number of jobs.
+    """
+    jobs = iter(jobs)
+    pending = {executor.submit(job_func, *job): job for job in itertools.islice(jobs, max_in_flight)}
+    while pending:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            job = pending.pop(future)
+            for next_job in itertools.islice(jobs, 1):
+                pending[executor.submit(job_func, *next_job)] = next_job
+            yield job, future
+        # for
+    # while
+
+
+def run_batch(job_func, jobs, num_skipped=0, workers=None):
+    """
+    Run job_func over the jobs in a process pool, printing progress and throughput.
+    :param job_func: picklable callable (job) -> (source file, size in bytes, seconds), raising on failure
+    :param jobs: job tuples, the first item of each is its source file
+    :param num_skipped: jobs already skipped by the caller, for the summary
+    :param workers: number of processes, default os.cpu_count()
+    :return: dict with counts, bytes and seconds of the run
+    """
+    start_time = time.time()
+    num_done, num_failed, total_bytes = 0, 0, 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        future_jobs = {executor.submit(job_func, job): job for job in jobs}
+        for future in concurrent.futures.as_completed(future_jobs):
+            try:
+                src_file, size, seconds = future.result()
+            except Exception as e:
+                print("### Error @ {}: {}".format(future_jobs[future][0], e))
+                num_failed += 1
+                continue
+            num_done += 1
+            total_bytes += size
+            print("### [{}/{}] {} in {:.2f}s ({:.1f} MB/s)".format(
+                num_done, len(jobs), os.path.basename(src_file), seconds, size / 1e6 / max(seconds, 1e-6)))
+        # for
+    # with
+    elapsed = max(time.time() - start_time, 1e-6)
+
+    print("### Batch over: {} done, {} skipped, {} failed in {:.1f}s".format(num_done, num_skipped, num_failed, elapsed))
+    print("### Throughput: {:.1f} MB/s, {:.2f} files/s".format(total_bytes / 1e6 / elapsed, num_done / elapsed))
+
+    return {'done': num_done, 'skipped': num_skipped, 'failed': num_failed,
+            'bytes': total_bytes, 'seconds': elapsed}
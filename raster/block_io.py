@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""
+Block-windowed streaming I/O for gdal datasets
+
+Windows are aligned to the natural block size of the source, so every read touches whole
+tiles (or strips) and peak memory is bounded by the window size, not by the image size.
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import collections
+import numpy as np
+from osgeo import gdal, osr
+gdal.UseExceptions()
+
+
+# target window edge (x, y) in pixels, rounded to multiples of the natural block size
+DEFAULT_BLOCK_SIZE = (512, 512)
+
+block_window = collections.namedtuple(
+    'block_window', ['xoff', 'yoff', 'xsize', 'ysize', 'halo_xoff', 'halo_yoff', 'halo_xsize', 'halo_ysize'])
+
+
+def natural_block_size(raster_ds, band=1):
+    """
+    Natural block size (x, y) of one band, e.g. (256, 256) for tiled or (width, 1) for striped TIFF.
+    """
+    block_x, block_y = raster_ds.GetRasterBand(band).GetBlockSize()
+    return max(1, block_x), max(1, block_y)
+
+
+def block_windows(raster_ds, block_size=DEFAULT_BLOCK_SIZE, halo=0):
+    """
+    Iterate windows over the raster, aligned to its natural block size.
+    :param raster_ds: gdal dataset
+    :param block_size: target window size (x, y), rounded down to multiples of the natural block size
+    :param halo: extra pixels read around each window for neighbourhood operations,
+                 clipped at the raster border
+    :return: generator of block_window
+    """
+    width, height = raster_ds.RasterXSize, raster_ds.RasterYSize
+    block_x, block_y = natural_block_size(raster_ds)
+    step_x = max(block_x, (block_size[0] // block_x) * block_x)
+    step_y = max(block_y, (block_size[1] // block_y) * block_y)
+
+    for yoff in range(0, height, step_y):
+        ysize = min(step_y, height - yoff)
+        halo_yoff = max(0, yoff - halo)
+        halo_ysize = min(height, yoff + ysize + halo) - halo_yoff
+
+        for xoff in range(0, width, step_x):
+            xsize = min(step_x, width - xoff)
+            halo_xoff = max(0, xoff - halo)
+            halo_xsize = min(width, xoff + xsize + halo) - halo_xoff
+
+            yield block_window(xoff, yoff, xsize, ysize, halo_xoff, halo_yoff, halo_xsize, halo_ysize)
+        # for
+    # for
+
+
+def read_block(raster_ds, window, band_list=None, with_halo=True):
+    """
+    Read one window from the dataset.
+    :param raster_ds: gdal dataset
+    :param window: block_window
+    :param band_list: 1-based band numbers, default all bands
+    :param with_halo: read the halo region around the window as well
+    :return: np.array with shape (bands, ysize, xsize)
+    """
+    if band_list is None:
+        band_list = range(1, raster_ds.RasterCount + 1)
+
+    if with_halo:
+        xoff, yoff, xsize, ysize = window.halo_xoff, window.halo_yoff, window.halo_xsize, window.halo_ysize
+    else:
+        xoff, yoff, xsize, ysize = window.xoff, window.yoff, window.xsize, window.ysize
+
+    band_arrays = [raster_ds.GetRasterBand(bb).ReadAsArray(xoff, yoff, xsize, ysize) for bb in band_list]
+    return np.stack(band_arrays, axis=0)
+
+
+def crop_halo(block_array, window):
+    """
+    Remove the halo from an array read with read_block(..., with_halo=True).
+    """
+    top = window.yoff - window.halo_yoff
+    left = window.xoff - window.halo_xoff
+    return block_array[..., top:top + window.ysize, left:left + window.xsize]
+
+
+def write_block(raster_ds, window, block_array, band_list=None, scale=1):
+    """
+    Write one window (without halo) to the dataset.
+    :param raster_ds: gdal dataset opened for update
+    :param window: block_window in source pixel coordinates
+    :param block_array: np.array with shape (bands, ysize*scale, xsize*scale)
+    :param band_list: 1-based band numbers, default 1..bands
+    :param scale: integer factor between target and source pixel grids
+    """
+    if block_array.ndim == 2:
+        block_array = block_array[np.newaxis, :, :]
+    if band_list is None:
+        band_list = range(1, block_array.shape[0] + 1)
+
+    for idx, bb in enumerate(band_list):
+        raster_ds.GetRasterBand(bb).WriteArray(block_array[idx], window.xoff * scale, window.yoff * scale)
+
+
+def process_blocks(src_ds, target_ds, block_func=None, block_size=DEFAULT_BLOCK_SIZE, halo=0,
+                   src_bands=None, target_bands=None, target_scale=1):
+    """
+    Stream the source through block_func window by window and write the results to the target.
+    :param src_ds: gdal dataset
+    :param target_ds: gdal dataset opened for update, with the same grid as src_ds
+                      (or target_scale times finer)
+    :param block_func: callable (block_array, window) -> np.array (bands, ysize*target_scale, xsize*target_scale),
+                       block_array includes the halo, use crop_halo() to drop it; None copies the block
+    :param block_size: target window size (x, y)
+    :param halo: halo width in pixels
+    :param src_bands: 1-based source band numbers, default all bands
+    :param target_bands: 1-based target band numbers, default 1..bands
+    :param target_scale: integer factor between target and source pixel grids
+    :return: number of windows processed
+    """
+    num_windows = 0
+    for window in block_windows(src_ds, block_size, halo):
+        block_array = read_block(src_ds, window, src_bands, with_halo=True)
+        if block_func is None:
+            result_array = crop_halo(block_array, window)
+        else:
+            result_array = block_func(block_array, window)
+        write_block(target_ds, window, result_array, target_bands, target_scale)
+        num_windows += 1
+    # for
+
+    return num_windows
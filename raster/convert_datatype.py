@@ -13,6 +13,8 @@ import argparse
 import numpy as np
 from osgeo import gdal, osr
 
+from block_io import DEFAULT_BLOCK_SIZE, process_blocks
+
 os.environ['CPL_ZIP_ENCODING'] = 'UTF-8'
 gdal.UseExceptions()
 
@@ -29,14 +31,19 @@ def parse_args():
     parser.add_argument('--datatype', required=False, type=str,
                         default="uint8",
                         help='datatype for results in [uint8,uint16,uint32,int16]')
+    parser.add_argument('--streaming', action='store_true',
+                        help='convert block by block with bounded memory')
     opts = parser.parse_args()
     return opts
 
 
-def convert_raster_datatype(src_path, target_path, datatype='uint8', format='GTiff'):
+def convert_raster_datatype(src_path, target_path, datatype='uint8', format='GTiff', streaming=False,
+                            block_size=DEFAULT_BLOCK_SIZE):
 
     """
-
+    Convert the datatype of raster.
+    :param streaming: convert window by window instead of reading the whole image
+    :param block_size: window size (x, y) for streaming mode
     """
 
     #################################################################
@@ -53,17 +60,15 @@ def convert_raster_datatype(src_path, target_path, datatype='uint8', format='GTi
 
     #################################################################
     # 2. get data
-    src_array = src_ds.ReadAsArray()
-
     gdal_type_dict = {'uint8': gdal.GDT_Byte, 'uint16': gdal.GDT_UInt16, 'uint32': gdal.GDT_UInt32,
                  'int16': gdal.GDT_Int16, 'int32': gdal.GDT_Int32,
                  'float32': gdal.GDT_Float32, 'float64': gdal.GDT_Float64}
     gdal_type = gdal_type_dict[datatype]
 
-    np_type_dict = {'uint8': np.byte, 'uint16': np.uint16, 'uint32': np.uint32,
+    np_type_dict = {'uint8': np.uint8, 'uint16': np.uint16, 'uint32': np.uint32,
                     'int16': np.int16, 'int32': np.int32,
                     'float32': np.float32, 'float64': np.float64}
-    tar_array = src_array.astype(np_type_dict[datatype])
+    np_type = np_type_dict[datatype]
 
     #################################################################
     # 3. write image
@@ -77,7 +82,11 @@ def convert_raster_datatype(src_path, target_path, datatype='uint8', format='GTi
     tar_ds.SetProjection(src_proj)
 
     # dst_ds.GetRasterBand(1).SetNoDataValue(nodata_value)
-    tar_ds.WriteRaster(0, 0, src_shape[0], src_shape[1], tar_array.tobytes())
+    if streaming:
+        process_blocks(src_ds, tar_ds, lambda block_array, window: block_array.astype(np_type), block_size)
+    else:
+        tar_array = src_ds.ReadAsArray().astype(np_type)
+        tar_ds.WriteRaster(0, 0, src_shape[0], src_shape[1], tar_array.tobytes())
 
     #################################################################
     # 4. close
@@ -100,13 +109,14 @@ def main():
     src_path = opts.src_path
     target_path = opts.target_path
     datatype = opts.datatype
+    streaming = opts.streaming
 
     # src_path = r'H:\FF\application_dataset\2020-france-agri\s2_l1c_fmask_mask_band\L1C_T31TFN_20190103T104708_Fmask4_mask.tif'
     # target_path = r'H:\FF\application_dataset\2020-france-agri\s2_l1c_fmask_mask_band_10m\L1C_T31TFN_20190103T104708_Fmask4_mask.tif'
     # datatype = 'uint8'
 
     ###########################################################
-    convert_raster_datatype(src_path, target_path, datatype)
+    convert_raster_datatype(src_path, target_path, datatype, streaming=streaming)
 
     ###########################################################
     # close
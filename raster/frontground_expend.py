@@ -9,39 +9,126 @@ Date: 2021-09-16
 import os
 import rasterio
 import numpy as np
+from rasterio.windows import Window
 
 
-def invalid_pixel_mask_expend(input_raster, output_raster):
+def structuring_element(size=3, shape='square'):
+    """
+    Build a boolean structuring element for the morphological dilation.
+    :param size: odd edge length of the element, 3 gives the classic 3x3 neighbourhood
+    :param shape: one of 'square', 'cross', 'disk'
+    :return: np.array of bool with shape (size, size)
+    """
+    if size < 1 or size % 2 == 0:
+        raise Exception("Size of structuring element should be odd and positive, got {}".format(size))
+
+    radius = size // 2
+    yy, xx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+
+    if shape == 'square':
+        selem = np.ones((size, size), dtype=bool)
+    elif shape == 'cross':
+        selem = (yy == 0) | (xx == 0)
+    elif shape == 'disk':
+        selem = (yy * yy + xx * xx) <= radius * radius
+    else:
+        raise Exception("Structuring element {} not supported".format(shape))
+
+    return selem
+
+
+def invalid_value_predicate(nodata=None, values=None, value_range=None):
+    """
+    Build the predicate telling which pixels are invalid.
+    :param nodata: single nodata value, NaN is supported
+    :param values: sequence of values regarded as invalid
+    :param value_range: (low, high) closed interval regarded as invalid
+    :return: callable, band_array -> bool mask
+    """
+    def _predicate(band_array):
+        invalid_mask = np.zeros(band_array.shape, dtype=bool)
+        if nodata is not None:
+            if np.isnan(nodata):
+                invalid_mask |= np.isnan(band_array)
+            else:
+                invalid_mask |= (band_array == nodata)
+        if values is not None:
+            invalid_mask |= np.isin(band_array, values)
+        if value_range is not None:
+            low, high = value_range
+            invalid_mask |= (band_array >= low) & (band_array <= high)
+        return invalid_mask
+
+    return _predicate
+
+
+def binary_dilate(mask, selem):
+    """
+    Dilate a boolean mask with the structuring element, pixels outside the mask are regarded as valid.
+    Each offset of the element is an OR of one shifted view, so the cost is size*size whole-array operations.
+    :param mask: 2D np.array of bool
+    :param selem: 2D np.array of bool, with odd shape
+    :return: 2D np.array of bool, same shape as mask
+    """
+    radius_y, radius_x = selem.shape[0] // 2, selem.shape[1] // 2
+    height, width = mask.shape
+
+    padded = np.pad(mask, ((radius_y, radius_y), (radius_x, radius_x)), mode='constant', constant_values=False)
+    dilated = np.zeros(mask.shape, dtype=bool)
+    for dy, dx in zip(*np.nonzero(selem)):
+        dilated |= padded[dy:dy + height, dx:dx + width]
+
+    return dilated
+
+
+def _expend_windows(src_dataset, block_size, halo):
+    """
+    Yield (window, halo_window) pairs, windows are aligned to the natural block size of the source.
+    """
+    block_y, block_x = src_dataset.block_shapes[0]
+    step_y = max(block_y, (block_size // block_y) * block_y)
+    step_x = max(block_x, (block_size // block_x) * block_x)
+
+    for row_off in range(0, src_dataset.height, step_y):
+        win_h = min(step_y, src_dataset.height - row_off)
+        halo_row = max(0, row_off - halo)
+        halo_h = min(src_dataset.height, row_off + win_h + halo) - halo_row
+
+        for col_off in range(0, src_dataset.width, step_x):
+            win_w = min(step_x, src_dataset.width - col_off)
+            halo_col = max(0, col_off - halo)
+            halo_w = min(src_dataset.width, col_off + win_w + halo) - halo_col
+
+            yield (Window(col_off, row_off, win_w, win_h),
+                   Window(halo_col, halo_row, halo_w, halo_h))
+
+
+def invalid_pixel_mask_expend(input_raster, output_raster, size=3, shape='square', invalid_predicate=None,
+                              band=1, block_size=1024):
+    """
+    Mark invalid pixels and their neighbourhood (morphological dilation) in a uint8 mask raster.
+    The raster is processed window by window with a halo of size//2 pixels, so memory is bounded by block_size.
+    :param input_raster:
+    :param output_raster:
+    :param size: edge length of the structuring element
+    :param shape: 'square', 'cross' or 'disk'
+    :param invalid_predicate: callable from invalid_value_predicate(), default marks value 0 as invalid
+    :param band: band (1-based) used for the invalid test
+    :param block_size: approximate edge length of processing windows, in pixels
+    :return:
+    """
+    selem = structuring_element(size, shape)
+    halo = size // 2
+    if invalid_predicate is None:
+        invalid_predicate = invalid_value_predicate(values=(0,))
 
     with rasterio.open(input_raster) as src_dataset:
         profile = src_dataset.profile
 
-        # raster_array = src_dataset.read() # read all bands
-        band_array = src_dataset.read(1)
-        invalid_mask = (band_array == 0)
-        height, width = invalid_mask.shape
-
-        invalid_mask_expend = np.zeros(shape=(height+2, width+2), dtype=np.uint8)
-        for hh in range(height):
-            for ww in range(width):
-                if invalid_mask[hh, ww]==True:
-                    # invalid_mask_expend[hh  , ww  ] = 1
-                    # invalid_mask_expend[hh  , ww+1] = 1
-                    # invalid_mask_expend[hh  , ww+2] = 1
-                    # invalid_mask_expend[hh+1, ww  ] = 1
-                    # invalid_mask_expend[hh+1, ww+1] = 1
-                    # invalid_mask_expend[hh+1, ww+2] = 1
-                    # invalid_mask_expend[hh+2, ww  ] = 1
-                    # invalid_mask_expend[hh+2, ww+1] = 1
-                    # invalid_mask_expend[hh+2, ww+2] = 1
-                    for h in range(3):
-                        for w in range(3):
-                            invalid_mask_expend[hh + h, ww + w] = 1
-        invalid_mask_expend = invalid_mask_expend[1:-1, 1:-1]
-
         profile.update(
             dtype=np.uint8,
-            count=1
+            count=1,
+            nodata=None
         )
         '''you can also using ...
         with rasterio.open('NDVI.tif', mode='w', driver='GTiff',
@@ -49,7 +136,18 @@ def invalid_pixel_mask_expend(input_raster, output_raster):
                            crs=src.crs, transform=src.transform, dtype=np.uint8) as dst:
         '''
         with rasterio.open(output_raster, mode='w', **profile) as dst_dataset:
-            dst_dataset.write(invalid_mask_expend, 1)
+            for window, halo_window in _expend_windows(src_dataset, block_size, halo):
+                band_array = src_dataset.read(band, window=halo_window)
+                invalid_mask = invalid_predicate(band_array)
+                invalid_mask_expend = binary_dilate(invalid_mask, selem)
+
+                # crop the halo away
+                top = window.row_off - halo_window.row_off
+                left = window.col_off - halo_window.col_off
+                invalid_mask_expend = invalid_mask_expend[top:top + window.height, left:left + window.width]
+
+                dst_dataset.write(invalid_mask_expend.astype(np.uint8), 1, window=window)
+            # for
         # with
     # with
 
@@ -14,11 +14,74 @@ import numpy as np
 from skimage import exposure
 from osgeo import gdal, osr
 
+from block_io import DEFAULT_BLOCK_SIZE, block_windows, read_block, process_blocks
+
 os.environ['CPL_ZIP_ENCODING'] = 'UTF-8'
 gdal.UseExceptions()
 
 
-def hist_match(src_path, ref_path, matched_path, format='GTiff'):
+np_type_dict = {gdal.GDT_Byte: np.uint8, gdal.GDT_UInt16: np.uint16, gdal.GDT_Int16: np.int16,
+                gdal.GDT_UInt32: np.uint32, gdal.GDT_Int32: np.int32,
+                gdal.GDT_Float32: np.float32, gdal.GDT_Float64: np.float64}
+
+
+def band_value_counts(raster_ds, band, block_size=DEFAULT_BLOCK_SIZE, nbins=4096):
+    """
+    Accumulate the histogram of one band block by block.
+    8/16-bit integer bands are counted per value (exact), other bands in nbins bins between min and max.
+    Pixels equal to the nodata value of the band (and NaN) are not counted.
+    :return: (values, counts) of the non-empty bins
+    """
+    raster_band = raster_ds.GetRasterBand(band)
+    np_type = np_type_dict[raster_band.DataType]
+    nodata = raster_band.GetNoDataValue()
+
+    if np.issubdtype(np_type, np.integer) and np.iinfo(np_type).bits <= 16:
+        offset = np.iinfo(np_type).min
+        counts = np.zeros(np.iinfo(np_type).max - offset + 1, dtype=np.int64)
+        for window in block_windows(raster_ds, block_size):
+            block_array = read_block(raster_ds, window, [band], with_halo=False)
+            counts += np.bincount((block_array.ravel().astype(np.int64) - offset), minlength=counts.size)
+        if (nodata is not None) and (offset <= nodata <= np.iinfo(np_type).max) and float(nodata).is_integer():
+            counts[int(nodata) - offset] = 0
+        values = np.arange(counts.size, dtype=np.float64) + offset
+    else:
+        (band_min, band_max) = raster_band.ComputeRasterMinMax(False)
+        if band_max > band_min:
+            edges = np.linspace(band_min, band_max, nbins + 1)
+        else:
+            # constant band, a single bin holding all valid pixels
+            edges = np.array([band_min - 0.5, band_min + 0.5])
+        counts = np.zeros(len(edges) - 1, dtype=np.int64)
+        for window in block_windows(raster_ds, block_size):
+            block_array = read_block(raster_ds, window, [band], with_halo=False).ravel()
+            valid = np.isfinite(block_array)
+            if nodata is not None:
+                valid &= block_array != nodata
+            counts += np.histogram(block_array[valid], bins=edges)[0]
+        values = (edges[:-1] + edges[1:]) / 2
+    # if
+
+    valid = counts > 0
+    return values[valid], counts[valid]
+
+
+def match_cumulative_cdf(src_values, src_counts, ref_values, ref_counts):
+    """
+    Map source values to reference values with the same cumulative frequency.
+    """
+    src_quantiles = np.cumsum(src_counts) / float(np.sum(src_counts))
+    ref_quantiles = np.cumsum(ref_counts) / float(np.sum(ref_counts))
+    return np.interp(src_quantiles, ref_quantiles, ref_values)
+
+
+def hist_match(src_path, ref_path, matched_path, format='GTiff', streaming=False, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Match the histogram of source image to the reference image.
+    :param streaming: collect histograms and remap pixels block by block, band by band,
+                      instead of reading both images into memory
+    :param block_size: window size (x, y) for streaming mode
+    """
 
     #################################################################
     # 1. open source data
@@ -38,15 +101,7 @@ def hist_match(src_path, ref_path, matched_path, format='GTiff'):
     ref_shape = (ref_ds.RasterXSize, ref_ds.RasterYSize, ref_ds.RasterCount)
 
     #################################################################
-    # 2. get data
-    src_array = src_ds.ReadAsArray()
-    ref_array = ref_ds.ReadAsArray()
-
-    multi = 2 if src_shape[-1] > 1 else None
-    matched_array = exposure.match_histograms(src_array, ref_array, channel_axis=multi)
-
-    #################################################################
-    # 3. write image
+    # 2. write image
     matched_driver = gdal.GetDriverByName(format)
     matched_ds = matched_driver.Create(matched_path, xsize=src_shape[0], ysize=src_shape[1], bands=src_shape[2], eType=src_datatype)
     if not matched_ds:
@@ -55,14 +110,39 @@ def hist_match(src_path, ref_path, matched_path, format='GTiff'):
     matched_ds.SetGeoTransform(src_geotransform)
     matched_ds.SetProjection(src_proj)
 
-    matched_ds.WriteRaster(0, 0, src_shape[0], src_shape[1], matched_array.tobytes())
+    if streaming:
+        assert (src_shape[2] == ref_shape[2])
+        np_type = np_type_dict[src_datatype]
+
+        for bb in range(0, src_shape[2]):
+            src_values, src_counts = band_value_counts(src_ds, bb + 1, block_size)
+            ref_values, ref_counts = band_value_counts(ref_ds, bb + 1, block_size)
+            matched_values = match_cumulative_cdf(src_values, src_counts, ref_values, ref_counts)
+
+            def remap_block(block_array, window):
+                matched_block = np.interp(block_array, src_values, matched_values)
+                if np.issubdtype(np_type, np.integer):
+                    matched_block = np.clip(np.rint(matched_block), np.iinfo(np_type).min, np.iinfo(np_type).max)
+                return matched_block.astype(np_type)
+
+            process_blocks(src_ds, matched_ds, remap_block, block_size, src_bands=[bb + 1], target_bands=[bb + 1])
+        # for
+    else:
+        src_array = src_ds.ReadAsArray()
+        ref_array = ref_ds.ReadAsArray()
+
+        multi = 2 if src_shape[-1] > 1 else None
+        matched_array = exposure.match_histograms(src_array, ref_array, channel_axis=multi)
+
+        matched_ds.WriteRaster(0, 0, src_shape[0], src_shape[1], matched_array.tobytes())
+        del ref_array, src_array
 
     #################################################################
-    # 4. close
+    # 3. close
     # print("### Building overviews")
     # dst_ds.BuildOverviews("NEAREST")
     matched_ds.FlushCache()
-    del matched_ds, ref_array, src_array
+    del matched_ds
 
     print("### Success @ hist_match() ##################")
 
@@ -7,8 +7,11 @@ Author: Zhou Ya'nan
 Date: 2021-09-16
 """
 import os
+import re
+import time
 import datetime
 import argparse
+import concurrent.futures
 import numpy as np
 import pandas as pd
 from pyhdf.SD import SD, SDC
@@ -24,37 +27,137 @@ def parse_args():
     parser.add_argument('--target-raster', required=False, type=str,
                         default="./data/target.tif",
                         help='target raster file in TIFF format')
+    parser.add_argument('--src-folder', required=False, type=str, default=None,
+                        help='folder of MCD19A2 granules for batch mode')
+    parser.add_argument('--target-folder', required=False, type=str, default="./data",
+                        help='folder of daily and period composites in batch mode')
+    parser.add_argument('--start-date', required=False, type=str, default=None,
+                        help='first date (YYYY-MM-DD) in batch mode')
+    parser.add_argument('--end-date', required=False, type=str, default=None,
+                        help='last date (YYYY-MM-DD) in batch mode')
+    parser.add_argument('--period-days', required=False, type=int, default=8,
+                        help='length of composite periods in days, counted from Jan 1st')
+    parser.add_argument('--workers', required=False, type=int, default=os.cpu_count(),
+                        help='number of processes in batch mode')
     opts = parser.parse_args()
     return opts
 
 
-def aod_read_mvc(hdf_path, aod_key = 'Optical_Depth_055'):
+# MODIS sinusoidal grid, 36 x 18 tiles of 1111950.519667 m
+MODIS_SINU_PROJ4 = '+proj=sinu +lon_0=0 +x_0=0 +y_0=0 +R=6371007.181 +units=m +no_defs'
+MODIS_SINU_XMIN = -20015109.354
+MODIS_SINU_YMAX = 10007554.677
+MODIS_TILE_SIZE = 2 * 20015109.354 / 36
+
+# e.g. MCD19A2.A2017001.h27v05.006.2018114111739.hdf
+granule_pattern = re.compile(r'\.A(\d{4})(\d{3})\.h(\d{2})v(\d{2})\.')
+
+
+def parse_granule_name(hdf_path):
     """
+    (date, h, v) from the name of a MODIS granule, None if it does not match.
+    """
+    matched = granule_pattern.search(os.path.basename(hdf_path))
+    if not matched:
+        return None
+    year, doy, h, v = [int(g) for g in matched.groups()]
+    return datetime.date(year, 1, 1) + datetime.timedelta(days=doy - 1), h, v
+
 
+def sinusoidal_geotransform(h, v, xsize=1200, ysize=1200):
     """
-    print("### Reading HDF image {}".format(hdf_path))
+    Geotransform of tile hXXvYY of the MODIS sinusoidal grid, e.g. 926.625433 m pixels for 1200 x 1200.
+    """
+    ulx = MODIS_SINU_XMIN + h * MODIS_TILE_SIZE
+    uly = MODIS_SINU_YMAX - v * MODIS_TILE_SIZE
+    return ulx, MODIS_TILE_SIZE / xsize, 0.0, uly, 0.0, -MODIS_TILE_SIZE / ysize
+
+
+def metadata_geotransform(hdf_scidata, xsize=1200, ysize=1200):
+    """
+    Geotransform from UpperLeftPointMtrs/LowerRightMtrs of StructMetadata.0, None if not found.
+    """
+    struct_metadata = hdf_scidata.attributes().get('StructMetadata.0', '')
+    upper_left = re.search(r'UpperLeftPointMtrs=\(([-\d.]+),([-\d.]+)\)', struct_metadata)
+    lower_right = re.search(r'LowerRightMtrs=\(([-\d.]+),([-\d.]+)\)', struct_metadata)
+    if not (upper_left and lower_right):
+        return None
+    ulx, uly = float(upper_left.group(1)), float(upper_left.group(2))
+    lrx, lry = float(lower_right.group(1)), float(lower_right.group(2))
+    return ulx, (lrx - ulx) / xsize, 0.0, uly, 0.0, (lry - uly) / ysize
 
-    hdf_scidata = SD(hdf_path, SDC.READ)
-    # print (hdf_scidata.info(), hdf_scidata.attributes())
 
-    scidata_dict = hdf_scidata.datasets()
-    for idx, sds in enumerate(scidata_dict.keys()):
-        print (idx, sds)
+def sinusoidal_projection():
+    srs = osr.SpatialReference()
+    srs.ImportFromProj4(MODIS_SINU_PROJ4)
+    return srs.ExportToWkt()
 
+
+class aod_accumulator(object):
+    """
+    Running max, sum and count of valid AOD, orbits (or daily composites) are folded in one by one,
+    so the (orbits, 1200, 1200) array is never held as float.
+    """
+    def __init__(self, shape):
+        self.max = np.full(shape, -np.inf, dtype=np.float32)
+        self.sum = np.zeros(shape, dtype=np.float64)
+        self.count = np.zeros(shape, dtype=np.uint16)
+
+    def add(self, aod_array, valid_mask):
+        np.maximum(self.max, aod_array, out=self.max, where=valid_mask)
+        self.sum += np.where(valid_mask, aod_array, 0)
+        self.count += valid_mask
+
+    def merge(self, other):
+        np.maximum(self.max, other.max, out=self.max)
+        self.sum += other.sum
+        self.count += other.count
+
+    def result(self, fill_value):
+        """
+        :return: (max, mean, count) with fill_value where no valid observation
+        """
+        no_data = self.count == 0
+        aod_max = np.where(no_data, fill_value, self.max).astype(np.float32)
+        aod_mean = np.where(no_data, fill_value, self.sum / np.maximum(self.count, 1)).astype(np.float32)
+        return aod_max, aod_mean, self.count
+
+
+def aod_read_accumulate(hdf_path, aod_key='Optical_Depth_055'):
+    """
+    Read the AOD layer of one granule orbit by orbit into an aod_accumulator.
+    :return: (accumulator, fill_value, scale_factor, geotransform from metadata or None)
+    """
+    hdf_scidata = SD(hdf_path, SDC.READ)
     aod_dataset = hdf_scidata.select(aod_key)
-    print(aod_dataset.attributes(), aod_dataset.info())
 
     attrs = aod_dataset.attributes(full=1)
     fill_value = attrs['_FillValue'][0]
     scale_factor = attrs['scale_factor'][0]
 
-    aod_data = aod_dataset.get()
+    dims = aod_dataset.info()[2]
+    num_orbits = dims[0] if len(dims) == 3 else 1
+    accumulator = aod_accumulator(dims[-2:])
+    for orbit in range(num_orbits):
+        orbit_data = aod_dataset[orbit] if len(dims) == 3 else aod_dataset.get()
+        accumulator.add(orbit_data, orbit_data != fill_value)
+    # for
+
+    geotransform = metadata_geotransform(hdf_scidata, dims[-1], dims[-2])
+    aod_dataset.endaccess()
+    hdf_scidata.end()
+
+    return accumulator, fill_value, scale_factor, geotransform
+
+
+def aod_read_mvc(hdf_path, aod_key = 'Optical_Depth_055'):
+    """
 
-    aod_data = aod_data.astype('float32')
-    aod_data[aod_data == fill_value] = np.nan
-    # aod_mvc = np.nanmean(aod_data, axis=0)
-    aod_mvc = np.nanmax(aod_data, axis=0)
-    aod_mvc[np.isnan(aod_mvc)] = fill_value
+    """
+    print("### Reading HDF image {}".format(hdf_path))
+
+    accumulator, fill_value, scale_factor, geotransform = aod_read_accumulate(hdf_path, aod_key)
+    aod_mvc = accumulator.result(fill_value)[0]
     aod_mean = aod_mvc.astype('int16')
 
     return aod_mean # shape (channel, xsize, ysize)
@@ -127,6 +230,132 @@ def copy_spatialref(img_path4, img_path2):
     return True
 
 
+def save_composite_image(accumulator, save_path, geotransform, fill_value, scale_factor):
+    """
+    Write (max, mean, count) bands of one composite, AOD kept in digital numbers with the scale in the band.
+    """
+    aod_max, aod_mean, aod_count = accumulator.result(fill_value)
+
+    file_driver = gdal.GetDriverByName('GTiff')
+    dst_ds = file_driver.Create(save_path, xsize=aod_max.shape[1], ysize=aod_max.shape[0], bands=3,
+                                eType=gdal.GDT_Float32, options=['TILED=YES', 'COMPRESS=DEFLATE'])
+    if not dst_ds:
+        raise Exception("Fail to create image {}".format(save_path))
+    dst_ds.SetProjection(sinusoidal_projection())
+    dst_ds.SetGeoTransform(geotransform)
+
+    for bb, (band_array, band_name) in enumerate(((aod_max, 'max'), (aod_mean, 'mean'), (aod_count, 'count'))):
+        dst_band = dst_ds.GetRasterBand(bb + 1)
+        dst_band.WriteArray(band_array)
+        dst_band.SetDescription(band_name)
+        if band_name != 'count':
+            dst_band.SetNoDataValue(float(fill_value))
+            dst_band.SetScale(float(scale_factor))
+    # for
+
+    dst_ds.FlushCache()
+    return True
+
+
+def _aod_granule_job(job):
+    """
+    Daily composite of one granule in a worker process, the accumulator is returned for period compositing.
+    """
+    hdf_path, save_path, aod_key = job
+    start_time = time.time()
+    date, h, v = parse_granule_name(hdf_path)
+
+    accumulator, fill_value, scale_factor, geotransform = aod_read_accumulate(hdf_path, aod_key)
+    if geotransform is None:
+        geotransform = sinusoidal_geotransform(h, v, accumulator.max.shape[1], accumulator.max.shape[0])
+    save_composite_image(accumulator, save_path, geotransform, fill_value, scale_factor)
+
+    return hdf_path, accumulator, fill_value, scale_factor, geotransform, time.time() - start_time
+
+
+def aod_batch_composite(hdf_paths, target_folder, period_days=8, start_date=None, end_date=None, workers=None,
+                        aod_key='Optical_Depth_055'):
+    """
+    Daily and period (max, mean, count) composites of MCD19A2 granules.
+    Granules are dispatched to a process pool, each writes its daily composite
+    MCD19A2.AYYYYDDD.hXXvYY.<aod_key>.tif and its accumulator is folded into the period composite
+    MCD19A2.AYYYYDDD_<days>D.hXXvYY.<aod_key>.tif, written as soon as all granules of the period are in.
+    Georeferencing comes from the granule metadata or the h/v index in the name.
+    :param hdf_paths: MCD19A2 granules
+    :param target_folder:
+    :param period_days: period length, periods start at Jan 1st of each year
+    :param start_date: datetime.date, None for no limit
+    :param end_date: datetime.date, None for no limit
+    :param workers: number of processes, default os.cpu_count()
+    :return: dict with counts and seconds of the run
+    """
+    if not os.path.exists(target_folder):
+        os.makedirs(target_folder)
+
+    # one granule for each tile and day, the latest production wins
+    granules = {}
+    for hdf_path in sorted(hdf_paths):
+        parsed = parse_granule_name(hdf_path)
+        if parsed is None:
+            print("### Skip unknown granule {}".format(hdf_path))
+            continue
+        date, h, v = parsed
+        if (start_date and date < start_date) or (end_date and date > end_date):
+            continue
+        granules[(h, v, date)] = hdf_path
+    # for
+
+    def period_key(h, v, date):
+        period_start = (date.timetuple().tm_yday - 1) // period_days * period_days + 1
+        return h, v, date.year, period_start
+
+    jobs, remaining = [], {}
+    for (h, v, date), hdf_path in sorted(granules.items(), key=lambda item: (item[0][2], item[0][:2])):
+        day_name = "MCD19A2.A{}{:03d}.h{:02d}v{:02d}.{}.tif".format(
+            date.year, date.timetuple().tm_yday, h, v, aod_key)
+        jobs.append((hdf_path, os.path.join(target_folder, day_name), aod_key))
+        remaining[period_key(h, v, date)] = remaining.get(period_key(h, v, date), 0) + 1
+    # for
+
+    start_time = time.time()
+    periods = {}
+    num_done, num_failed = 0, 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        future_jobs = {executor.submit(_aod_granule_job, job): job for job in jobs}
+        for future in concurrent.futures.as_completed(future_jobs):
+            hdf_path = future_jobs[future][0]
+            date, h, v = parse_granule_name(hdf_path)
+            key = period_key(h, v, date)
+            try:
+                hdf_path, accumulator, fill_value, scale_factor, geotransform, seconds = future.result()
+                num_done += 1
+                print("### [{}/{}] {} in {:.2f}s".format(num_done, len(jobs), os.path.basename(hdf_path), seconds))
+
+                if key not in periods:
+                    periods[key] = (accumulator, fill_value, scale_factor, geotransform)
+                else:
+                    periods[key][0].merge(accumulator)
+            except Exception as e:
+                print("### Error @ {}: {}".format(hdf_path, e))
+                num_failed += 1
+
+            remaining[key] -= 1
+            if remaining[key] == 0 and key in periods:
+                period_name = "MCD19A2.A{}{:03d}_{}D.h{:02d}v{:02d}.{}.tif".format(
+                    key[2], key[3], period_days, key[0], key[1], aod_key)
+                accumulator, fill_value, scale_factor, geotransform = periods.pop(key)
+                save_composite_image(accumulator, os.path.join(target_folder, period_name), geotransform,
+                                     fill_value, scale_factor)
+                print("### Period composite {}".format(period_name))
+        # for
+    # with
+    elapsed = max(time.time() - start_time, 1e-6)
+
+    print("### Batch over: {} done, {} failed in {:.1f}s ({:.2f} granules/s)".format(
+        num_done, num_failed, elapsed, num_done / elapsed))
+    return {'done': num_done, 'failed': num_failed, 'seconds': elapsed}
+
+
 def main():
     now = datetime.datetime.now()
     print("###########################################################")
@@ -138,16 +367,30 @@ def main():
     opts = parse_args()
     hdf_path = opts.src_hdf
     save_path = opts.target_raster
-    spatial_ref_path = ''
+
+    if opts.src_folder:
+        hdf_paths = [os.path.join(opts.src_folder, f) for f in os.listdir(opts.src_folder) if f.endswith('.hdf')]
+        start_date = datetime.datetime.strptime(opts.start_date, '%Y-%m-%d').date() if opts.start_date else None
+        end_date = datetime.datetime.strptime(opts.end_date, '%Y-%m-%d').date() if opts.end_date else None
+        aod_batch_composite(hdf_paths, opts.target_folder, opts.period_days, start_date, end_date, opts.workers)
+        print("### Task over #############################################")
+        return
 
     # for test
     # hdf_path = r'F:\application_dataset\CovidVegGreen\MCD19A2\2017\MCD19A2.A2017001.h27v05.006.2018114111739.hdf'
     # save_path = r'F:\application_dataset\CovidVegGreen\MCD19A2\2017\aod055\MCD19A2.A2017001_AOD055.mvc.tif'
-    spatial_ref_path = r'F:\application_dataset\CovidVegGreen\MCD19A2\2017\aod055\spatialref.tif'
 
     aod_mvc_array = aod_read_mvc(hdf_path)
     save_band_image(aod_mvc_array, save_path)
-    copy_spatialref(spatial_ref_path, save_path)
+
+    # georeference from the h/v index of the granule, no reference raster needed
+    parsed = parse_granule_name(hdf_path)
+    if parsed is not None:
+        save_ds = gdal.Open(save_path, gdal.GA_Update)
+        save_ds.SetProjection(sinusoidal_projection())
+        save_ds.SetGeoTransform(sinusoidal_geotransform(parsed[1], parsed[2], aod_mvc_array.shape[1],
+                                                        aod_mvc_array.shape[0]))
+        del save_ds
 
 
     print("### Task over #############################################")
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+
+"""
+Gridding of TROPOSIF L2B soundings to rasters (mean, count, std and quality-weighted mean)
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import re
+import time
+import datetime
+import argparse
+import numpy as np
+import xarray
+from osgeo import gdal, osr
+gdal.UseExceptions()
+
+
+# TROPOSIF_L2B_2018-05-01.nc
+l2b_date_pattern = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Gridding of TROPOSIF L2B soundings')
+    parser.add_argument('--src-folder', required=False, type=str, default="./data",
+                        help='folder of daily L2B netCDF files')
+    parser.add_argument('--target-folder', required=False, type=str, default="./data/grid",
+                        help='folder of daily and period rasters')
+    parser.add_argument('--bounds', required=False, type=str, default="-180,-90,180,90",
+                        help='grid bounds xmin,ymin,xmax,ymax in units of the grid crs')
+    parser.add_argument('--resolution', required=False, type=float, default=0.05,
+                        help='cell size in units of the grid crs')
+    parser.add_argument('--crs', required=False, type=str, default="EPSG:4326",
+                        help='crs of the grid, e.g. EPSG:4326 or EPSG:3857')
+    parser.add_argument('--variable', required=False, type=str, default="SIF_743",
+                        help='variable to grid')
+    parser.add_argument('--error-variable', required=False, type=str, default="SIF_ERROR_743",
+                        help='error of the variable, weights 1/error^2 of the weighted mean')
+    parser.add_argument('--max-cloud-fraction', required=False, type=float, default=None,
+                        help='skip soundings with cloud_fraction_L2 above this')
+    parser.add_argument('--period-days', required=False, type=int, default=8,
+                        help='length of composite periods in days, counted from Jan 1st')
+    parser.add_argument('--chunk-size', required=False, type=int, default=1000000,
+                        help='soundings read in one batch')
+    opts = parser.parse_args()
+    return opts
+
+
+class l2b_grid(object):
+    """
+    Regular grid in lat/lon or a projected crs, north-up.
+    """
+    def __init__(self, bounds=(-180, -90, 180, 90), resolution=0.05, crs='EPSG:4326'):
+        self.xmin, self.ymin, self.xmax, self.ymax = bounds
+        self.resolution = resolution
+        self.xsize = int(round((self.xmax - self.xmin) / resolution))
+        self.ysize = int(round((self.ymax - self.ymin) / resolution))
+
+        self.srs = osr.SpatialReference()
+        self.srs.SetFromUserInput(crs)
+        self.srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        self.transform = None
+        if not self.srs.IsGeographic():
+            lonlat_srs = osr.SpatialReference()
+            lonlat_srs.ImportFromEPSG(4326)
+            lonlat_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            self.transform = osr.CoordinateTransformation(lonlat_srs, self.srs)
+
+    @property
+    def num_cells(self):
+        return self.xsize * self.ysize
+
+    def geotransform(self):
+        return self.xmin, self.resolution, 0.0, self.ymax, 0.0, -self.resolution
+
+    def cell_index(self, lon, lat):
+        """
+        Flat cell index (row * xsize + col) of each sounding, -1 outside the grid.
+        """
+        if self.transform is None:
+            x, y = lon, lat
+        else:
+            points = np.array(self.transform.TransformPoints(np.column_stack((lon, lat))))
+            x, y = points[:, 0], points[:, 1]
+
+        col = np.floor((x - self.xmin) / self.resolution).astype(np.int64)
+        row = np.floor((self.ymax - y) / self.resolution).astype(np.int64)
+        inside = (col >= 0) & (col < self.xsize) & (row >= 0) & (row < self.ysize)
+        return np.where(inside, row * self.xsize + col, -1)
+
+
+class grid_accumulator(object):
+    """
+    Running sums of soundings, kept only for the cells touched so far (sorted flat cell index),
+    so memory and the cost of add() depend on the soundings, not on the grid.
+    """
+    fields = ('count', 'sum', 'sum_sq', 'weighted_sum', 'weight')
+
+    def __init__(self, num_cells):
+        self.num_cells = num_cells
+        self.cells = np.zeros(0, dtype=np.int64)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.sum = np.zeros(0, dtype=np.float64)
+        self.sum_sq = np.zeros(0, dtype=np.float64)
+        self.weighted_sum = np.zeros(0, dtype=np.float64)
+        self.weight = np.zeros(0, dtype=np.float64)
+
+    def _fold(self, cells, sums):
+        """
+        Add per-cell sums (dict of fields, aligned with cells) into the accumulator.
+        """
+        all_cells = np.concatenate((self.cells, cells))
+        self.cells, inverse = np.unique(all_cells, return_inverse=True)
+        for name in self.fields:
+            values = np.concatenate((getattr(self, name), sums[name]))
+            folded = np.bincount(inverse, weights=values, minlength=len(self.cells))
+            setattr(self, name, folded.astype(np.int64) if name == 'count' else folded)
+        # for
+
+    def add(self, cell_index, values, weights=None):
+        valid = (cell_index >= 0) & np.isfinite(values)
+        if weights is not None:
+            valid &= np.isfinite(weights)
+        cell_index, values = cell_index[valid], values[valid].astype(np.float64)
+
+        # reduce the chunk on its own cells first
+        cells, inverse = np.unique(cell_index, return_inverse=True)
+        sums = {'count': np.bincount(inverse, minlength=len(cells)),
+                'sum': np.bincount(inverse, weights=values, minlength=len(cells)),
+                'sum_sq': np.bincount(inverse, weights=values * values, minlength=len(cells)),
+                'weighted_sum': np.zeros(len(cells)), 'weight': np.zeros(len(cells))}
+        if weights is not None:
+            weights = weights[valid].astype(np.float64)
+            sums['weighted_sum'] = np.bincount(inverse, weights=values * weights, minlength=len(cells))
+            sums['weight'] = np.bincount(inverse, weights=weights, minlength=len(cells))
+        self._fold(cells, sums)
+
+    def merge(self, other):
+        self._fold(other.cells, {name: getattr(other, name) for name in self.fields})
+
+    def band(self, name):
+        """
+        One output band over the whole grid, float32, NaN for empty cells (0 for count).
+        :param name: 'mean', 'count', 'std' or 'wmean'
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if name == 'count':
+                values = self.count
+            elif name == 'mean':
+                values = self.sum / self.count
+            elif name == 'std':
+                mean = self.sum / self.count
+                values = np.sqrt(np.maximum(self.sum_sq / self.count - mean * mean, 0))
+            elif name == 'wmean':
+                values = self.weighted_sum / self.weight
+            else:
+                raise Exception("Band {} not supported, use one of [mean, count, std, wmean]".format(name))
+        # with
+        band_array = np.zeros(self.num_cells, dtype=np.float32) if name == 'count' \
+            else np.full(self.num_cells, np.nan, dtype=np.float32)
+        band_array[self.cells] = values
+        return band_array
+
+    def result(self):
+        """
+        :return: (mean, count, std, weighted mean) as float32, NaN for empty cells
+        """
+        return tuple(self.band(name) for name in ('mean', 'count', 'std', 'wmean'))
+
+
+def l2b_accumulate(l2b_path, grid, accumulator, variable='SIF_743', error_variable='SIF_ERROR_743',
+                   max_cloud_fraction=None, chunk_size=1000000):
+    """
+    Fold the soundings of one L2B file into the accumulator, chunk by chunk of the PRODUCT group.
+    Weights are 1/error^2 of error_variable, the weighted mean is left empty if it is missing.
+    :return: number of soundings read
+    """
+    l2b_ds = xarray.open_dataset(l2b_path, group='PRODUCT')
+    if error_variable not in l2b_ds.variables:
+        print("### Warning: variable {} not found in {}, no weighted mean".format(error_variable, l2b_path))
+        error_variable = None
+    if (max_cloud_fraction is not None) and ('cloud_fraction_L2' not in l2b_ds.variables):
+        print("### Warning: variable cloud_fraction_L2 not found in {}, no cloud filter".format(l2b_path))
+        max_cloud_fraction = None
+
+    sounding_dim = l2b_ds['longitude'].dims[0]
+    num_soundings = l2b_ds.sizes[sounding_dim]
+    for start in range(0, num_soundings, chunk_size):
+        chunk_ds = l2b_ds.isel({sounding_dim: slice(start, start + chunk_size)})
+        values = chunk_ds[variable].values
+        cell_index = grid.cell_index(chunk_ds['longitude'].values, chunk_ds['latitude'].values)
+        if max_cloud_fraction is not None:
+            cell_index[~(chunk_ds['cloud_fraction_L2'].values <= max_cloud_fraction)] = -1
+
+        weights = None
+        if error_variable is not None:
+            with np.errstate(divide='ignore'):
+                weights = 1.0 / np.square(chunk_ds[error_variable].values.astype(np.float64))
+            weights[~np.isfinite(weights)] = np.nan
+        accumulator.add(cell_index, values, weights)
+    # for
+
+    l2b_ds.close()
+    return num_soundings
+
+
+def save_grid_image(accumulator, grid, save_path):
+    """
+    Write (mean, count, std, weighted mean) bands of one composite.
+    """
+    file_driver = gdal.GetDriverByName('GTiff')
+    dst_ds = file_driver.Create(save_path, xsize=grid.xsize, ysize=grid.ysize, bands=4, eType=gdal.GDT_Float32,
+                                options=['TILED=YES', 'COMPRESS=DEFLATE'])
+    if not dst_ds:
+        raise Exception("Fail to create image {}".format(save_path))
+    dst_ds.SetProjection(grid.srs.ExportToWkt())
+    dst_ds.SetGeoTransform(grid.geotransform())
+
+    # one dense band in memory at a time
+    for bb, band_name in enumerate(('mean', 'count', 'std', 'wmean')):
+        dst_band = dst_ds.GetRasterBand(bb + 1)
+        dst_band.WriteArray(accumulator.band(band_name).reshape(grid.ysize, grid.xsize))
+        dst_band.SetDescription(band_name)
+        if band_name != 'count':
+            dst_band.SetNoDataValue(np.nan)
+    # for
+
+    dst_ds.FlushCache()
+    return True
+
+
+def l2b_gridding(l2b_paths, target_folder, grid, variable='SIF_743', error_variable='SIF_ERROR_743',
+                 max_cloud_fraction=None, period_days=8, chunk_size=1000000):
+    """
+    Daily and period rasters of L2B files, streamed file by file in date order.
+    At most one daily and one period accumulator are held, so memory only depends on the grid.
+    Writes <variable>_<YYYY-MM-DD>.tif for each file and <variable>_<YYYY-MM-DD>_<days>D.tif for each period.
+    :return: dict with counts and seconds of the run
+    """
+    if not os.path.exists(target_folder):
+        os.makedirs(target_folder)
+
+    dated_paths = []
+    for l2b_path in l2b_paths:
+        matched = l2b_date_pattern.search(os.path.basename(l2b_path))
+        if not matched:
+            print("### Skip file without date {}".format(l2b_path))
+            continue
+        dated_paths.append((datetime.date(*[int(g) for g in matched.groups()]), l2b_path))
+    # for
+    dated_paths.sort()
+
+    def period_start(date):
+        doy = (date.timetuple().tm_yday - 1) // period_days * period_days
+        return datetime.date(date.year, 1, 1) + datetime.timedelta(days=doy)
+
+    def save_period(start, accumulator):
+        period_name = "{}_{}_{}D.tif".format(variable, start.isoformat(), period_days)
+        save_grid_image(accumulator, grid, os.path.join(target_folder, period_name))
+        print("### Period composite {}".format(period_name))
+
+    start_time = time.time()
+    total_soundings = 0
+    current_period, period_accumulator = None, None
+    for date, l2b_path in dated_paths:
+        if period_start(date) != current_period:
+            if period_accumulator is not None:
+                save_period(current_period, period_accumulator)
+            current_period, period_accumulator = period_start(date), grid_accumulator(grid.num_cells)
+
+        file_time = time.time()
+        day_accumulator = grid_accumulator(grid.num_cells)
+        num_soundings = l2b_accumulate(l2b_path, grid, day_accumulator, variable, error_variable,
+                                       max_cloud_fraction, chunk_size)
+        save_grid_image(day_accumulator, grid, os.path.join(target_folder, "{}_{}.tif".format(variable, date)))
+        period_accumulator.merge(day_accumulator)
+        total_soundings += num_soundings
+        print("### {}: {} soundings in {:.1f}s".format(os.path.basename(l2b_path), num_soundings,
+                                                      time.time() - file_time))
+    # for
+    if period_accumulator is not None:
+        save_period(current_period, period_accumulator)
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    print("### Gridding over: {} files, {:.0f} soundings/s".format(len(dated_paths), total_soundings / elapsed))
+    return {'files': len(dated_paths), 'soundings': total_soundings, 'seconds': elapsed}
+
+
+def main():
+    now = datetime.datetime.now()
+    print("###########################################################")
+    print("### TROPOSIF L2B gridding #################################")
+    print("### ", now)
+    print("###########################################################")
+
+    opts = parse_args()
+    bounds = [float(b) for b in opts.bounds.split(',')]
+    grid = l2b_grid(bounds, opts.resolution, opts.crs)
+
+    l2b_paths = [os.path.join(opts.src_folder, f) for f in sorted(os.listdir(opts.src_folder)) if f.endswith('.nc')]
+    l2b_gridding(l2b_paths, opts.target_folder, grid, opts.variable, opts.error_variable, opts.max_cloud_fraction,
+                 opts.period_days, opts.chunk_size)
+
+    print("### Task over #############################################")
+
+
+if __name__ == "__main__":
+    main()
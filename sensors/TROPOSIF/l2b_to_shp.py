@@ -1,38 +1,181 @@
 # -*- coding: utf-8 -*-
 
 """
-***
+Export TROPOSIF L2B soundings to point features (GeoParquet, GeoPackage or Shapefile)
 
 Author: Zhou Ya'nan
 Date: 2021-09-16
 """
 import os
+import time
+import datetime
+import argparse
+import concurrent.futures
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 import xarray
 
 
-def l2b_shapefile(l2b_path, shape_path):
+DEFAULT_VARIABLES = ['SIF_743', 'SIF_735', 'SIF_ERROR_743', 'cloud_fraction_L2', 'quality_flag']
+
+# format -> (suffix of the target, ogr driver)
+export_formats = {'parquet': ('.parquet', None), 'gpkg': ('.gpkg', 'GPKG'), 'shp': ('.shp', 'ESRI Shapefile')}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export TROPOSIF L2B soundings to point features')
+    parser.add_argument('--src-path', required=False, type=str, default="./data",
+                        help='L2B netCDF file, or folder of daily files')
+    parser.add_argument('--target-folder', required=False, type=str, default="./data",
+                        help='folder of exported features')
+    parser.add_argument('--format', required=False, type=str, default="parquet",
+                        help='export format in [parquet, gpkg, shp]')
+    parser.add_argument('--variables', required=False, type=str, default=",".join(DEFAULT_VARIABLES),
+                        help='comma separated variables of the PRODUCT group')
+    parser.add_argument('--chunk-size', required=False, type=int, default=500000,
+                        help='soundings read and written in one batch')
+    parser.add_argument('--workers', required=False, type=int, default=os.cpu_count(),
+                        help='number of processes for multiple files')
+    opts = parser.parse_args()
+    return opts
+
+
+def l2b_export(l2b_path, target_path, variables=DEFAULT_VARIABLES, format='parquet', chunk_size=500000,
+               column_names=None):
+    """
+    Export the soundings of one L2B file batch by batch, memory is bounded by chunk_size.
+    parquet writes one GeoParquet part file for each batch into the folder target_path,
+    gpkg and shp append each batch to a single layer.
+    :param l2b_path: TROPOSIF L2B netCDF
+    :param target_path:
+    :param variables: variables of the PRODUCT group, missing ones are skipped with a warning
+    :param format: in export_formats
+    :param chunk_size: soundings in one batch
+    :param column_names: dict of output column names for variables, default the variable names
+    :return: number of exported soundings
+    """
+    if format not in export_formats:
+        raise Exception("Format {} not supported, use one of {}".format(format, list(export_formats.keys())))
 
+    column_names = column_names or {}
     l2b_ds = xarray.open_dataset(l2b_path, group='PRODUCT')
 
-    data = l2b_ds['SIF_743'].values
-    lon = l2b_ds['longitude'].values
-    lat = l2b_ds['latitude'].values
+    selected = []
+    for var in variables:
+        if var in l2b_ds.variables:
+            selected.append(var)
+        else:
+            print("### Warning: variable {} not found in {}, skipped".format(var, os.path.basename(l2b_path)))
+    # for
 
-    dat = pd.DataFrame({'lon': lon, 'lat': lat, 'sif743': data})
-    geom = gpd.points_from_xy(dat['lon'], dat['lat'], crs=4326)
-    geo_dat = gpd.GeoDataFrame(data=dat[['sif743']], geometry=geom)
-    # geo_dat.plot(column='sif743', legend=True, markersize=1)
+    sounding_dim = l2b_ds['longitude'].dims[0]
+    num_soundings = l2b_ds.sizes[sounding_dim]
+    if format == 'parquet':
+        if not os.path.exists(target_path):
+            os.makedirs(target_path)
+        # part files of an earlier export would be read as part of this one
+        for file in os.listdir(target_path):
+            if file.startswith('part-') and file.endswith('.parquet'):
+                os.remove(os.path.join(target_path, file))
+        # for
+
+    for part, start in enumerate(range(0, num_soundings, chunk_size)):
+        chunk_ds = l2b_ds.isel({sounding_dim: slice(start, start + chunk_size)})
+        dat = pd.DataFrame({column_names.get(var, var): chunk_ds[var].values for var in selected})
+        geom = gpd.points_from_xy(chunk_ds['longitude'].values, chunk_ds['latitude'].values, crs=4326)
+        geo_dat = gpd.GeoDataFrame(data=dat, geometry=geom)
+
+        if format == 'parquet':
+            geo_dat.to_parquet(os.path.join(target_path, "part-{:05d}.parquet".format(part)), index=False)
+        else:
+            geo_dat.to_file(target_path, driver=export_formats[format][1], encoding='utf-8',
+                            mode='w' if part == 0 else 'a')
+    # for
 
-    geo_dat.to_file(shape_path, driver='ESRI Shapefile', encoding='utf-8')
     l2b_ds.close()
+    return num_soundings
+
+
+def l2b_shapefile(l2b_path, shape_path):
+    """
+    SIF_743 soundings of one file as ESRI Shapefile, in the attribute sif743 as before.
+    """
+    l2b_export(l2b_path, shape_path, variables=['SIF_743'], format='shp', column_names={'SIF_743': 'sif743'})
     return shape_path
 
 
-l2b_path = r'D:\TROPOSIF_L2B_2018-05-01.nc'
-shape_path = r'D:\TROPOSIF_L2B_2018-05-01.nc.shp'
+def _l2b_export_job(job):
+    """
+    Export one file in a worker process, return (l2b_path, soundings, seconds).
+    """
+    l2b_path, target_path, variables, format, chunk_size = job
+    start_time = time.time()
+    num_soundings = l2b_export(l2b_path, target_path, variables, format, chunk_size)
+    return l2b_path, num_soundings, time.time() - start_time
+
+
+def batch_l2b_export(l2b_paths, target_folder, variables=DEFAULT_VARIABLES, format='parquet', chunk_size=500000,
+                     workers=None):
+    """
+    Export many daily files in a process pool, each to <target_folder>/<file name><suffix of format>.
+    """
+    if not os.path.exists(target_folder):
+        os.makedirs(target_folder)
+
+    jobs = []
+    for l2b_path in l2b_paths:
+        target_path = os.path.join(target_folder, os.path.basename(l2b_path) + export_formats[format][0])
+        jobs.append((l2b_path, target_path, variables, format, chunk_size))
+    # for
+
+    start_time = time.time()
+    num_done, num_failed, total_soundings = 0, 0, 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        future_jobs = {executor.submit(_l2b_export_job, job): job for job in jobs}
+        for future in concurrent.futures.as_completed(future_jobs):
+            try:
+                l2b_path, num_soundings, seconds = future.result()
+            except Exception as e:
+                print("### Error @ {}: {}".format(future_jobs[future][0], e))
+                num_failed += 1
+                continue
+            num_done += 1
+            total_soundings += num_soundings
+            print("### [{}/{}] {}: {} soundings in {:.1f}s".format(
+                num_done, len(jobs), os.path.basename(l2b_path), num_soundings, seconds))
+        # for
+    # with
+    elapsed = max(time.time() - start_time, 1e-6)
+
+    print("### Export over: {} done, {} failed, {:.0f} soundings/s".format(num_done, num_failed,
+                                                                         total_soundings / elapsed))
+    return {'done': num_done, 'failed': num_failed, 'soundings': total_soundings, 'seconds': elapsed}
+
+
+def main():
+    now = datetime.datetime.now()
+    print("###########################################################")
+    print("### TROPOSIF L2B export ###################################")
+    print("### ", now)
+    print("###########################################################")
+
+    opts = parse_args()
+    variables = [var.strip() for var in opts.variables.split(',') if var.strip()]
+
+    src_path = opts.src_path
+    if os.path.isdir(src_path):
+        l2b_paths = [os.path.join(src_path, f) for f in sorted(os.listdir(src_path)) if f.endswith('.nc')]
+    else:
+        l2b_paths = [src_path]
+
+    # l2b_path = r'D:\TROPOSIF_L2B_2018-05-01.nc'
+    # shape_path = r'D:\TROPOSIF_L2B_2018-05-01.nc.shp'
+
+    batch_l2b_export(l2b_paths, opts.target_folder, variables, opts.format, opts.chunk_size, opts.workers)
+
+    print("### Task over #############################################")
 
 
-l2b_shapefile(l2b_path, shape_path)
+if __name__ == "__main__":
+    main()
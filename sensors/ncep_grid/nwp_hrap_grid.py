@@ -7,12 +7,19 @@ Author: Zhou Ya'nan
 Date: 2021-09-16
 """
 import os
+import sys
+import time
+import fnmatch
 import datetime
 import argparse
 import math
 import numpy as np
+from matplotlib.path import Path
 from osgeo import gdal, osr
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'raster'))
+from batch_runner import is_up_to_date, run_batch
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='***')
@@ -22,51 +29,316 @@ def parse_args():
     #                     help='target file for writing results')
     # parser.add_argument('--georef-file', required=False, type=str, default="./data/data.tif",
     #                     help='spatial reference for results')
+    parser.add_argument('--src-folder', required=False, type=str, default=None,
+                        help='archive folder of Stage IV GRIB files, searched recursively')
+    parser.add_argument('--target-folder', required=False, type=str, default="./data",
+                        help='folder of converted GeoTIFFs, sub-folders of the archive are kept')
+    parser.add_argument('--pattern', required=False, type=str, default="*",
+                        help='file name pattern of GRIB files, e.g. "ST4.*.24h*"')
+    parser.add_argument('--cog', action='store_true',
+                        help='write Cloud Optimized GeoTIFFs instead of tiled GeoTIFFs')
+    parser.add_argument('--workers', required=False, type=int, default=os.cpu_count(),
+                        help='number of processes')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='convert files which are already converted')
     opts = parser.parse_args()
     return opts
 
 
-def lonlat2hrap(lon, lat):
-    def deg2rad(deg):
-        return deg * (math.pi / 180)
+# HRAP polar stereographic: standard latitude 60N, central meridian 105W, earth radius 6371.2 km,
+# 4.7625 km cells at 60N with the north pole at HRAP (401, 1601)
+HRAP_STLAT = 60.0
+HRAP_CLON = 15.0
+HRAP_RADIUS = 6371.2
+HRAP_MESH = 4.7625
+HRAP_POLE = (401.0, 1601.0)
+
+# NCEP Stage IV CONUS grid, 1121 x 881 cells, lower left corner at HRAP (1, 1)
+# (first grid point 23.117N 119.023W is the centre of cell (1.5, 1.5))
+STAGE4_XSIZE = 1121
+STAGE4_YSIZE = 881
+STAGE4_HRAP_ORIGIN = (1.0, 1.0)
+
+HRAP_PROJ4 = '+proj=stere +lat_0=90 +lat_ts=60 +lon_0=-105 +x_0=0 +y_0=0 +a=6371200 +b=6371200 +units=m +no_defs'
 
-    stlat = 60.0
-    clon = 15.0
-    rad = 6371.2
+# files of a GRIB archive which are never converted
+NON_GRIB_SUFFIXES = ('.tif', '.tiff', '.idx', '.xml', '.aux', '.txt', '.md5')
+
+
+def lonlat2hrap(lon, lat):
+    """
+    HRAP coordinates of lon/lat in degrees, scalars or np.array of any shape.
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
 
-    sfactor = (1+math.sin(deg2rad(stlat))) / (1+math.sin(deg2rad(lat)))
-    R = rad * math.cos(deg2rad(lat)) * sfactor
-    x = R * math.cos(deg2rad(lon+clon))
-    y = R * math.sin(deg2rad(lon+clon))
+    sfactor = (1 + np.sin(np.deg2rad(HRAP_STLAT))) / (1 + np.sin(np.deg2rad(lat)))
+    R = HRAP_RADIUS * np.cos(np.deg2rad(lat)) * sfactor
+    x = R * np.cos(np.deg2rad(lon + HRAP_CLON))
+    y = R * np.sin(np.deg2rad(lon + HRAP_CLON))
 
-    hrapx = x / 4.7625 + 401
-    hrapy = y / 4.7625 + 1601
+    hrapx = x / HRAP_MESH + HRAP_POLE[0]
+    hrapy = y / HRAP_MESH + HRAP_POLE[1]
 
     return [hrapx, hrapy]
 
 
-def transform_grib_tiff(src_grib, target_tiff):
+def hrap2lonlat(hrapx, hrapy):
+    """
+    Inverse of lonlat2hrap, lon in [-180, 180), scalars or np.array of any shape.
+    """
+    x = (np.asarray(hrapx, dtype=np.float64) - HRAP_POLE[0]) * HRAP_MESH
+    y = (np.asarray(hrapy, dtype=np.float64) - HRAP_POLE[1]) * HRAP_MESH
+
+    R = np.hypot(x, y)
+    lat = 90.0 - 2 * np.rad2deg(np.arctan(R / (HRAP_RADIUS * (1 + np.sin(np.deg2rad(HRAP_STLAT))))))
+    lon = np.rad2deg(np.arctan2(y, x)) - HRAP_CLON
+    lon = np.mod(lon + 180.0, 360.0) - 180.0
+
+    return [lon, lat]
+
+
+class hrap_grid_index(object):
+    """
+    Map points and polygons to cells of an HRAP grid (Stage IV by default) in bulk.
+
+    Cells are addressed by flat index row * xsize + col into the array as gdal reads it;
+    north_up=True for north-up arrays (first row is the northernmost, as gdal delivers GRIB),
+    False for arrays in GRIB scan order (first row is the southernmost).
+    -1 marks points outside the grid and is skipped by sample() and zonal_mean().
+    """
+    def __init__(self, xsize=STAGE4_XSIZE, ysize=STAGE4_YSIZE, hrap_origin=STAGE4_HRAP_ORIGIN, north_up=True):
+        self.xsize = xsize
+        self.ysize = ysize
+        self.hrap_origin = hrap_origin
+        self.north_up = north_up
+
+    def lonlat2cell(self, lon, lat):
+        """
+        :return: (row, col, inside) np.arrays in the shape of lon/lat
+        """
+        hrapx, hrapy = lonlat2hrap(lon, lat)
+        col = np.floor(hrapx - self.hrap_origin[0]).astype(np.int64)
+        row = np.floor(hrapy - self.hrap_origin[1]).astype(np.int64)
+        inside = (col >= 0) & (col < self.xsize) & (row >= 0) & (row < self.ysize)
+        if self.north_up:
+            row = self.ysize - 1 - row
+        return row, col, inside
+
+    def cell_centers(self):
+        """
+        lon/lat of all cell centres, np.arrays (ysize, xsize).
+        """
+        cols, rows = np.meshgrid(np.arange(self.xsize), np.arange(self.ysize))
+        if self.north_up:
+            rows = self.ysize - 1 - rows
+        return hrap2lonlat(cols + self.hrap_origin[0] + 0.5, rows + self.hrap_origin[1] + 0.5)
+
+    def point_index(self, lon, lat):
+        """
+        Flat cell index of each point, -1 outside the grid.
+        """
+        row, col, inside = self.lonlat2cell(lon, lat)
+        return np.where(inside, row * self.xsize + col, -1)
+
+    def polygon_index(self, polygons):
+        """
+        Cells whose centre falls inside each polygon, tested in HRAP coordinates within the polygon bounds.
+        :param polygons: sequence of np.array (vertices, 2) of lon/lat
+        :return: (cell_index, indptr) in CSR layout, cells of polygon i are cell_index[indptr[i]:indptr[i+1]]
+        """
+        cell_lists = []
+        for polygon in polygons:
+            polygon = np.asarray(polygon, dtype=np.float64)
+            hrapx, hrapy = lonlat2hrap(polygon[:, 0], polygon[:, 1])
+            vertices = np.column_stack((hrapx - self.hrap_origin[0], hrapy - self.hrap_origin[1]))
+
+            col0 = max(0, int(np.floor(vertices[:, 0].min())))
+            col1 = min(self.xsize, int(np.ceil(vertices[:, 0].max())) + 1)
+            row0 = max(0, int(np.floor(vertices[:, 1].min())))
+            row1 = min(self.ysize, int(np.ceil(vertices[:, 1].max())) + 1)
+            if col0 >= col1 or row0 >= row1:
+                cell_lists.append(np.zeros(0, dtype=np.int64))
+                continue
+
+            cols, rows = np.meshgrid(np.arange(col0, col1), np.arange(row0, row1))
+            centers = np.column_stack((cols.ravel() + 0.5, rows.ravel() + 0.5))
+            inside = Path(vertices).contains_points(centers)
+            rows, cols = rows.ravel()[inside], cols.ravel()[inside]
+            if self.north_up:
+                rows = self.ysize - 1 - rows
+            cell_lists.append(rows * self.xsize + cols)
+        # for
+
+        indptr = np.zeros(len(cell_lists) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(cells) for cells in cell_lists])
+        cell_index = np.concatenate(cell_lists) if cell_lists else np.zeros(0, dtype=np.int64)
+        return cell_index, indptr
+
+    def sample(self, grid_array, cell_index, fill_value=np.nan):
+        """
+        Values at flat cell indices, for (ysize, xsize) or (bands, ysize, xsize) arrays.
+        """
+        flat_array = grid_array.reshape(grid_array.shape[:-2] + (-1,))
+        values = flat_array[..., np.maximum(cell_index, 0)].astype(np.float64)
+        values[..., cell_index < 0] = fill_value
+        return values
+
+    def zonal_mean(self, grid_array, cell_index, indptr, nodata=None):
+        """
+        Mean of the cells of each polygon of polygon_index(), NaN for polygons without valid cells.
+        """
+        values = self.sample(grid_array, cell_index)
+        valid = ~np.isnan(values)
+        if nodata is not None:
+            valid &= values != nodata
+        polygon_id = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+        sums = np.bincount(polygon_id[valid], weights=values[valid], minlength=len(indptr) - 1)
+        counts = np.bincount(polygon_id[valid], minlength=len(indptr) - 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts
+
+    def save(self, save_path, **index_arrays):
+        """
+        Precomputed index arrays (e.g. point_index=..., cell_index=..., indptr=...) with the grid definition, in .npz.
+        """
+        np.savez(save_path, grid=np.array([self.xsize, self.ysize, self.hrap_origin[0], self.hrap_origin[1],
+                                           self.north_up], dtype=np.float64), **index_arrays)
+
+    @staticmethod
+    def load(load_path):
+        """
+        :return: (hrap_grid_index, dict of index arrays) saved by save()
+        """
+        with np.load(load_path) as npz_file:
+            grid = npz_file['grid']
+            index_arrays = {key: npz_file[key] for key in npz_file.files if key != 'grid'}
+        grid_index = hrap_grid_index(int(grid[0]), int(grid[1]), (grid[2], grid[3]), bool(grid[4]))
+        return grid_index, index_arrays
+
+
+def stage4_bounds(hrap_origin=STAGE4_HRAP_ORIGIN, xsize=STAGE4_XSIZE, ysize=STAGE4_YSIZE):
+    """
+    Bounds [ulx, uly, lrx, lry] of the HRAP grid in metres of HRAP_PROJ4.
+    """
+    mesh = HRAP_MESH * 1000
+    ulx = (hrap_origin[0] - HRAP_POLE[0]) * mesh
+    lry = (hrap_origin[1] - HRAP_POLE[1]) * mesh
+    return [ulx, lry + ysize * mesh, ulx + xsize * mesh, lry]
+
+
+def grib_open_path(src_grib):
+    """
+    gdal path of a GRIB file, gzip compressed files are read through /vsigzip/.
+    """
+    if src_grib.endswith('.gz'):
+        return '/vsigzip/' + src_grib
+    return src_grib
+
+
+def transform_grib_tiff(src_grib, target_tiff, cog=False, compress='DEFLATE'):
     """
     Transform [NCEP/EMC U.S. Stage IV imagery [NCAR/EOL]] to Tiff image.
-    :param src_grib:
+    Output is compressed and internally tiled (or a COG), with the HRAP polar stereographic CRS
+    assigned explicitly and the Stage IV bounds for 1121 x 881 grids, as GRIB1 files carry
+    no usable spatial reference for gdal.
+    :param src_grib: GRIB1/GRIB2 file, optionally .gz
     :param target_tiff:
+    :param cog: write a Cloud Optimized GeoTIFF
+    :param compress: compression of the GeoTIFF
     :return:
     """
     # Open grib dataset
-    grid_ds = gdal.Open(src_grib)
+    grid_ds = gdal.Open(grib_open_path(src_grib))
     if grid_ds is None:
         print("Wrong: to open dataset")
         return False
     # here can print info about grib data
 
-    # Create driver for tiff
-    tiff_driver = gdal.GetDriverByName('GTiff')
-    tiff_ds = tiff_driver.CreateCopy(target_tiff, grid_ds, 0)
+    # floating point predictor for precipitation, horizontal differencing for integer data
+    data_type = grid_ds.GetRasterBand(1).DataType
+    predictor = '3' if data_type in (gdal.GDT_Float32, gdal.GDT_Float64) else '2'
+    creation_options = ['COMPRESS={}'.format(compress), 'PREDICTOR={}'.format(predictor)]
+    if not cog:
+        creation_options += ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256']
+
+    output_bounds = None
+    if (grid_ds.RasterXSize, grid_ds.RasterYSize) == (STAGE4_XSIZE, STAGE4_YSIZE):
+        output_bounds = stage4_bounds()
+
+    # write to a temporary file first, so that an interrupted run leaves no complete-looking target
+    temp_tiff = target_tiff + '.part'
+    try:
+        tiff_ds = gdal.Translate(temp_tiff, grid_ds, format='COG' if cog else 'GTiff',
+                                 creationOptions=creation_options, outputSRS=HRAP_PROJ4, outputBounds=output_bounds)
+        if tiff_ds is None:
+            print("Wrong: to translate {}".format(src_grib))
+            return False
 
-    # Properly close dataset to flush to disk
-    tiff_ds = None
-    grid_ds = None
+        # Properly close dataset to flush to disk
+        tiff_ds = None
+        os.replace(temp_tiff, target_tiff)
+    finally:
+        grid_ds = None
+        # a failed translation (None or exception) must not leave the partial file behind
+        if os.path.exists(temp_tiff):
+            os.remove(temp_tiff)
+    # try
     print("### [transform_grib_tiff] over!")
+    return True
+
+
+def find_grib_files(src_folder, pattern="*"):
+    """
+    GRIB files under the folder (recursively) matching the file name pattern.
+    """
+    grib_files = []
+    for root, dirs, files in os.walk(src_folder):
+        for file in sorted(files):
+            if file.lower().endswith(NON_GRIB_SUFFIXES) or not fnmatch.fnmatch(file, pattern):
+                continue
+            grib_files.append(os.path.join(root, file))
+        # for
+    # for
+    return sorted(grib_files)
+
+
+def _grib_tiff_job(job):
+    """
+    Convert one file in a worker process, return (src_grib, size in bytes, seconds).
+    """
+    src_grib, target_tiff, cog = job
+    start_time = time.time()
+    if not transform_grib_tiff(src_grib, target_tiff, cog):
+        raise Exception("Fail to convert {}".format(src_grib))
+    return src_grib, os.path.getsize(src_grib), time.time() - start_time
+
+
+def batch_grib_tiff(src_folder, target_folder, pattern="*", cog=False, workers=None, overwrite=False):
+    """
+    Convert a Stage IV archive (hourly/6h/24h, GRIB1 and GRIB2) to GeoTIFFs in a process pool.
+    Targets are <target_folder>/<relative path of the source>.tif, files already converted are skipped.
+    :return: dict with counts, bytes and seconds of the run
+    """
+    jobs = []
+    num_skipped = 0
+    for src_grib in find_grib_files(src_folder, pattern):
+        relative_path = os.path.relpath(src_grib, src_folder)
+        if relative_path.endswith('.gz'):
+            relative_path = relative_path[:-3]
+        target_tiff = os.path.join(target_folder, relative_path + '.tif')
+
+        if (not overwrite) and is_up_to_date(src_grib, target_tiff):
+            num_skipped += 1
+            continue
+        if not os.path.exists(os.path.dirname(target_tiff)):
+            os.makedirs(os.path.dirname(target_tiff))
+        jobs.append((src_grib, target_tiff, cog))
+    # for
+    print("### {} files to convert, {} already converted".format(len(jobs), num_skipped))
+
+    return run_batch(_grib_tiff_job, jobs, num_skipped, workers)
 
 
 def main():
@@ -78,6 +350,10 @@ def main():
 
     # console parameters
     opts = parse_args()
+    if opts.src_folder:
+        batch_grib_tiff(opts.src_folder, opts.target_folder, opts.pattern, opts.cog, opts.workers, opts.overwrite)
+        print("### Task over #############################################")
+        return
 
     # test parameters
     grib_file = "G:/FF/application_dataset/AmericanWatershed/Precipitation NCEPEMC 4KM Gridded Data (GRIB) Stage IV Data/ST4.2015030112.24h"
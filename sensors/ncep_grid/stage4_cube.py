@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time cube (time x y x) of NCEP Stage IV precipitation in HDF5
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import re
+import time
+import datetime
+import argparse
+import numpy as np
+import pandas as pd
+import h5py
+from osgeo import gdal, osr
+gdal.UseExceptions()
+
+from nwp_hrap_grid import (grib_open_path, find_grib_files, stage4_bounds, hrap_grid_index, HRAP_PROJ4,
+                           STAGE4_XSIZE, STAGE4_YSIZE)
+
+
+# ST4.2015030112.24h, st4_conus.2021020112.24h.grb2
+grib_time_pattern = re.compile(r'(\d{10})')
+grib_period_pattern = re.compile(r'\.(\d+h)')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Stage IV precipitation time cube')
+    parser.add_argument('--src-folder', required=False, type=str, default=None,
+                        help='archive folder of Stage IV GRIB files to append to the cube')
+    parser.add_argument('--cube-file', required=False, type=str, default="./data/st4_01h.h5",
+                        help='HDF5 cube file, created if not existing')
+    parser.add_argument('--pattern', required=False, type=str, default="ST4.*.01h*",
+                        help='file name pattern of GRIB files, one accumulation period for each cube')
+    parser.add_argument('--time-chunk', required=False, type=int, default=168,
+                        help='time steps in one chunk (and in one write), e.g. 168 hours')
+    parser.add_argument('--watershed-csv', required=False, type=str, default=None,
+                        help='CSV of lon,lat polygon vertices, its mean rainfall history is extracted')
+    parser.add_argument('--target-csv', required=False, type=str, default="./data/watershed_rainfall.csv",
+                        help='CSV of the extracted rainfall history')
+    opts = parser.parse_args()
+    return opts
+
+
+def parse_grib_time(grib_path):
+    """
+    Valid time of a Stage IV file from YYYYMMDDHH in its name, None if not found.
+    """
+    matched = grib_time_pattern.search(os.path.basename(grib_path))
+    if not matched:
+        return None
+    return datetime.datetime.strptime(matched.group(1), '%Y%m%d%H')
+
+
+def create_cube(cube_path, xsize=STAGE4_XSIZE, ysize=STAGE4_YSIZE, time_chunk=168, spatial_chunk=16,
+                period=''):
+    """
+    Empty cube, resizable along time.
+    Chunks hold a long run of time steps for a small block of cells, so the history of one pixel
+    (or of a watershed) is a few contiguous chunk reads.
+    :param time_chunk: time steps in one chunk
+    :param spatial_chunk: edge of one chunk in cells
+    :param period: accumulation period of the cube, e.g. '01h'
+    """
+    with h5py.File(cube_path, 'w') as cube_file:
+        cube_file.create_dataset('precip', shape=(0, ysize, xsize), maxshape=(None, ysize, xsize),
+                                 dtype=np.float32, chunks=(time_chunk, spatial_chunk, spatial_chunk),
+                                 compression='gzip', compression_opts=4, shuffle=True, fillvalue=np.nan)
+        # hours since 1970-01-01
+        cube_file.create_dataset('time', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(4096,))
+
+        cube_file.attrs['crs'] = HRAP_PROJ4
+        ulx, uly, lrx, lry = stage4_bounds(xsize=xsize, ysize=ysize)
+        cube_file.attrs['geotransform'] = [ulx, (lrx - ulx) / xsize, 0.0, uly, 0.0, (lry - uly) / ysize]
+        cube_file.attrs['period'] = period
+        cube_file.attrs['units'] = 'kg m-2'
+    # with
+
+
+def datetime2hours(valid_time):
+    return int((valid_time - datetime.datetime(1970, 1, 1)).total_seconds() // 3600)
+
+
+def hours2datetime(hours):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(hours=int(hours))
+
+
+def read_cube_times(cube_path):
+    """
+    Valid times of the cube as np.array of datetime64[h].
+    """
+    with h5py.File(cube_path, 'r') as cube_file:
+        hours = cube_file['time'][:]
+    return hours.astype('datetime64[h]')
+
+
+def read_grib_precip(grib_path):
+    """
+    Precipitation of one GRIB file, north-up as gdal reads it, NaN for nodata.
+    """
+    grib_ds = gdal.Open(grib_open_path(grib_path), gdal.GA_ReadOnly)
+    grib_band = grib_ds.GetRasterBand(1)
+    precip_array = grib_band.ReadAsArray().astype(np.float32)
+    nodata = grib_band.GetNoDataValue()
+    if nodata is not None:
+        precip_array[precip_array == nodata] = np.nan
+    del grib_ds
+    return precip_array
+
+
+def append_cube(cube_path, grib_files, time_chunk=None):
+    """
+    Append GRIB files newer than the last time step of the cube, in time order.
+    Frames are buffered and written time_chunk at a time, so each write fills whole chunks
+    instead of rewriting every chunk of the grid for each hour.
+    :param cube_path: cube from create_cube()
+    :param grib_files: files of the accumulation period of the cube
+    :param time_chunk: frames in one write, default the time chunk of the cube
+    :return: number of appended time steps
+    """
+    timed_files = []
+    for grib_path in grib_files:
+        valid_time = parse_grib_time(grib_path)
+        if valid_time is None:
+            print("### Skip file without time {}".format(grib_path))
+            continue
+        timed_files.append((datetime2hours(valid_time), grib_path))
+    # for
+    timed_files.sort()
+
+    with h5py.File(cube_path, 'a') as cube_file:
+        precip_ds, time_ds = cube_file['precip'], cube_file['time']
+        if time_chunk is None:
+            time_chunk = precip_ds.chunks[0]
+        last_hour = time_ds[-1] if time_ds.shape[0] > 0 else None
+
+        buffer = np.full((time_chunk,) + precip_ds.shape[1:], np.nan, dtype=np.float32)
+        buffer_hours = []
+
+        def flush():
+            num_steps = len(buffer_hours)
+            if num_steps == 0:
+                return
+            tt = precip_ds.shape[0]
+            precip_ds.resize(tt + num_steps, axis=0)
+            time_ds.resize(tt + num_steps, axis=0)
+            precip_ds[tt:tt + num_steps] = buffer[:num_steps]
+            time_ds[tt:tt + num_steps] = buffer_hours
+            del buffer_hours[:]
+
+        start_time = time.time()
+        num_appended = 0
+        for hour, grib_path in timed_files:
+            if (last_hour is not None) and (hour <= last_hour):
+                continue
+            try:
+                precip_array = read_grib_precip(grib_path)
+            except Exception as e:
+                print("### Error @ {}: {}".format(grib_path, e))
+                continue
+            if precip_array.shape != precip_ds.shape[1:]:
+                print("### Skip {} of shape {}".format(grib_path, precip_array.shape))
+                continue
+
+            buffer[len(buffer_hours)] = precip_array
+            buffer_hours.append(hour)
+            last_hour = hour
+            num_appended += 1
+            if len(buffer_hours) == time_chunk:
+                flush()
+                print("### Appended {} steps, up to {}".format(num_appended, hours2datetime(hour)))
+        # for
+        flush()
+    # with
+
+    seconds = max(time.time() - start_time, 1e-6)
+    print("### {} steps appended in {:.1f}s ({:.1f} files/s)".format(num_appended, seconds, num_appended / seconds))
+    return num_appended
+
+
+def extract_cells(cube_path, cell_index, start_time=None, end_time=None):
+    """
+    Time series of grid cells, read as one slab over the bounding box of the cells.
+    :param cell_index: flat cell indices (row * xsize + col, north-up) from hrap_grid_index, -1 is skipped
+    :param start_time: datetime.datetime, None for the first step
+    :param end_time: datetime.datetime (inclusive), None for the last step
+    :return: (np.array of datetime64[h], np.array (time, cells) of float32, NaN for cells outside)
+    """
+    cell_index = np.asarray(cell_index, dtype=np.int64)
+    with h5py.File(cube_path, 'r') as cube_file:
+        precip_ds, hours = cube_file['precip'], cube_file['time'][:]
+        xsize = precip_ds.shape[2]
+
+        t0 = 0 if start_time is None else np.searchsorted(hours, datetime2hours(start_time), side='left')
+        t1 = len(hours) if end_time is None else np.searchsorted(hours, datetime2hours(end_time), side='right')
+
+        values = np.full((t1 - t0, len(cell_index)), np.nan, dtype=np.float32)
+        inside = cell_index >= 0
+        if inside.any() and t1 > t0:
+            rows, cols = cell_index[inside] // xsize, cell_index[inside] % xsize
+            row0, row1, col0, col1 = rows.min(), rows.max() + 1, cols.min(), cols.max() + 1
+            slab = precip_ds[t0:t1, row0:row1, col0:col1]
+            values[:, inside] = slab[:, rows - row0, cols - col0]
+    # with
+
+    return hours[t0:t1].astype('datetime64[h]'), values
+
+
+def watershed_rainfall(cube_path, polygon, start_time=None, end_time=None, grid_index=None):
+    """
+    Mean rainfall history of a watershed.
+    :param polygon: np.array (vertices, 2) of lon/lat
+    :return: pd.DataFrame with time, mean, max and number of valid cells
+    """
+    if grid_index is None:
+        grid_index = hrap_grid_index()
+    cell_index, indptr = grid_index.polygon_index([polygon])
+
+    times, values = extract_cells(cube_path, cell_index, start_time, end_time)
+    valid = ~np.isnan(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_values = np.where(valid, values, 0).sum(axis=1) / valid.sum(axis=1)
+    max_values = np.where(valid, values, -np.inf).max(axis=1, initial=-np.inf)
+    max_values[np.isinf(max_values)] = np.nan
+
+    return pd.DataFrame({'time': times, 'mean': mean_values, 'max': max_values, 'cells': valid.sum(axis=1)})
+
+
+def main():
+    now = datetime.datetime.now()
+    print("###########################################################")
+    print("### Stage IV time cube ####################################")
+    print("### ", now)
+    print("###########################################################")
+
+    opts = parse_args()
+    cube_path = opts.cube_file
+
+    if opts.src_folder:
+        grib_files = find_grib_files(opts.src_folder, opts.pattern)
+        if not os.path.exists(cube_path):
+            period = grib_period_pattern.search(os.path.basename(grib_files[0])) if grib_files else None
+            create_cube(cube_path, time_chunk=opts.time_chunk, period=period.group(1) if period else '')
+        append_cube(cube_path, grib_files)
+    # if
+
+    if opts.watershed_csv:
+        vertices = pd.read_csv(opts.watershed_csv)[['lon', 'lat']].values
+        rainfall = watershed_rainfall(cube_path, vertices)
+        rainfall.to_csv(opts.target_csv, index=False)
+        print("### Rainfall history of {} steps in {}".format(len(rainfall), opts.target_csv))
+
+    print("### Task over #############################################")
+
+
+if __name__ == "__main__":
+    main()
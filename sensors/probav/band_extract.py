@@ -17,6 +17,7 @@ from osgeo import gdal, osr
 gdal.UseExceptions()
 
 from gdal_image_ulti import save_band_image, copy_spatialref
+from probav_reader import probav_s10_toc_reader
 
 
 # --src-file ""
@@ -36,48 +37,6 @@ def parse_args():
     return opts
 
 
-class probav_s10_toc_reader(object):
-    """
-
-    """
-
-    def __init__(self, src_file):
-        self.src_file = src_file
-        self.datasource = self._read_probav_s5_toc()
-
-    def get_spatialref(self):
-        if self.datasource is None:
-            return None
-
-    def get_ndvi_array(self):
-        # replace <subdataset> with the number of the subdataset you need, starting with 0
-        ndvi_ds = gdal.Open(self.datasource.GetSubDatasets()[6][0], gdal.GA_ReadOnly)
-        ndvi_array = ndvi_ds.ReadAsArray()
-        print("Shape: {}".format(ndvi_array.shape))
-        return ndvi_array
-
-    def get_mask_array(self):
-        # replace <subdataset> with the number of the subdataset you need, starting with 0
-        mask_ds = gdal.Open(self.datasource.GetSubDatasets()[7][0], gdal.GA_ReadOnly)
-        mask_array = mask_ds.ReadAsArray()
-        return (mask_array == 248) | (mask_array == 232)
-
-    def _read_probav_s5_toc(self):
-
-        if not gdal.GetDriverByName('HDF5'):
-            raise Exception('HDF5 driver is not available')
-
-        hdf5_datasource = gdal.Open(self.src_file, gdal.GA_ReadOnly)
-        if hdf5_datasource is not None:
-            subdataset = hdf5_datasource.GetSubDatasets()
-            # print("Subdataset: ", subdataset)
-
-        return hdf5_datasource
-
-    def _get_product(self, product):
-        pass
-
-
 def ndvi_masked_extract(src_file, target_file, ref_file):
     """
 
@@ -7,6 +7,7 @@ Author: Zhou Ya'nan
 Date: 2021-09-16
 """
 import os
+import sys
 import time
 import datetime
 import argparse
@@ -15,6 +16,11 @@ import numpy as np
 from osgeo import gdal, osr
 gdal.UseExceptions()
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'raster'))
+from block_io import block_windows
+
+from probav_reader import probav_s5_toc_reader
+
 
 # --src-folder ""
 # --target-file ""
@@ -29,7 +35,12 @@ def parse_args():
                         help='target file for writing results')
     parser.add_argument('--georef-file', required=False, type=str, default="./data/data.tif",
                         help='spatial reference for results')
-    parser.add_argument('--operator', required=False, type=str, default="max", help='stistic operator')
+    parser.add_argument('--operator', required=False, type=str, default="max",
+                        help='stistic operator in [max, min, mean, count, first, last]')
+    parser.add_argument('--tiled', action='store_true',
+                        help='composite window by window across all inputs with fixed memory')
+    parser.add_argument('--block-size', required=False, type=int, default=1024,
+                        help='window edge in pixels for tiled mode')
     opts = parser.parse_args()
     return opts
 
@@ -94,62 +105,108 @@ def copy_spatialref(img_path4, img_path2):
     return True
 
 
-class probav_s5_toc_reader(object):
+class ndvi_accumulator(object):
     """
+    Running composite of masked NDVI, each array is folded in as it is read,
+    so memory does not grow with the number of dates.
 
+    operator: 'max', 'min', 'mean', 'count' (number of valid dates), 'first' or 'last' valid value
+    fill_value: result for pixels without any valid date
     """
-    def __init__(self, src_file):
-        self.src_file = src_file
-        self.datasource = self._read_probav_s5_toc()
-
-    def get_spatialref(self):
-        if self.datasource is None:
-            return None
-
-    def get_ndvi_array(self):
-        # replace <subdataset> with the number of the subdataset you need, starting with 0
-        ndvi_ds = gdal.Open(self.datasource.GetSubDatasets()[6][0], gdal.GA_ReadOnly)
-        ndvi_array = ndvi_ds.ReadAsArray()
-        print("Shape: {}".format(ndvi_array.shape))
-        return ndvi_array
-
-    def get_mask_array(self):
-        # replace <subdataset> with the number of the subdataset you need, starting with 0
-        mask_ds = gdal.Open(self.datasource.GetSubDatasets()[7][0], gdal.GA_ReadOnly)
-        mask_array = mask_ds.ReadAsArray()
-        return (mask_array==248)
-
-    def _read_probav_s5_toc(self):
-
-        if not gdal.GetDriverByName('HDF5'):
-            raise Exception('HDF5 driver is not available')
-
-        hdf5_datasource = gdal.Open(self.src_file, gdal.GA_ReadOnly)
-        if hdf5_datasource is not None:
-            subdataset = hdf5_datasource.GetSubDatasets()
-            # print("Subdataset: ", subdataset)
-
-        return hdf5_datasource
-
-    def _get_product(self, product):
-        pass
-
+    operators = ('max', 'min', 'mean', 'count', 'first', 'last')
+
+    def __init__(self, operator="max", fill_value=0):
+        if operator not in self.operators:
+            raise Exception("Operator {} not supported, use one of {}".format(operator, self.operators))
+        self.operator = operator
+        self.fill_value = fill_value
+        self.value = None
+        self.count = None
+
+    def add(self, ndvi_array, valid_mask):
+        if self.count is None:
+            self.count = np.zeros(ndvi_array.shape, dtype=np.uint16)
+            self.value = np.zeros(ndvi_array.shape, dtype=np.float64 if self.operator == 'mean' else np.float32)
+
+        if self.operator == 'max':
+            update = valid_mask & ((self.count == 0) | (ndvi_array > self.value))
+        elif self.operator == 'min':
+            update = valid_mask & ((self.count == 0) | (ndvi_array < self.value))
+        elif self.operator == 'first':
+            update = valid_mask & (self.count == 0)
+        elif self.operator == 'last':
+            update = valid_mask
+        else:
+            update = None
+
+        if self.operator == 'mean':
+            self.value += np.where(valid_mask, ndvi_array, 0)
+        elif update is not None:
+            self.value[update] = ndvi_array[update]
+        self.count += valid_mask
+
+    def result(self):
+        if self.operator == 'count':
+            return self.count.astype(np.float32)
+
+        composite = self.value
+        if self.operator == 'mean':
+            composite = composite / np.maximum(self.count, 1)
+        composite = composite.astype(np.float32)
+        composite[self.count == 0] = self.fill_value
+        return composite
+
+
+def create_composite_image(save_path, xsize, ysize, bands=1, format='GTiff'):
+    file_driver = gdal.GetDriverByName(format)
+    dst_ds = file_driver.Create(save_path, xsize=xsize, ysize=ysize, bands=bands, eType=gdal.GDT_Float32,
+                                options=['TILED=YES', 'COMPRESS=DEFLATE'])
+    if not dst_ds:
+        raise Exception("Fail to create image {}".format(save_path))
+    return dst_ds
 
-def ndvi_composites(src_files, target_file, ref_file, operator="max"):
 
+def ndvi_composites(src_files, target_file, ref_file, operator="max", tiled=False, block_size=(1024, 1024)):
+    """
+    Composite masked NDVI of PROBA-V files.
+    :param src_files: PROBA-V S5/S10 TOC HDF5 files
+    :param target_file:
+    :param ref_file: raster giving the spatial reference of results
+    :param operator: see ndvi_accumulator
+    :param tiled: composite window by window across all inputs, memory is bounded by block_size
+                  instead of the image size
+    :param block_size: window size (x, y) for tiled mode
+    :return:
+    """
     if os.path.exists(target_file):
         os.remove(target_file)
 
-    ndvi_mask = []
-    for i, file in enumerate(src_files):
-        dataset = probav_s5_toc_reader(file)
-        ndvi_array = dataset.get_ndvi_array()
-        mask_array = dataset.get_mask_array()
-        ndvi_mask.append(ndvi_array * mask_array)
-
-    max_composite = np.maximum.reduce([r for r in ndvi_mask])
+    if not tiled:
+        accumulator = ndvi_accumulator(operator)
+        for i, file in enumerate(src_files):
+            dataset = probav_s5_toc_reader(file)
+            accumulator.add(dataset.get_ndvi_array(), dataset.get_mask_array())
+            dataset.close()
+        # for
+
+        save_band_image(accumulator.result(), target_file)
+    else:
+        datasets = [probav_s5_toc_reader(file) for file in src_files]
+        ndvi_ds = datasets[0].get_dataset('NDVI')
+        target_ds = create_composite_image(target_file, ndvi_ds.RasterXSize, ndvi_ds.RasterYSize)
+
+        for window in block_windows(ndvi_ds, block_size):
+            read_window = (window.xoff, window.yoff, window.xsize, window.ysize)
+            accumulator = ndvi_accumulator(operator)
+            for dataset in datasets:
+                accumulator.add(dataset.get_ndvi_array(read_window), dataset.get_mask_array(read_window))
+            target_ds.GetRasterBand(1).WriteArray(accumulator.result(), window.xoff, window.yoff)
+        # for
+
+        target_ds.FlushCache()
+        del target_ds, ndvi_ds, datasets
+    # if
 
-    save_band_image(max_composite, target_file)
     copy_spatialref(ref_file, target_file)
 
 
@@ -165,6 +222,8 @@ def main():
     target_file = opts.target_file
     georef_file = opts.georef_file
     operator = opts.operator
+    tiled = opts.tiled
+    block_size = (opts.block_size, opts.block_size)
 
     src_files = []
     folder_list = os.listdir(folder)
@@ -174,7 +233,7 @@ def main():
             src_files.append(src_df)
     #for
 
-    ndvi_composites(src_files, target_file, georef_file, operator)
+    ndvi_composites(src_files, target_file, georef_file, operator, tiled, block_size)
 
     # # test mvc
     # probav_s5_toc_1 = "H:/FF/application_dataset/africa_grass/PROBAV_S5_TOC_X17Y04/PROBAV_S5_TOC_X17Y04_20200101_100M_V101.HDF5"
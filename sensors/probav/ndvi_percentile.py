@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+"""
+Median (percentile) composite of NDVI
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import sys
+import time
+import datetime
+import argparse
+import tracemalloc
+import warnings
+import numpy as np
+from osgeo import gdal, osr
+gdal.UseExceptions()
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'raster'))
+from block_io import block_windows
+
+from probav_reader import probav_s5_toc_reader
+from ndvi_mvc import create_composite_image, copy_spatialref
+
+
+# per pixel: the date read from the source with its mask and the bin index temporaries
+WINDOW_PIXEL_OVERHEAD = 96
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='NDVI median(percentile) composite for Probav data')
+    parser.add_argument('--src-folder', required=False, type=str, default="./",
+                        help='source folder containing files for composition')
+    parser.add_argument('--target-file', required=False, type=str, default="./data",
+                        help='target file for writing results')
+    parser.add_argument('--georef-file', required=False, type=str, default="./data/data.tif",
+                        help='spatial reference for results')
+    parser.add_argument('--percentiles', required=False, type=str, default="50",
+                        help='comma separated percentiles, one band for each')
+    parser.add_argument('--method', required=False, type=str, default="exact",
+                        help='exact (nanpercentile) or histogram (approximate, bounded by bins)')
+    parser.add_argument('--memory-mb', required=False, type=float, default=512,
+                        help='memory budget for one window in MB')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='benchmark against a full-stack np.nanpercentile on synthetic data')
+    opts = parser.parse_args()
+    return opts
+
+
+def window_rows_from_budget(num_dates, xsize, memory_budget_mb=512, method='exact', nbins=256, num_percentiles=1):
+    """
+    Number of full-width rows in one window so that its peak working set stays within the budget.
+    exact holds the float32 stack (dates), its sorted copy and the NaN mask of the stack;
+    histogram holds the int32 counts (bins) next to the int64 bincount of one date and its int32 copy,
+    the int32 cumulative sum of the percentile step is allocated after these are released.
+    Both add WINDOW_PIXEL_OVERHEAD and the float32 results with their reshaped copy.
+    Checked with check_memory_budget().
+    """
+    if method == 'exact':
+        bytes_per_pixel = num_dates * (4 + 4 + 1)
+    else:
+        bytes_per_pixel = nbins * (4 + 8 + 4)
+    bytes_per_pixel += WINDOW_PIXEL_OVERHEAD + num_percentiles * 4 * 2
+    rows = int(memory_budget_mb * 1024 * 1024 // (bytes_per_pixel * xsize))
+    return max(1, rows)
+
+
+def histogram_bin_index(ndvi_array, value_range=(0, 255), nbins=256):
+    """
+    Bins are centred on lo + i*width, so integer data with nbins == hi-lo+1 is binned without loss.
+    """
+    low, high = value_range
+    width = (high - low) / float(nbins - 1)
+    bin_index = np.rint((ndvi_array.astype(np.float32) - low) / width)
+    return np.clip(bin_index, 0, nbins - 1).astype(np.int64)
+
+
+def histogram_percentile(counts, percentiles, value_range=(0, 255), fill_value=0):
+    """
+    Percentiles from per-pixel histograms, linear interpolation between ranks as np.nanpercentile.
+    :param counts: np.array (pixels, nbins)
+    :param percentiles: sequence of percentiles in [0, 100]
+    :return: np.array (len(percentiles), pixels) of float32
+    """
+    low, high = value_range
+    nbins = counts.shape[1]
+    bin_values = low + np.arange(nbins) * (high - low) / float(nbins - 1)
+
+    num_valid = counts.sum(axis=1)
+    # counts of a pixel sum up to the number of dates, int32 is enough
+    cum_counts = np.cumsum(counts, axis=1, dtype=np.int32)
+
+    def value_at_rank(rank):
+        return bin_values[(cum_counts > rank[:, np.newaxis]).argmax(axis=1)]
+
+    results = np.full((len(percentiles), counts.shape[0]), fill_value, dtype=np.float32)
+    has_valid = num_valid > 0
+    for idx, q in enumerate(percentiles):
+        rank = q / 100.0 * np.maximum(num_valid - 1, 0)
+        rank_lo = np.floor(rank)
+        frac = rank - rank_lo
+        value_lo = value_at_rank(rank_lo)
+        value_hi = value_at_rank(np.minimum(rank_lo + 1, np.maximum(num_valid - 1, 0)))
+        results[idx, has_valid] = (value_lo + frac * (value_hi - value_lo))[has_valid]
+    # for
+
+    return results
+
+
+def nan_percentile_sorted(stack, percentiles, fill_value=0):
+    """
+    Exact nan-aware percentiles along axis 0, same linear interpolation as np.nanpercentile.
+    np.nanpercentile falls back to a per-pixel loop along the axis when NaNs are present,
+    so the stack is sorted once (NaNs go last) and the ranks are gathered for all pixels at once.
+    :param stack: np.array (dates, ...) of float, NaN for invalid
+    :return: np.array (len(percentiles), ...) of float32
+    """
+    sorted_stack = np.sort(stack, axis=0)
+    num_valid = np.sum(~np.isnan(stack), axis=0)
+    last = np.maximum(num_valid - 1, 0)
+
+    results = np.full((len(percentiles),) + stack.shape[1:], fill_value, dtype=np.float32)
+    has_valid = num_valid > 0
+    for idx, q in enumerate(percentiles):
+        rank = q / 100.0 * last
+        rank_lo = np.floor(rank).astype(np.int64)
+        rank_hi = np.minimum(rank_lo + 1, last)
+        value_lo = np.take_along_axis(sorted_stack, rank_lo[np.newaxis], axis=0)[0]
+        value_hi = np.take_along_axis(sorted_stack, rank_hi[np.newaxis], axis=0)[0]
+        percentile_value = value_lo + (rank - rank_lo) * (value_hi - value_lo)
+        results[idx][has_valid] = percentile_value[has_valid]
+    # for
+
+    return results
+
+
+def percentile_window(window_reader, num_dates, percentiles, method='exact', value_range=(0, 255), nbins=256,
+                      fill_value=0):
+    """
+    Percentile composite of one window.
+    :param window_reader: callable date_index -> (ndvi_array, valid_mask) of the window
+    :param num_dates:
+    :param percentiles:
+    :param method: 'exact' stacks the dates and sorts them (nan_percentile_sorted),
+                   'histogram' folds every date into per-pixel histograms (approximate unless bins are lossless)
+    :return: np.array (len(percentiles), ysize, xsize) of float32
+    """
+    if method == 'exact':
+        stack = None
+        for dd in range(num_dates):
+            ndvi_array, valid_mask = window_reader(dd)
+            if stack is None:
+                stack = np.empty((num_dates,) + ndvi_array.shape, dtype=np.float32)
+            stack[dd] = ndvi_array
+            stack[dd][~valid_mask] = np.nan
+        # for
+        window_shape = stack.shape[1:]
+        results = nan_percentile_sorted(stack, percentiles, fill_value)
+    elif method == 'histogram':
+        counts = None
+        for dd in range(num_dates):
+            ndvi_array, valid_mask = window_reader(dd)
+            if counts is None:
+                window_shape = ndvi_array.shape
+                counts = np.zeros(ndvi_array.size * nbins, dtype=np.int32)
+            pixel_index = np.flatnonzero(valid_mask)
+            bin_index = histogram_bin_index(ndvi_array.ravel()[pixel_index], value_range, nbins)
+            counts += np.bincount(pixel_index * nbins + bin_index, minlength=counts.size).astype(np.int32)
+        # for
+        results = histogram_percentile(counts.reshape(-1, nbins), percentiles, value_range, fill_value)
+    else:
+        raise Exception("Method {} not supported".format(method))
+
+    return results.reshape((len(percentiles),) + tuple(window_shape))
+
+
+def ndvi_percentile_composites(src_files, target_file, ref_file, percentiles=(50,), method='exact',
+                               memory_budget_mb=512, value_range=(0, 255), nbins=256):
+    """
+    Percentile composite of masked NDVI, window by window across all dates.
+    The window height is chosen from the memory budget, one output band for each percentile.
+    :param src_files: PROBA-V S5/S10 TOC HDF5 files
+    :param target_file:
+    :param ref_file: raster giving the spatial reference of results
+    :param percentiles: e.g. (50,) for median
+    :param method: 'exact' (sorted stack) or 'histogram' (per-pixel histograms, approximate)
+    :param memory_budget_mb: memory budget for one window
+    :return:
+    """
+    if os.path.exists(target_file):
+        os.remove(target_file)
+
+    datasets = [probav_s5_toc_reader(file) for file in src_files]
+    ndvi_ds = datasets[0].get_dataset('NDVI')
+    xsize, ysize = ndvi_ds.RasterXSize, ndvi_ds.RasterYSize
+
+    rows = window_rows_from_budget(len(datasets), xsize, memory_budget_mb, method, nbins, len(percentiles))
+    print("### Window of {} x {} for {} dates".format(xsize, rows, len(datasets)))
+
+    target_ds = create_composite_image(target_file, xsize, ysize, bands=len(percentiles))
+    for window in block_windows(ndvi_ds, (xsize, rows)):
+        read_window = (window.xoff, window.yoff, window.xsize, window.ysize)
+
+        def window_reader(dd):
+            return datasets[dd].get_ndvi_array(read_window), datasets[dd].get_mask_array(read_window)
+
+        results = percentile_window(window_reader, len(datasets), percentiles, method, value_range, nbins)
+        for idx in range(len(percentiles)):
+            target_ds.GetRasterBand(idx + 1).WriteArray(results[idx], window.xoff, window.yoff)
+    # for
+
+    target_ds.FlushCache()
+    del target_ds, ndvi_ds, datasets
+
+    copy_spatialref(ref_file, target_file)
+
+
+def check_memory_budget(num_dates=36, xsize=1000, percentiles=(50,), memory_budget_mb=64, method='histogram',
+                        nbins=256, seed=0):
+    """
+    Peak traced memory of one window sized by window_rows_from_budget, on synthetic float64 NDVI
+    (the widest type a reader returns), raises if it is over the budget.
+    :return: peak in MB
+    """
+    rows = window_rows_from_budget(num_dates, xsize, memory_budget_mb, method, nbins, len(percentiles))
+    rng = np.random.default_rng(seed)
+
+    def window_reader(dd):
+        return rng.integers(0, 251, size=(rows, xsize)).astype(np.float64), rng.random((rows, xsize)) > 0.3
+
+    tracemalloc.start()
+    percentile_window(window_reader, num_dates, percentiles, method, nbins=nbins)
+    peak_mb = tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0
+    tracemalloc.stop()
+
+    print("### {:<10} window of {} x {}, peak {:.1f} MB for a budget of {} MB".format(
+        method, xsize, rows, peak_mb, memory_budget_mb))
+    if peak_mb > memory_budget_mb:
+        raise Exception("Peak {:.1f} MB of a {} window over the budget of {} MB".format(
+            peak_mb, method, memory_budget_mb))
+    return peak_mb
+
+
+def benchmark_percentile(num_dates=36, shape=(500, 500), percentiles=(50,), memory_budget_mb=64, seed=0,
+                         trace_memory=False):
+    """
+    Compare the block-wise compositor with a naive full-stack np.nanpercentile on synthetic NDVI.
+    Reports time and the largest difference to the naive result, plus peak traced memory
+    with trace_memory (a second, slower run under tracemalloc).
+    """
+    rng = np.random.default_rng(seed)
+    ndvi_stack = rng.integers(0, 251, size=(num_dates,) + shape, dtype=np.uint8)
+    mask_stack = rng.random((num_dates,) + shape) > 0.3
+    print("### Benchmark: {} dates of {} x {}".format(num_dates, shape[1], shape[0]))
+
+    def run(name, func):
+        start_time = time.time()
+        result = func()
+        print("### {:<10} {:8.2f}s".format(name, time.time() - start_time))
+        if trace_memory:
+            tracemalloc.start()
+            func()
+            print("### {:<10} peak {:8.1f} MB".format(name, tracemalloc.get_traced_memory()[1] / 1e6))
+            tracemalloc.stop()
+        return result
+
+    def naive():
+        stack = np.where(mask_stack, ndvi_stack.astype(np.float32), np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            results = np.nanpercentile(stack, percentiles, axis=0)
+        return np.nan_to_num(results, nan=0).astype(np.float32)
+
+    def blockwise(method):
+        rows = window_rows_from_budget(num_dates, shape[1], memory_budget_mb, method, num_percentiles=len(percentiles))
+        results = np.zeros((len(percentiles),) + shape, dtype=np.float32)
+        for yoff in range(0, shape[0], rows):
+            def window_reader(dd):
+                return ndvi_stack[dd, yoff:yoff + rows], mask_stack[dd, yoff:yoff + rows]
+            results[:, yoff:yoff + rows] = percentile_window(window_reader, num_dates, percentiles, method)
+        return results
+
+    naive_result = run('naive', naive)
+    for method in ('exact', 'histogram'):
+        result = run(method, lambda: blockwise(method))
+        print("### {:<10} max abs diff to naive {:.6f}".format(method, np.abs(result - naive_result).max()))
+        check_memory_budget(num_dates, shape[1], percentiles, memory_budget_mb, method, seed=seed)
+    # for
+
+
+def main():
+    now = datetime.datetime.now()
+    print("###########################################################")
+    print("### NDVI median(percentile) composite #####################")
+    print("### ", now)
+    print("###########################################################")
+
+    opts = parse_args()
+    percentiles = [float(q) for q in opts.percentiles.split(',')]
+
+    if opts.benchmark:
+        benchmark_percentile(percentiles=percentiles, memory_budget_mb=opts.memory_mb)
+        return
+
+    folder = opts.src_folder
+    src_files = [os.path.join(folder, df) for df in sorted(os.listdir(folder))
+                 if os.path.isfile(os.path.join(folder, df))]
+
+    ndvi_percentile_composites(src_files, opts.target_file, opts.georef_file, percentiles, opts.method,
+                               opts.memory_mb)
+
+    print("### Task over #############################################")
+
+
+if __name__ == "__main__":
+    main()
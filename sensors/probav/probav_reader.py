@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+Reader for PROBA-V TOC products in HDF5
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import numpy as np
+from osgeo import gdal, osr
+gdal.UseExceptions()
+
+
+# leaf names of layers which are keyed by their parent group, e.g. //LEVEL3/RADIOMETRY/RED/TOC -> RED
+PARENT_KEYED_LAYERS = ('TOC', 'TOA')
+
+
+def subdataset_key(subdataset_name):
+    """
+    Layer key of one subdataset, e.g.
+    HDF5:"X.HDF5"://LEVEL3/NDVI/NDVI -> NDVI, HDF5:"X.HDF5"://LEVEL3/RADIOMETRY/NIR/TOC -> NIR
+    """
+    hdf5_path = subdataset_name.split('://')[-1]
+    path_parts = [part for part in hdf5_path.split('/') if part]
+    if len(path_parts) > 1 and path_parts[-1].upper() in PARENT_KEYED_LAYERS:
+        return path_parts[-2].upper()
+    return path_parts[-1].upper()
+
+
+def layer_attribute_keys(subdataset_name, attribute):
+    """
+    Metadata keys gdal gives one attribute of a layer, e.g. for //LEVEL3/NDVI/NDVI and SCALE:
+    ('LEVEL3_NDVI_NDVI_SCALE', 'SCALE')
+    """
+    hdf5_path = subdataset_name.split('://')[-1]
+    path_parts = [part.upper() for part in hdf5_path.split('/') if part]
+    return '_'.join(path_parts + [attribute]), attribute
+
+
+class probav_toc_reader(object):
+    """
+    Open the HDF5 container once, index its subdatasets by name (NDVI, SM, RED, NIR, BLUE, SWIR, TIME, ...)
+    and keep the opened layers for repeated (windowed) reads.
+    Arrays are returned in their stored dtype, physical values (DN - OFFSET) / SCALE only on request.
+    """
+    def __init__(self, src_file):
+        self.src_file = src_file
+        self.datasource = self._read_probav_toc()
+        self.subdatasets = self._index_subdatasets()
+        self._layers = {}
+
+    def get_spatialref(self):
+        if self.datasource is None:
+            return None
+
+    def get_names(self):
+        return list(self.subdatasets.keys())
+
+    def get_dataset(self, name):
+        """
+        Opened gdal dataset of one layer, opened on first access and cached.
+        """
+        name = name.upper()
+        if name not in self._layers:
+            if name not in self.subdatasets:
+                raise Exception("Layer {} not found in {}".format(name, self.src_file))
+            self._layers[name] = gdal.Open(self.subdatasets[name], gdal.GA_ReadOnly)
+        return self._layers[name]
+
+    def get_shape(self, name='NDVI'):
+        layer_ds = self.get_dataset(name)
+        return layer_ds.RasterYSize, layer_ds.RasterXSize
+
+    def get_scale_offset(self, name):
+        """
+        (SCALE, OFFSET) of one layer in the PROBA-V convention, physical value = (DN - OFFSET) / SCALE,
+        from the HDF5 attributes of the layer or the band, (1, 0) if not given.
+        """
+        layer_ds = self.get_dataset(name)
+        metadata = {key.upper(): value for key, value in layer_ds.GetMetadata().items()}
+        scale_keys = layer_attribute_keys(self.subdatasets[name.upper()], 'SCALE')
+        offset_keys = layer_attribute_keys(self.subdatasets[name.upper()], 'OFFSET')
+        scale = next((float(metadata[key]) for key in scale_keys if key in metadata), None)
+        offset = next((float(metadata[key]) for key in offset_keys if key in metadata), 0.0)
+        if scale not in (None, 0):
+            return scale, offset
+
+        # gdal band scale/offset follow physical value = DN * scale + offset, convert them
+        layer_band = layer_ds.GetRasterBand(1)
+        band_scale, band_offset = layer_band.GetScale(), layer_band.GetOffset()
+        if band_scale not in (None, 0):
+            return 1.0 / band_scale, -(band_offset or 0) / band_scale
+        return 1, 0
+
+    def get_array(self, name, window=None, scaled=False):
+        """
+        :param name: layer key, e.g. 'NDVI', 'SM', 'RED'
+        :param window: (xoff, yoff, xsize, ysize), None reads the whole layer
+        :param scaled: return float32 physical values instead of the stored digital numbers
+        """
+        layer_ds = self.get_dataset(name)
+        layer_array = layer_ds.ReadAsArray() if window is None else layer_ds.ReadAsArray(*window)
+        if scaled:
+            scale, offset = self.get_scale_offset(name)
+            layer_array = (layer_array.astype(np.float32) - offset) / scale
+        return layer_array
+
+    def get_ndvi_array(self, window=None, scaled=False):
+        return self.get_array('NDVI', window, scaled)
+
+    def get_mask_array(self, window=None):
+        """
+        Clear pixels from the status map, defined by subclasses.
+        """
+        return np.ones_like(self.get_array('SM', window), dtype=bool)
+
+    def close(self):
+        self._layers.clear()
+        self.datasource = None
+
+    def _read_probav_toc(self):
+
+        if not gdal.GetDriverByName('HDF5'):
+            raise Exception('HDF5 driver is not available')
+
+        hdf5_datasource = gdal.Open(self.src_file, gdal.GA_ReadOnly)
+        if hdf5_datasource is None:
+            raise Exception("Fail to open {}".format(self.src_file))
+
+        return hdf5_datasource
+
+    def _index_subdatasets(self):
+        subdatasets = {}
+        for subdataset_name, subdataset_desc in self.datasource.GetSubDatasets():
+            subdatasets.setdefault(subdataset_key(subdataset_name), subdataset_name)
+        # for
+        return subdatasets
+
+
+class probav_s5_toc_reader(probav_toc_reader):
+    """
+    PROBA-V S5 TOC, clear pixels with SM == 248.
+    """
+    def get_mask_array(self, window=None):
+        return self.get_array('SM', window) == 248
+
+
+class probav_s10_toc_reader(probav_toc_reader):
+    """
+    PROBA-V S10 TOC, clear pixels with SM in (248, 232).
+    """
+    def get_mask_array(self, window=None):
+        mask_array = self.get_array('SM', window)
+        return (mask_array == 248) | (mask_array == 232)
@@ -13,6 +13,9 @@ import argparse
 import numpy as np
 from osgeo import gdal, osr
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'raster'))
+from block_io import DEFAULT_BLOCK_SIZE, natural_block_size
+
 os.environ['CPL_ZIP_ENCODING'] = 'UTF-8'
 os.environ['PROJ_LIB'] = r'D:\develop-envi\anaconda3\envs\py38\Lib\site-packages\pyproj\proj_dir\share\proj'
 gdal.UseExceptions()
@@ -29,6 +32,10 @@ def parse_args():
     parser.add_argument('--res-scale', required=False, type=str,
                         default="2",
                         help='scale for resolution in [2,3,6]')
+    parser.add_argument('--streaming', action='store_true',
+                        help='scale block by block with bounded memory')
+    parser.add_argument('--virtual', action='store_true',
+                        help='write a VRT view at the target resolution instead of pixels')
     opts = parser.parse_args()
     return opts
 
@@ -56,32 +63,49 @@ def ndarray_nearest_neighbour_scaling(label, scale_h=2, scale_w=2):
      [7 7 7 8 8 8 9 9 9]]
     """
 
-    src_h, src_w = label.shape[0], label.shape[1]
-    new_h = src_h * scale_h
-    new_w = src_w * scale_w
-
-    if len(label.shape) == 2:
-        label_new = np.zeros([new_h, new_w], dtype=label.dtype)
-    else:
-        label_new = np.zeros([new_h, new_w, label.shape[2]], dtype=label.dtype)
-
-    y_pos = np.arange(new_h)
-    x_pos = np.arange(new_w)
-    y_pos = np.floor(y_pos / scale_h).astype(np.int32)
-    x_pos = np.floor(x_pos / scale_w).astype(np.int32)
-
-    y_pos = y_pos.reshape(y_pos.shape[0], 1)
-    y_pos = np.tile(y_pos, (1, new_w))
-    x_pos = np.tile(x_pos, (new_h, 1))
-    assert y_pos.shape == x_pos.shape
-
-    label_new[:, :] = label[y_pos[:, :], x_pos[:, :]]
+    # np.repeat copies each row/column in place of gathering through full-size index grids
+    label_new = np.repeat(label, scale_h, axis=0)
+    label_new = np.repeat(label_new, scale_w, axis=1)
     return label_new
 
 
-def nn_supres_20_10(raster20_path, raster10_path, super_scale=2, format='GTiff'):
+def nn_upscale_rows(src_ds, target_ds, super_scale=2, block_rows=DEFAULT_BLOCK_SIZE[1]):
     """
-
+    Stream nearest neighbour upscaling row block by row block into the target dataset.
+    Each source block is broadcast into a reused (rows, scale, width, scale) buffer,
+    whose contiguous (rows*scale, width*scale) view is written directly.
+    :param src_ds: gdal dataset
+    :param target_ds: gdal dataset with super_scale times the size of src_ds
+    :param super_scale: integer scale factor
+    :param block_rows: source rows per block, rounded to the natural block height
+    """
+    width, height = src_ds.RasterXSize, src_ds.RasterYSize
+    natural_y = natural_block_size(src_ds)[1]
+    step_y = max(natural_y, (block_rows // natural_y) * natural_y)
+
+    scaled_buffer = None
+    for yoff in range(0, height, step_y):
+        ysize = min(step_y, height - yoff)
+        for bb in range(1, src_ds.RasterCount + 1):
+            row_array = src_ds.GetRasterBand(bb).ReadAsArray(0, yoff, width, ysize)
+            if (scaled_buffer is None) or (scaled_buffer.dtype != row_array.dtype):
+                scaled_buffer = np.empty((step_y, super_scale, width, super_scale), dtype=row_array.dtype)
+
+            scaled_view = scaled_buffer[:ysize]
+            scaled_view[...] = row_array[:, np.newaxis, :, np.newaxis]
+            target_ds.GetRasterBand(bb).WriteArray(scaled_view.reshape(ysize * super_scale, width * super_scale),
+                                                   0, yoff * super_scale)
+        # for
+    # for
+
+
+def nn_supres_20_10(raster20_path, raster10_path, super_scale=2, format='GTiff', streaming=False,
+                    block_size=DEFAULT_BLOCK_SIZE, virtual=False):
+    """
+    Super resolution of raster with nearest neighbour scaling.
+    :param streaming: stream row blocks into the target (nn_upscale_rows), False scales the whole image in memory
+    :param block_size: window size (x, y) of the source, only the height is used for row blocks
+    :param virtual: write a VRT referring to the source at the finer resolution, no pixels are materialised
     """
 
     #################################################################
@@ -96,13 +120,17 @@ def nn_supres_20_10(raster20_path, raster10_path, super_scale=2, format='GTiff')
     data_type = raster20_ds.GetRasterBand(1).DataType
     raster20_shape = (raster20_ds.RasterXSize, raster20_ds.RasterYSize, raster20_ds.RasterCount)
 
-    #################################################################
-    # 2. get data
-    raster20_array = raster20_ds.ReadAsArray()
-    raster10_array = ndarray_nearest_neighbour_scaling(raster20_array, super_scale, super_scale)
+    if virtual:
+        raster10_ds = gdal.Translate(raster10_path, raster20_ds, format='VRT',
+                                     width=raster20_shape[0]*super_scale, height=raster20_shape[1]*super_scale,
+                                     resampleAlg='near')
+        del raster10_ds
+        del raster20_ds
+        print("### Success @ nn_supres_20_10() (VRT) ############")
+        return
 
     #################################################################
-    # 3. write image
+    # 2. create image
     raster10_driver = gdal.GetDriverByName(format)
     raster10_shape = (raster20_shape[0]*super_scale, raster20_shape[1]*super_scale, raster20_ds.RasterCount)
     raster10_ds = raster10_driver.Create(raster10_path, xsize=raster10_shape[0], ysize=raster10_shape[1],
@@ -116,8 +144,16 @@ def nn_supres_20_10(raster20_path, raster10_path, super_scale=2, format='GTiff')
     raster10_ds.SetGeoTransform(raster10_geotransform)
     raster10_ds.SetProjection(raster20_proj)
 
+    #################################################################
+    # 3. write image
     # dst_ds.GetRasterBand(1).SetNoDataValue(nodata_value)
-    raster10_ds.WriteRaster(0, 0, raster10_shape[0], raster10_shape[1], raster10_array.tobytes())
+    if streaming:
+        nn_upscale_rows(raster20_ds, raster10_ds, super_scale, block_size[1])
+    else:
+        for bb in range(0, raster10_shape[2]):
+            raster20_array = raster20_ds.GetRasterBand(bb + 1).ReadAsArray()
+            raster10_array = ndarray_nearest_neighbour_scaling(raster20_array, super_scale, super_scale)
+            raster10_ds.GetRasterBand(bb + 1).WriteArray(raster10_array)
 
     #################################################################
     # 4. close
@@ -141,13 +177,15 @@ def main():
     raster20_path = opts.src_path
     raster10_path = opts.target_path
     res_scale = int(opts.res_scale)
+    streaming = opts.streaming
+    virtual = opts.virtual
 
     # raster20_path = r'K:\FF\application_dataset\2021-yongchuan\4date\2021-06-30_2021-07-09\mask_re\20210707_mask_20m.tif'
     # raster10_path = r'K:\FF\application_dataset\2021-yongchuan\4date\2021-06-30_2021-07-09\mask_re_10m\20210707_mask_10m.tif'
     res_scale = 2
 
     ###########################################################
-    nn_supres_20_10(raster20_path, raster10_path, res_scale)
+    nn_supres_20_10(raster20_path, raster10_path, res_scale, streaming=streaming, virtual=virtual)
 
     ###########################################################
     # close
@@ -13,6 +13,9 @@ import argparse
 import numpy as np
 from osgeo import gdal, osr
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'raster'))
+from block_io import DEFAULT_BLOCK_SIZE, read_block, process_blocks
+
 os.environ['CPL_ZIP_ENCODING'] = 'UTF-8'
 os.environ['PROJ_LIB'] = r'D:\develop-envi\anaconda3\envs\py38\Lib\site-packages\pyproj\proj_dir\share\proj'
 gdal.UseExceptions()
@@ -29,13 +32,18 @@ def parse_args():
     parser.add_argument('--mask-path', required=False, type=str,
                         default="./data/mask.tif",
                         help='mask raster file in TIFF format')
+    parser.add_argument('--streaming', action='store_true',
+                        help='mask block by block with bounded memory')
     opts = parser.parse_args()
     return opts
 
 
-def pixel_wise_mask(src_path, target_path, mask_path, mask_mask_value=100, mask_value=0, format='GTiff'):
+def pixel_wise_mask(src_path, target_path, mask_path, mask_mask_value=100, mask_value=0, format='GTiff',
+                    streaming=False, block_size=DEFAULT_BLOCK_SIZE):
     """
-
+    Set pixels of source image to mask_value where the mask image equals mask_mask_value.
+    :param streaming: mask window by window instead of reading whole bands
+    :param block_size: window size (x, y) for streaming mode
     """
 
     #################################################################
@@ -70,14 +78,24 @@ def pixel_wise_mask(src_path, target_path, mask_path, mask_mask_value=100, mask_
 
     #################################################################
     # 3. write image
-    mask_band_array = mask_ds.GetRasterBand(1).ReadAsArray()
-
-    for bb in range(0, source_shape[2]):
-        source_band_array = source_ds.GetRasterBand(bb+1).ReadAsArray()
-        source_band_array[mask_band_array==mask_mask_value] = mask_value
-        target_ds.GetRasterBand(bb + 1).WriteRaster(0, 0, source_shape[0], source_shape[1], source_band_array.tobytes())
-        target_ds.GetRasterBand(bb + 1).SetNoDataValue(mask_value)
-    # for
+    if streaming:
+        def mask_block(block_array, window):
+            mask_block_array = read_block(mask_ds, window, [1], with_halo=False)[0]
+            block_array[:, mask_block_array==mask_mask_value] = mask_value
+            return block_array
+
+        process_blocks(source_ds, target_ds, mask_block, block_size)
+        for bb in range(0, source_shape[2]):
+            target_ds.GetRasterBand(bb + 1).SetNoDataValue(mask_value)
+    else:
+        mask_band_array = mask_ds.GetRasterBand(1).ReadAsArray()
+
+        for bb in range(0, source_shape[2]):
+            source_band_array = source_ds.GetRasterBand(bb+1).ReadAsArray()
+            source_band_array[mask_band_array==mask_mask_value] = mask_value
+            target_ds.GetRasterBand(bb + 1).WriteRaster(0, 0, source_shape[0], source_shape[1], source_band_array.tobytes())
+            target_ds.GetRasterBand(bb + 1).SetNoDataValue(mask_value)
+        # for
 
     #################################################################
     # 4. close
@@ -13,6 +13,9 @@ import argparse
 import numpy as np
 from osgeo import gdal, osr
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'raster'))
+from block_io import DEFAULT_BLOCK_SIZE, process_blocks
+
 os.environ['CPL_ZIP_ENCODING'] = 'UTF-8'
 os.environ['PROJ_LIB'] = r'D:\develop-envi\anaconda3\envs\py38\Lib\site-packages\pyproj\proj_dir\share\proj'
 gdal.UseExceptions()
@@ -29,6 +32,8 @@ def parse_args():
     parser.add_argument('--res', required=False, type=str,
                         default="10m",
                         help='target resolution in [10m, 20m, slc]')
+    parser.add_argument('--streaming', action='store_true',
+                        help='extract block by block with bounded memory')
     opts = parser.parse_args()
     return opts
 
@@ -75,9 +80,11 @@ def read_s2image_info(s2img_path):
     return s2ds_list
 
 
-def resolution_extract_10m(s2img_path, target_path, format='GTiff'):
+def resolution_extract_10m(s2img_path, target_path, format='GTiff', streaming=False, block_size=DEFAULT_BLOCK_SIZE):
     """
-
+    Extract [B2,B3,B4,B8] at 10m.
+    :param streaming: copy window by window instead of whole bands
+    :param block_size: window size (x, y) for streaming mode
     """
 
     #################################################################
@@ -125,14 +132,15 @@ def resolution_extract_10m(s2img_path, target_path, format='GTiff'):
     b_band = s2ds_sub1.GetRasterBand(3)
     nir_band = s2ds_sub1.GetRasterBand(4)
 
-    red_array = r_band.ReadAsArray(xoff=0, yoff=0, win_xsize=r_band.XSize, win_ysize=r_band.YSize,
-                                   buf_xsize=r_band.XSize, buf_ysize=r_band.YSize, buf_type=data_type)
-    green_array = g_band.ReadAsArray(xoff=0, yoff=0, win_xsize=r_band.XSize, win_ysize=r_band.YSize,
-                                     buf_xsize=r_band.XSize, buf_ysize=r_band.YSize, buf_type=data_type)
-    blue_array = b_band.ReadAsArray(xoff=0, yoff=0, win_xsize=r_band.XSize, win_ysize=r_band.YSize,
-                                    buf_xsize=r_band.XSize, buf_ysize=r_band.YSize, buf_type=data_type)
-    nir_array = nir_band.ReadAsArray(xoff=0, yoff=0, win_xsize=nir_band.XSize, win_ysize=nir_band.YSize,
-                                     buf_xsize=nir_band.XSize, buf_ysize=nir_band.YSize, buf_type=data_type)
+    if not streaming:
+        red_array = r_band.ReadAsArray(xoff=0, yoff=0, win_xsize=r_band.XSize, win_ysize=r_band.YSize,
+                                       buf_xsize=r_band.XSize, buf_ysize=r_band.YSize, buf_type=data_type)
+        green_array = g_band.ReadAsArray(xoff=0, yoff=0, win_xsize=r_band.XSize, win_ysize=r_band.YSize,
+                                         buf_xsize=r_band.XSize, buf_ysize=r_band.YSize, buf_type=data_type)
+        blue_array = b_band.ReadAsArray(xoff=0, yoff=0, win_xsize=r_band.XSize, win_ysize=r_band.YSize,
+                                        buf_xsize=r_band.XSize, buf_ysize=r_band.YSize, buf_type=data_type)
+        nir_array = nir_band.ReadAsArray(xoff=0, yoff=0, win_xsize=nir_band.XSize, win_ysize=nir_band.YSize,
+                                         buf_xsize=nir_band.XSize, buf_ysize=nir_band.YSize, buf_type=data_type)
 
     #################################################################
     # 3. write image
@@ -151,10 +159,14 @@ def resolution_extract_10m(s2img_path, target_path, format='GTiff'):
     dst_ds.SetGeoTransform(s2ds_sub1.GetGeoTransform())
 
     # dst_ds.GetRasterBand(1).SetNoDataValue(nodata_value)
-    dst_ds.GetRasterBand(1).WriteRaster(0, 0, img_shape[0], img_shape[1], blue_array.tobytes())
-    dst_ds.GetRasterBand(2).WriteRaster(0, 0, img_shape[0], img_shape[1], green_array.tobytes())
-    dst_ds.GetRasterBand(3).WriteRaster(0, 0, img_shape[0], img_shape[1], red_array.tobytes())
-    dst_ds.GetRasterBand(4).WriteRaster(0, 0, img_shape[0], img_shape[1], nir_array.tobytes())
+    if streaming:
+        # [B2,B3,B4,B8] from [B4,B3,B2,B8]
+        process_blocks(s2ds_sub1, dst_ds, None, block_size, src_bands=[3, 2, 1, 4])
+    else:
+        dst_ds.GetRasterBand(1).WriteRaster(0, 0, img_shape[0], img_shape[1], blue_array.tobytes())
+        dst_ds.GetRasterBand(2).WriteRaster(0, 0, img_shape[0], img_shape[1], green_array.tobytes())
+        dst_ds.GetRasterBand(3).WriteRaster(0, 0, img_shape[0], img_shape[1], red_array.tobytes())
+        dst_ds.GetRasterBand(4).WriteRaster(0, 0, img_shape[0], img_shape[1], nir_array.tobytes())
 
     #################################################################
     # 4. close
@@ -167,9 +179,11 @@ def resolution_extract_10m(s2img_path, target_path, format='GTiff'):
     print("### Success @ resolution_extract_10m() ##################")
 
 
-def resolution_extract_20m(s2img_path, target_path, format='GTiff'):
+def resolution_extract_20m(s2img_path, target_path, format='GTiff', streaming=False, block_size=DEFAULT_BLOCK_SIZE):
     """
-
+    Extract [B5,B6,B7,B8A,B11,B12] at 20m.
+    :param streaming: copy window by window instead of whole bands
+    :param block_size: window size (x, y) for streaming mode
     """
 
     #################################################################
@@ -219,18 +233,19 @@ def resolution_extract_20m(s2img_path, target_path, format='GTiff'):
     b11_band = s2ds_sub2.GetRasterBand(5)
     b12_band = s2ds_sub2.GetRasterBand(6)
 
-    b5_array = b5_band.ReadAsArray(xoff=0, yoff=0, win_xsize=b5_band.XSize, win_ysize=b5_band.YSize,
-                                   buf_xsize=b5_band.XSize, buf_ysize=b5_band.YSize, buf_type=data_type)
-    b6_array = b6_band.ReadAsArray(xoff=0, yoff=0, win_xsize=b6_band.XSize, win_ysize=b6_band.YSize,
-                                     buf_xsize=b6_band.XSize, buf_ysize=b6_band.YSize, buf_type=data_type)
-    b7_array = b7_band.ReadAsArray(xoff=0, yoff=0, win_xsize=b7_band.XSize, win_ysize=b7_band.YSize,
-                                    buf_xsize=b7_band.XSize, buf_ysize=b7_band.YSize, buf_type=data_type)
-    b8a_array = b8a_band.ReadAsArray(xoff=0, yoff=0, win_xsize=b8a_band.XSize, win_ysize=b8a_band.YSize,
-                                     buf_xsize=b8a_band.XSize, buf_ysize=b8a_band.YSize, buf_type=data_type)
-    b11_array = b11_band.ReadAsArray(xoff=0, yoff=0, win_xsize=b11_band.XSize, win_ysize=b11_band.YSize,
-                                     buf_xsize=b11_band.XSize, buf_ysize=b11_band.YSize, buf_type=data_type)
-    b12_array = b12_band.ReadAsArray(xoff=0, yoff=0, win_xsize=b12_band.XSize, win_ysize=b12_band.YSize,
-                                     buf_xsize=b12_band.XSize, buf_ysize=b12_band.YSize, buf_type=data_type)
+    if not streaming:
+        b5_array = b5_band.ReadAsArray(xoff=0, yoff=0, win_xsize=b5_band.XSize, win_ysize=b5_band.YSize,
+                                       buf_xsize=b5_band.XSize, buf_ysize=b5_band.YSize, buf_type=data_type)
+        b6_array = b6_band.ReadAsArray(xoff=0, yoff=0, win_xsize=b6_band.XSize, win_ysize=b6_band.YSize,
+                                         buf_xsize=b6_band.XSize, buf_ysize=b6_band.YSize, buf_type=data_type)
+        b7_array = b7_band.ReadAsArray(xoff=0, yoff=0, win_xsize=b7_band.XSize, win_ysize=b7_band.YSize,
+                                        buf_xsize=b7_band.XSize, buf_ysize=b7_band.YSize, buf_type=data_type)
+        b8a_array = b8a_band.ReadAsArray(xoff=0, yoff=0, win_xsize=b8a_band.XSize, win_ysize=b8a_band.YSize,
+                                         buf_xsize=b8a_band.XSize, buf_ysize=b8a_band.YSize, buf_type=data_type)
+        b11_array = b11_band.ReadAsArray(xoff=0, yoff=0, win_xsize=b11_band.XSize, win_ysize=b11_band.YSize,
+                                         buf_xsize=b11_band.XSize, buf_ysize=b11_band.YSize, buf_type=data_type)
+        b12_array = b12_band.ReadAsArray(xoff=0, yoff=0, win_xsize=b12_band.XSize, win_ysize=b12_band.YSize,
+                                         buf_xsize=b12_band.XSize, buf_ysize=b12_band.YSize, buf_type=data_type)
 
     #################################################################
     # 3. write image
@@ -248,12 +263,15 @@ def resolution_extract_20m(s2img_path, target_path, format='GTiff'):
     dst_ds.SetProjection(s2ds_sub2.GetProjection())
     dst_ds.SetGeoTransform(s2ds_sub2.GetGeoTransform())
     # dst_ds.GetRasterBand(1).SetNoDataValue(nodata_value)
-    dst_ds.GetRasterBand(1).WriteRaster(0, 0, img_shape[0], img_shape[1], b5_array.tobytes())
-    dst_ds.GetRasterBand(2).WriteRaster(0, 0, img_shape[0], img_shape[1], b6_array.tobytes())
-    dst_ds.GetRasterBand(3).WriteRaster(0, 0, img_shape[0], img_shape[1], b7_array.tobytes())
-    dst_ds.GetRasterBand(4).WriteRaster(0, 0, img_shape[0], img_shape[1], b8a_array.tobytes())
-    dst_ds.GetRasterBand(5).WriteRaster(0, 0, img_shape[0], img_shape[1], b11_array.tobytes())
-    dst_ds.GetRasterBand(6).WriteRaster(0, 0, img_shape[0], img_shape[1], b12_array.tobytes())
+    if streaming:
+        process_blocks(s2ds_sub2, dst_ds, None, block_size, src_bands=[1, 2, 3, 4, 5, 6])
+    else:
+        dst_ds.GetRasterBand(1).WriteRaster(0, 0, img_shape[0], img_shape[1], b5_array.tobytes())
+        dst_ds.GetRasterBand(2).WriteRaster(0, 0, img_shape[0], img_shape[1], b6_array.tobytes())
+        dst_ds.GetRasterBand(3).WriteRaster(0, 0, img_shape[0], img_shape[1], b7_array.tobytes())
+        dst_ds.GetRasterBand(4).WriteRaster(0, 0, img_shape[0], img_shape[1], b8a_array.tobytes())
+        dst_ds.GetRasterBand(5).WriteRaster(0, 0, img_shape[0], img_shape[1], b11_array.tobytes())
+        dst_ds.GetRasterBand(6).WriteRaster(0, 0, img_shape[0], img_shape[1], b12_array.tobytes())
 
     #################################################################
     # 4. close
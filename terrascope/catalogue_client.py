@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""
+Terrascope OpenSearch catalogue client, pages are fetched concurrently and cached on disk
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import json
+import time
+import hashlib
+import asyncio
+import argparse
+import threading
+import collections
+import concurrent.futures
+import requests
+
+
+TERRASCOPE_CATALOGUE = 'https://services.terrascope.be/catalogue'
+
+product_record = collections.namedtuple(
+    'product_record', ['id', 'title', 'date', 'tile_id', 'data', 'related', 'alternates', 'properties'])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Terrascope catalogue search')
+    parser.add_argument('--collection', required=False, type=str, default="urn:eop:VITO:TERRASCOPE_S2_FCOVER_V2",
+                        help='collection id')
+    parser.add_argument('--start', required=False, type=str, default="2021-03-01T00:00:00.000Z",
+                        help='start of the time window')
+    parser.add_argument('--end', required=False, type=str, default="2021-12-31T23:59:59.000Z",
+                        help='end of the time window')
+    parser.add_argument('--geometry', required=False, type=str, default=None,
+                        help='WKT geometry of the AOI')
+    parser.add_argument('--bbox', required=False, type=str, default=None,
+                        help='bbox of the AOI, west,south,east,north')
+    parser.add_argument('--tile-id', required=False, type=str, default=None,
+                        help='tile id, e.g. 30TUL')
+    parser.add_argument('--base-url', required=False, type=str, default=TERRASCOPE_CATALOGUE,
+                        help='catalogue endpoint')
+    parser.add_argument('--cache-dir', required=False, type=str,
+                        default=os.path.join(os.path.expanduser('~'), '.cache', 'terrascope'),
+                        help='folder of cached responses')
+    parser.add_argument('--ttl', required=False, type=float, default=24 * 3600,
+                        help='seconds a cached response stays valid, 0 disables the cache')
+    parser.add_argument('--target-list', required=False, type=str, default=None,
+                        help='write the data links of all products to this file, one for each line')
+    opts = parser.parse_args()
+    return opts
+
+
+class response_cache(object):
+    """
+    Catalogue responses on disk, one JSON file for each query keyed by the sha1 of the query,
+    expired after ttl seconds.
+    """
+    def __init__(self, cache_dir, ttl=24 * 3600):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        if cache_dir and ttl > 0 and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def query_key(url, params):
+        query = json.dumps([url, sorted((k, str(v)) for k, v in params.items())])
+        return hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        if not self.cache_dir or self.ttl <= 0:
+            return None
+        cache_path = self._path(key)
+        if not os.path.exists(cache_path) or (time.time() - os.path.getmtime(cache_path) > self.ttl):
+            return None
+        with open(cache_path, 'r', encoding='utf-8') as cache_file:
+            return json.load(cache_file)
+
+    def set(self, key, response_json):
+        if not self.cache_dir or self.ttl <= 0:
+            return
+        # write and rename, so that concurrent readers never see a partial file
+        temp_path = self._path(key) + '.{}.part'.format(threading.get_ident())
+        with open(temp_path, 'w', encoding='utf-8') as cache_file:
+            json.dump(response_json, cache_file)
+        os.replace(temp_path, self._path(key))
+
+    def clear(self):
+        for file in os.listdir(self.cache_dir):
+            if file.endswith('.json'):
+                os.remove(os.path.join(self.cache_dir, file))
+        # for
+
+
+def parse_product(feature):
+    """
+    product_record of one GeoJSON feature of the catalogue.
+    """
+    properties = feature.get('properties', {})
+    links = properties.get('links', {})
+    attributes = properties.get('additionalAttributes', {})
+    return product_record(
+        id=feature.get('id'),
+        title=properties.get('title'),
+        date=properties.get('date'),
+        tile_id=attributes.get('tileId', properties.get('tileId')),
+        data=[{'href': link.get('href'), 'length': link.get('length'), 'title': link.get('title')}
+              for link in links.get('data', [])],
+        related=[link.get('href') for link in links.get('related', [])],
+        alternates=[link.get('href') for link in links.get('alternates', [])],
+        properties=properties)
+
+
+class catalogue_client(object):
+    """
+    OpenSearch client of the Terrascope catalogue.
+    The first page gives totalResults, the remaining pages (startIndex/count) are fetched concurrently,
+    blocking requests run in a thread pool under asyncio. Responses are cached on disk by query.
+    """
+    def __init__(self, base_url=TERRASCOPE_CATALOGUE, cache_dir=None, ttl=24 * 3600, page_size=100,
+                 concurrency=8, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.cache = response_cache(cache_dir, ttl)
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._local = threading.local()
+        self.num_requests = 0
+
+    def _session(self):
+        # one session (and connection pool) for each worker thread
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def fetch_page(self, params):
+        """
+        One page of the products endpoint, from the cache if not expired.
+        """
+        url = self.base_url + '/products'
+        key = response_cache.query_key(url, params)
+        response_json = self.cache.get(key)
+        if response_json is not None:
+            return response_json
+
+        url_result = self._session().get(url, params=params, timeout=self.timeout)
+        self.num_requests += 1
+        if url_result.status_code != 200:
+            raise Exception('Catalogue error {} for {}'.format(url_result.status_code, url_result.url))
+
+        response_json = url_result.json()
+        self.cache.set(key, response_json)
+        return response_json
+
+    @staticmethod
+    def query_params(collection, start=None, end=None, geometry=None, bbox=None, tile_id=None, **extra):
+        params = {'collection': collection}
+        for name, value in (('start', start), ('end', end), ('geometry', geometry), ('bbox', bbox),
+                            ('tileId', tile_id)):
+            if value is not None:
+                params[name] = value
+        params.update(extra)
+        return params
+
+    async def search_async(self, collection, start=None, end=None, geometry=None, bbox=None, tile_id=None,
+                           **extra):
+        """
+        All products of a query in catalogue order.
+        :return: list of product_record
+        """
+        params = self.query_params(collection, start, end, geometry, bbox, tile_id, **extra)
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            async def fetch(start_index):
+                page_params = dict(params, startIndex=start_index, count=self.page_size)
+                async with semaphore:
+                    return await loop.run_in_executor(executor, self.fetch_page, page_params)
+
+            first_page = await fetch(1)
+            total_results = int(first_page.get('totalResults', len(first_page.get('features', []))))
+            start_indices = range(1 + self.page_size, total_results + 1, self.page_size)
+            pages = [first_page] + list(await asyncio.gather(*[fetch(idx) for idx in start_indices]))
+        # with
+
+        products = []
+        for page in pages:
+            products.extend(parse_product(feature) for feature in page.get('features', []))
+        # for
+        return products
+
+    def search(self, collection, start=None, end=None, geometry=None, bbox=None, tile_id=None, **extra):
+        """
+        Blocking wrapper of search_async().
+        """
+        return asyncio.run(self.search_async(collection, start, end, geometry, bbox, tile_id, **extra))
+
+
+def main():
+    print("###########################################################")
+    print("### Terrascope catalogue search ###########################")
+    print("###########################################################")
+
+    opts = parse_args()
+    client = catalogue_client(opts.base_url, opts.cache_dir, opts.ttl)
+
+    start_time = time.time()
+    products = client.search(opts.collection, opts.start, opts.end, opts.geometry, opts.bbox, opts.tile_id)
+    print("### {} products with {} requests in {:.1f}s".format(len(products), client.num_requests,
+                                                              time.time() - start_time))
+
+    for product in products:
+        print(product.title, product.date, [link['href'] for link in product.data])
+    # for
+
+    if opts.target_list:
+        with open(opts.target_list, 'w') as list_file:
+            for product in products:
+                for link in product.data:
+                    list_file.write(link['href'] + '\n')
+            # for
+        # with
+
+    print("### Task over #############################################")
+
+
+if __name__ == "__main__":
+    main()
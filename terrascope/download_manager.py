@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""
+Concurrent, resumable downloader of Terrascope products
+
+Author: Zhou Ya'nan
+Date: 2021-09-16
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+import concurrent.futures
+from urllib.parse import urlparse
+import requests
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Download manager for Terrascope products')
+    parser.add_argument('--url-list', required=False, type=str, default="./data/download_list.txt",
+                        help='file of urls, one for each line')
+    parser.add_argument('--target-folder', required=False, type=str, default="./data/products",
+                        help='folder of downloaded files')
+    parser.add_argument('--manifest', required=False, type=str, default=None,
+                        help='manifest of the downloads, default <target-folder>/manifest.json')
+    parser.add_argument('--workers', required=False, type=int, default=4,
+                        help='concurrent downloads')
+    parser.add_argument('--token', required=False, type=str, default=None,
+                        help='bearer token for protected products')
+    parser.add_argument('--retries', required=False, type=int, default=3,
+                        help='retries of a download, each resumes the partial file')
+    opts = parser.parse_args()
+    return opts
+
+
+def file_checksum(file_path, algorithm='md5'):
+    file_hash = hashlib.new(algorithm)
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def verify_file(file_path, size=None, checksum=None):
+    """
+    :param size: expected size in bytes, None to skip
+    :param checksum: expected '<algorithm>:<hex digest>' (e.g. 'md5:...'), None to skip
+    """
+    if (size is not None) and (os.path.getsize(file_path) != int(size)):
+        return False
+    if checksum:
+        algorithm, digest = checksum.split(':', 1) if ':' in checksum else ('md5', checksum)
+        if file_checksum(file_path, algorithm.lower()) != digest.lower():
+            return False
+    return True
+
+
+class download_manager(object):
+    """
+    Download files with a bounded pool of threads.
+    - Partial files (<target>.part) are resumed with HTTP Range requests.
+    - Size (given or from the response) and checksum are verified before the file is renamed to its target.
+    - Targets follow the host and path of the url, urls resolving to the same target are rejected.
+    - One requests.Session for each host, so connections are reused across files.
+    - A JSON manifest records finished downloads, reruns skip them and continue with the rest.
+    """
+    def __init__(self, target_folder, manifest_path=None, workers=4, headers=None, retries=3, timeout=60):
+        self.target_folder = target_folder
+        self.manifest_path = manifest_path or os.path.join(target_folder, 'manifest.json')
+        self.workers = workers
+        self.headers = headers or {}
+        self.retries = retries
+        self.timeout = timeout
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.bytes_downloaded = 0
+
+        if not os.path.exists(target_folder):
+            os.makedirs(target_folder)
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, 'r', encoding='utf-8') as manifest_file:
+            return json.load(manifest_file)
+
+    def _save_manifest(self):
+        # called with the lock held
+        temp_path = self.manifest_path + '.part'
+        with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=1)
+        os.replace(temp_path, self.manifest_path)
+
+    def _update_manifest(self, url, entry):
+        with self._lock:
+            self.manifest[url] = entry
+            self._save_manifest()
+
+    def _session(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                session.headers.update(self.headers)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+            return self._sessions[host]
+
+    def target_path(self, url):
+        """
+        <target folder>/<host>/<url path>, files of the same name in different collections do not collide.
+        """
+        parsed_url = urlparse(url)
+        parts = [part for part in parsed_url.path.split('/') if part not in ('', '.', '..')]
+        if not parts:
+            raise Exception('No file name in {}'.format(url))
+        return os.path.join(self.target_folder, parsed_url.netloc.replace(':', '_'), *parts)
+
+    def is_done(self, url):
+        entry = self.manifest.get(url)
+        return (entry is not None) and entry.get('status') == 'done' and os.path.exists(entry['target']) \
+            and os.path.getsize(entry['target']) == entry['size']
+
+    def _fetch(self, url, part_path):
+        """
+        Fetch the rest of the partial file, return the expected total size (None if unknown).
+        """
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else {}
+
+        with self._session(url).get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 416:
+                # range beyond the end, the partial file is already complete
+                return offset
+            if response.status_code not in (200, 206):
+                raise Exception('HTTP error {} for {}'.format(response.status_code, url))
+
+            if response.status_code == 200:
+                # server ignored the range, start over
+                offset = 0
+                content_range = None
+            else:
+                content_range = response.headers.get('Content-Range')
+
+            total_size = None
+            if content_range and '/' in content_range and not content_range.endswith('/*'):
+                total_size = int(content_range.rsplit('/', 1)[1])
+            elif response.headers.get('Content-Length') is not None:
+                total_size = offset + int(response.headers['Content-Length'])
+
+            with open(part_path, 'ab' if offset > 0 else 'wb') as part_file:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    part_file.write(chunk)
+                    with self._lock:
+                        self.bytes_downloaded += len(chunk)
+                # for
+            # with
+        # with
+        return total_size
+
+    def download(self, url, size=None, checksum=None, target_path=None):
+        """
+        Download one file with resume and verification.
+        :return: (url, target path, size in bytes, seconds)
+        """
+        target_path = target_path or self.target_path(url)
+        part_path = target_path + '.part'
+        os.makedirs(os.path.dirname(os.path.abspath(target_path)), exist_ok=True)
+        start_time = time.time()
+
+        for attempt in range(self.retries + 1):
+            try:
+                total_size = self._fetch(url, part_path)
+                expected_size = size if size is not None else total_size
+                if verify_file(part_path, expected_size, checksum):
+                    break
+                if (expected_size is not None) and os.path.getsize(part_path) < int(expected_size):
+                    raise Exception('Incomplete download of {}'.format(url))
+                # oversized or wrong checksum, the partial file cannot be trusted
+                os.remove(part_path)
+                raise Exception('Verification failed for {}'.format(url))
+            except Exception as e:
+                if attempt == self.retries:
+                    self._update_manifest(url, {'target': target_path, 'status': 'failed', 'error': str(e)})
+                    raise
+                print("### Retry {} of {}: {}".format(attempt + 1, url, e))
+        # for
+
+        os.replace(part_path, target_path)
+        file_size = os.path.getsize(target_path)
+        self._update_manifest(url, {'target': target_path, 'status': 'done', 'size': file_size,
+                                    'checksum': checksum})
+        return url, target_path, file_size, time.time() - start_time
+
+    def download_all(self, items):
+        """
+        :param items: urls, or dicts with 'href' and optional 'length', 'checksum', 'target'
+                      (e.g. the data links of catalogue_client products)
+        :return: dict with counts, bytes and seconds of the run
+        """
+        jobs = []
+        num_skipped = 0
+        target_urls = {}
+        for item in items:
+            item = {'href': item} if isinstance(item, str) else dict(item)
+            item['target'] = item.get('target') or self.target_path(item['href'])
+            if item['target'] in target_urls:
+                if target_urls[item['target']] == item['href']:
+                    # listed twice, one download is enough
+                    continue
+                raise Exception('{} and {} resolve to the same target {}'.format(
+                    target_urls[item['target']], item['href'], item['target']))
+            target_urls[item['target']] = item['href']
+
+            if self.is_done(item['href']):
+                num_skipped += 1
+                continue
+            jobs.append(item)
+        # for
+        print("### {} files to download, {} already done".format(len(jobs), num_skipped))
+
+        start_time = time.time()
+        self.bytes_downloaded = 0
+        num_done, num_failed = 0, 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            future_jobs = {executor.submit(self.download, job['href'], job.get('length'), job.get('checksum'),
+                                           job.get('target')): job for job in jobs}
+            for future in concurrent.futures.as_completed(future_jobs):
+                try:
+                    url, target_path, file_size, seconds = future.result()
+                except Exception as e:
+                    print("### Error @ {}: {}".format(future_jobs[future]['href'], e))
+                    num_failed += 1
+                    continue
+                num_done += 1
+                elapsed = max(time.time() - start_time, 1e-6)
+                print("### [{}/{}] {} ({:.1f} MB) in {:.1f}s, total {:.1f} MB/s".format(
+                    num_done, len(jobs), os.path.basename(target_path), file_size / 1e6, seconds,
+                    self.bytes_downloaded / 1e6 / elapsed))
+            # for
+        # with
+        elapsed = max(time.time() - start_time, 1e-6)
+
+        print("### Download over: {} done, {} skipped, {} failed, {:.1f} MB in {:.1f}s ({:.1f} MB/s)".format(
+            num_done, num_skipped, num_failed, self.bytes_downloaded / 1e6, elapsed,
+            self.bytes_downloaded / 1e6 / elapsed))
+        return {'done': num_done, 'skipped': num_skipped, 'failed': num_failed,
+                'bytes': self.bytes_downloaded, 'seconds': elapsed}
+
+
+def main():
+    print("###########################################################")
+    print("### Terrascope download manager ###########################")
+    print("###########################################################")
+
+    opts = parse_args()
+    with open(opts.url_list, 'r') as list_file:
+        urls = [line.strip() for line in list_file if line.strip()]
+
+    headers = {'Authorization': 'Bearer ' + opts.token} if opts.token else None
+    manager = download_manager(opts.target_folder, opts.manifest, opts.workers, headers, opts.retries)
+    manager.download_all(urls)
+
+    print("### Task over #############################################")
+
+
+if __name__ == "__main__":
+    main()
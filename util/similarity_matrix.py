@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""
+Similarity (Pearson, Spearman, cosine) matrices of many time series by blocked matrix multiplication
+
+Author: Zhou Ya'nan
+"""
+import os
+import time
+import datetime
+import argparse
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from scipy.stats import rankdata
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Similarity matrix of time series (columns of a CSV)')
+    parser.add_argument('--src-csv', required=False, type=str, default="./data/timeseries.csv",
+                        help='CSV of time series, one column for each series, no header')
+    parser.add_argument('--target-path', required=False, type=str, default="./data/similarity.npz",
+                        help='.npz (top-k sparse) or .npy (dense memmap) result')
+    parser.add_argument('--method', required=False, type=str, default="pearson",
+                        help='similarity in [pearson, spearman, cosine]')
+    parser.add_argument('--topk', required=False, type=int, default=20,
+                        help='neighbours kept for each series, 0 for the dense matrix')
+    parser.add_argument('--block-size', required=False, type=int, default=2048,
+                        help='series in one block of the matrix multiplication')
+    opts = parser.parse_args()
+    return opts
+
+
+def read_tsdata_array(csvdata_path, dtype=np.float32):
+    """
+    Time series as np.array (time, series), gaps filled forward along time as read_tsdata().
+    """
+    csvdata_pd = pd.read_csv(csvdata_path, header=None, dtype=dtype)
+    csvdata_pd = csvdata_pd.ffill(axis=0)
+    return csvdata_pd.to_numpy(dtype=dtype)
+
+
+def unit_columns(data_array, method='pearson'):
+    """
+    Columns scaled so that their dot products are the similarity.
+    pearson centres the columns, spearman does the same on ranks, cosine only normalises.
+    Remaining NaN count as the column mean, constant columns become zero (similarity 0).
+    """
+    data_array = np.asarray(data_array, dtype=np.float64)
+    if method == 'spearman':
+        data_array = rankdata(data_array, axis=0, nan_policy='omit')
+    elif method not in ('pearson', 'cosine'):
+        raise Exception("Method {} not supported, use one of [pearson, spearman, cosine]".format(method))
+
+    if method in ('pearson', 'spearman'):
+        data_array = data_array - np.nanmean(data_array, axis=0, keepdims=True)
+    data_array = np.where(np.isnan(data_array), 0, data_array)
+
+    norm = np.sqrt((data_array * data_array).sum(axis=0, keepdims=True))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        data_array = np.where(norm > 0, data_array / norm, 0)
+    return np.ascontiguousarray(data_array.T, dtype=np.float32)
+
+
+def similarity_blocks(unit_array, block_size=2048):
+    """
+    Row blocks of the similarity matrix, (start, np.array (rows, series) of float32).
+    :param unit_array: np.array (series, time) from unit_columns()
+    """
+    for start in range(0, unit_array.shape[0], block_size):
+        yield start, np.matmul(unit_array[start:start + block_size], unit_array.T)
+    # for
+
+
+def similarity_memmap(data_array, target_path, method='pearson', block_size=2048):
+    """
+    Dense float32 similarity matrix of the columns, written block by block to a .npy memmap.
+    """
+    unit_array = unit_columns(data_array, method)
+    num_series = unit_array.shape[0]
+
+    matrix = np.lib.format.open_memmap(target_path, mode='w+', dtype=np.float32, shape=(num_series, num_series))
+    for start, block in similarity_blocks(unit_array, block_size):
+        matrix[start:start + block.shape[0]] = block
+    # for
+    matrix.flush()
+    return matrix
+
+
+def similarity_topk(data_array, k=20, method='pearson', block_size=2048, absolute=False):
+    """
+    k most similar other series of each column, as sparse matrix.
+    :param absolute: rank by absolute similarity (strong negative correlation counts as similar)
+    :return: scipy.sparse.csr_matrix (series, series) with k entries in each row, k is capped at series - 1
+    """
+    unit_array = unit_columns(data_array, method)
+    num_series = unit_array.shape[0]
+    k = min(k, num_series - 1)
+    if k <= 0:
+        # a single series has no others
+        return scipy.sparse.csr_matrix((num_series, num_series), dtype=np.float32)
+
+    indices = np.zeros((num_series, k), dtype=np.int64)
+    values = np.zeros((num_series, k), dtype=np.float32)
+    for start, block in similarity_blocks(unit_array, block_size):
+        rows = np.arange(block.shape[0])
+        score = np.abs(block) if absolute else block.copy()
+        score[rows, start + rows] = -np.inf
+
+        top = np.argpartition(-score, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(score, top, axis=1), axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+
+        indices[start:start + block.shape[0]] = top
+        values[start:start + block.shape[0]] = np.take_along_axis(block, top, axis=1)
+    # for
+
+    indptr = np.arange(0, num_series * k + 1, k)
+    return scipy.sparse.csr_matrix((values.ravel(), indices.ravel(), indptr), shape=(num_series, num_series))
+
+
+def main():
+    now = datetime.datetime.now()
+    print("###########################################################")
+    print("### Time series similarity matrix #########################")
+    print("### ", now)
+    print("###########################################################")
+
+    opts = parse_args()
+    data_array = read_tsdata_array(opts.src_csv)
+    print("### {} series of {} steps".format(data_array.shape[1], data_array.shape[0]))
+
+    start_time = time.time()
+    if opts.topk > 0:
+        topk_matrix = similarity_topk(data_array, opts.topk, opts.method, opts.block_size)
+        scipy.sparse.save_npz(opts.target_path, topk_matrix)
+    else:
+        similarity_memmap(data_array, opts.target_path, opts.method, opts.block_size)
+    print("### {} similarity in {:.1f}s, saved to {}".format(opts.method, time.time() - start_time, opts.target_path))
+
+    print("### Task over #############################################")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,11 @@ Image operations
 Author: Zhou Ya'nan
 """
 import os
+import time
 import datetime
 import argparse
 import math
+import concurrent.futures
 import numpy as np
 import pandas as pd
 import seaborn as sns
@@ -22,6 +24,26 @@ from PyEMD import EMD, EEMD, CEEMDAN
 import pylab as plt
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='Decomposition of time series (columns of a CSV)')
+    parser.add_argument('--src-csv', required=False, type=str, default=None,
+                        help='CSV of time series, one column for each series, no header')
+    parser.add_argument('--target-prefix', required=False, type=str, default="./data/decompose",
+                        help='prefix of the .npy outputs')
+    parser.add_argument('--method', required=False, type=str, default="stl",
+                        help='decomposition in [stl, emd]')
+    parser.add_argument('--period', required=False, type=int, default=365,
+                        help='period of the seasonal component for stl')
+    parser.add_argument('--max-imfs', required=False, type=int, default=8,
+                        help='IMFs kept for emd (including the residue), extra ones are added to the last')
+    parser.add_argument('--workers', required=False, type=int, default=os.cpu_count(),
+                        help='number of processes')
+    parser.add_argument('--chunk-size', required=False, type=int, default=64,
+                        help='series in one task')
+    opts = parser.parse_args()
+    return opts
+
+
 def read_tsdata(csvdata_path):
     csvdata_pd = pd.read_csv(csvdata_path, header=None)
 
@@ -66,15 +88,118 @@ def timeseries_decompose_emd(tsdata):
     return IMFs
 
 
-def merge_decomposition(src_folder, tag_folder):
+# output components of each method, written to <target_prefix>_<component>.npy
+decompose_components = {'stl': ('trend', 'seasonal', 'resid'), 'emd': ('imfs',)}
+
+
+def decompose_output_paths(target_prefix, method):
+    return {component: "{}_{}.npy".format(target_prefix, component) for component in decompose_components[method]}
+
+
+def _decompose_chunk(job):
+    """
+    Decompose the series (columns) of one chunk in a worker process and write them into the output memmaps.
+    :return: (start, number of series, list of (column, error) for failed series)
+    """
+    chunk_data, start, method, period, max_imfs, output_paths = job
+    outputs = {component: np.load(path, mmap_mode='r+') for component, path in output_paths.items()}
+    num_imfs = np.zeros(chunk_data.shape[1], dtype=np.int16)
+    failed = []
+
+    for idx in range(chunk_data.shape[1]):
+        tsdata = chunk_data[:, idx]
+        try:
+            if method == 'stl':
+                result = timeseries_decompose_stl(tsdata, period)
+                outputs['trend'][:, start + idx] = result.trend
+                outputs['seasonal'][:, start + idx] = result.seasonal
+                outputs['resid'][:, start + idx] = result.resid
+            else:
+                imfs = timeseries_decompose_emd(tsdata)
+                if imfs.shape[0] > max_imfs:
+                    # keep the sum of components, the last slot holds the remaining slow modes
+                    imfs = np.concatenate((imfs[:max_imfs - 1], imfs[max_imfs - 1:].sum(axis=0, keepdims=True)))
+                outputs['imfs'][:imfs.shape[0], :, start + idx] = imfs
+                num_imfs[idx] = imfs.shape[0]
+        except Exception as e:
+            # NaN tells a failed series apart from a real all-zero decomposition
+            for output in outputs.values():
+                output[..., start + idx] = np.nan
+            failed.append((start + idx, str(e)))
+    # for
 
+    for output in outputs.values():
+        output.flush()
+    return start, num_imfs, failed
+
+
+def batch_decompose(data_array, target_prefix, method='stl', period=365, max_imfs=8, workers=None, chunk_size=64):
+    """
+    Decompose many series (columns of data_array) in a process pool, chunk by chunk,
+    each worker writes its columns straight into preallocated .npy memmaps:
+    stl -> <target_prefix>_trend.npy, _seasonal.npy, _resid.npy of shape (time, series),
+    emd -> <target_prefix>_imfs.npy of shape (max_imfs, time, series), zero padded,
+           with the number of IMFs of each series in <target_prefix>_num_imfs.npy.
+    Outputs are Fortran-ordered like merge_decomposition(), series which failed are NaN.
+    :param data_array: np.array (time, series) without gaps
+    :return: dict of output paths
+    """
+    if method not in decompose_components:
+        raise Exception("Method {} not supported, use one of {}".format(method, list(decompose_components.keys())))
+
+    data_array = np.asarray(data_array, dtype=np.float64)
+    num_time, num_series = data_array.shape
+    output_paths = decompose_output_paths(target_prefix, method)
+    for component, path in output_paths.items():
+        shape = (num_time, num_series) if method == 'stl' else (max_imfs, num_time, num_series)
+        # Fortran order keeps each series contiguous, as workers write one column at a time
+        output = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape, fortran_order=True)
+        del output
+    # for
+    num_imfs = np.zeros(num_series, dtype=np.int16)
+
+    jobs = [(data_array[:, start:start + chunk_size], start, method, period, max_imfs, output_paths)
+            for start in range(0, num_series, chunk_size)]
+    start_time = time.time()
+    num_done, num_failed = 0, 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for start, chunk_imfs, failed in executor.map(_decompose_chunk, jobs):
+            num_imfs[start:start + len(chunk_imfs)] = chunk_imfs
+            num_done += len(chunk_imfs)
+            num_failed += len(failed)
+            for column, error in failed:
+                print("### Error @ series {}: {}".format(column, error))
+            print("### {}/{} series, {:.1f} series/s".format(num_done, num_series,
+                                                             num_done / max(time.time() - start_time, 1e-6)))
+        # for
+    # with
+
+    if method == 'emd':
+        output_paths['num_imfs'] = "{}_num_imfs.npy".format(target_prefix)
+        np.save(output_paths['num_imfs'], num_imfs)
+
+    print("### Decomposition over: {} series ({} failed) in {:.1f}s".format(num_done, num_failed,
+                                                                           time.time() - start_time))
+    return output_paths
+
+
+def merge_decomposition(src_folder, tag_folder, format='npy', csv_chunk_rows=4096):
+    """
+    Regroup decomposition files (one (components, time) CSV for each series) into one file for each component,
+    compose_<component>.npy (or .csv) of shape (time, series).
+    Inputs are read one at a time and written into Fortran-ordered memmaps, so a column (series) is a
+    contiguous write and memory does not grow with the number of files.
+    :param format: 'npy' keeps the memmaps (float32), 'csv' also exports them in row chunks and removes them
+                   (float64, so that large-magnitude series keep their digits in the export)
+    :param csv_chunk_rows: rows of one CSV write
+    :return: list of output paths
+    """
     file_list = []
 
-    item_list = os.listdir(src_folder)
+    item_list = sorted(os.listdir(src_folder))
     for item_path in item_list:
         abs_path = os.path.join(src_folder, item_path)
         if os.path.isfile(abs_path):
-            print(abs_path)
             file_list.append(abs_path)
         # if
     # for
@@ -84,24 +209,57 @@ def merge_decomposition(src_folder, tag_folder):
     csvdata = pd.read_csv(file_list[0], header=None).to_numpy()
     row, col = csvdata.shape
 
-    all_data = np.zeros((num_data, row, col))
+    dtype = np.float64 if format == 'csv' else np.float32
+    npy_paths = [os.path.join(tag_folder, "compose_{}.npy".format(idx)) for idx in range(row)]
+    outputs = [np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(col, num_data),
+                                         fortran_order=True) for path in npy_paths]
+
+    start_time = time.time()
     for idx, path in enumerate(file_list):
-        csvdata = pd.read_csv(path, header=None).to_numpy()
-        all_data[idx] = csvdata
+        csvdata = pd.read_csv(path, header=None, dtype=dtype).to_numpy()
+        if csvdata.shape != (row, col):
+            raise Exception("Shape {} of {} differs from {}".format(csvdata.shape, path, (row, col)))
+        for rr in range(row):
+            outputs[rr][:, idx] = csvdata[rr]
+        # for
+        if (idx + 1) % 1000 == 0:
+            print("### Merged {}/{} files, {:.1f} files/s".format(idx + 1, num_data,
+                                                                  (idx + 1) / max(time.time() - start_time, 1e-6)))
     # for
+    for output in outputs:
+        output.flush()
+    del outputs
+
+    if format != 'csv':
+        return npy_paths
 
-    all_data = all_data.transpose(1, 0, 2)
-    for idx in range(row):
+    csv_paths = []
+    for idx, npy_path in enumerate(npy_paths):
         tag_path = os.path.join(tag_folder, "compose_{}.csv".format(idx))
-        np.savetxt(tag_path, all_data[idx].T, fmt='%.4f', delimiter=',')
+        compose = np.load(npy_path, mmap_mode='r')
+        with open(tag_path, 'w') as tag_file:
+            for chunk_start in range(0, compose.shape[0], csv_chunk_rows):
+                np.savetxt(tag_file, compose[chunk_start:chunk_start + csv_chunk_rows], fmt='%.4f', delimiter=',')
+        # with
+        del compose
+        os.remove(npy_path)
+        csv_paths.append(tag_path)
     # for
 
-    pass
+    return csv_paths
 
 
 def main():
     print("### Time Series Similiarity ###########################################")
 
+    opts = parse_args()
+    if opts.src_csv:
+        csv_data = read_tsdata(opts.src_csv).to_numpy()
+        batch_decompose(csv_data, opts.target_prefix, opts.method, opts.period, opts.max_imfs, opts.workers,
+                        opts.chunk_size)
+        print('### Task over!')
+        return
+
     # tscsv_path = 'D:/flow_2012_2021.csv'
     # csv_data = read_tsdata(tscsv_path).to_numpy()
     #
@@ -116,7 +274,7 @@ def main():
     src_folder = './streamflow-emd/compose_adjust/'
     tag_folder = './streamflow-emd/'
 
-    merge_decomposition(src_folder, tag_folder)
+    merge_decomposition(src_folder, tag_folder, format='csv')
 
     print('### Task over!')
 
@@ -6,9 +6,12 @@ Image operations
 Author: Zhou Ya'nan
 """
 import os
+import time
 import datetime
 import argparse
 import math
+import tempfile
+import concurrent.futures
 import numpy as np
 import pandas as pd
 import seaborn as sns
@@ -59,23 +62,236 @@ def calculate_dtw(x, y, dist=None):
     return dist
 
 
-def dtw_matrix(data_array):
+def dtw_batch(x_batch, y_batch, window=None):
+    """
+    DTW distances (accumulated absolute cost) of many pairs of equal-length series at once.
+    Rows of the cost matrix are filled in turn for all pairs, the left-to-right dependency inside a row
+    D[i,j] = c[i,j] + min(D[i-1,j-1], D[i-1,j], D[i,j-1]) is resolved with the prefix trick
+    D[i,j] = S[j] + min_{k<=j}(t[k] - S[k]), S the prefix sum of c[i,:] and t[k] = c[i,k] + min(D[i-1,k-1], D[i-1,k]).
+    :param x_batch: np.array (pairs, length)
+    :param y_batch: np.array (pairs, length)
+    :param window: Sakoe-Chiba band half width, None for no constraint
+    :return: np.array (pairs,)
+    """
+    x_batch = np.atleast_2d(np.asarray(x_batch, dtype=np.float64))
+    y_batch = np.atleast_2d(np.asarray(y_batch, dtype=np.float64))
+    num_pairs, length = x_batch.shape
+    if window is None:
+        window = length
+
+    prev_row = np.full((num_pairs, length + 1), np.inf)
+    prev_row[:, 0] = 0
+    for i in range(length):
+        lo, hi = max(0, i - window), min(length, i + window + 1)
+        cost = np.abs(x_batch[:, i:i + 1] - y_batch[:, lo:hi])
+        diag_up = np.minimum(prev_row[:, lo:hi], prev_row[:, lo + 1:hi + 1])
+        prefix = np.cumsum(cost, axis=1)
+
+        row = np.full((num_pairs, length + 1), np.inf)
+        row[:, lo + 1:hi + 1] = np.minimum.accumulate(cost + diag_up - prefix, axis=1) + prefix
+        prev_row = row
+    # for
+
+    return prev_row[:, length]
+
+
+def condensed_pairs(num_series, start, end):
+    """
+    (i, j) with i < j of condensed indices [start, end), in the order of scipy pdist.
+    """
+    c = np.arange(start, end, dtype=np.int64)
+    n = num_series
+    i = (n - 2 - np.floor(np.sqrt(-8 * c + 4 * n * (n - 1) - 7) / 2.0 - 0.5)).astype(np.int64)
+    j = (c + i + 1 - n * (n - 1) // 2 + (n - i) * ((n - i) - 1) // 2).astype(np.int64)
+    return i, j
+
+
+def lb_kim(query, candidates):
+    """
+    Lower bound from the end points, which every warping path matches.
+    """
+    return np.abs(candidates[:, 0] - query[0]) + np.abs(candidates[:, -1] - query[-1])
+
+
+def dtw_envelope(series, window=None):
+    """
+    Upper and lower envelopes (series, length) within the Sakoe-Chiba band.
+    """
+    length = series.shape[1]
+    if window is None or window >= length:
+        return (np.repeat(series.max(axis=1, keepdims=True), length, axis=1),
+                np.repeat(series.min(axis=1, keepdims=True), length, axis=1))
+
+    padded = np.pad(series, ((0, 0), (window, window)), mode='edge')
+    upper = np.lib.stride_tricks.sliding_window_view(padded, 2 * window + 1, axis=1).max(axis=2)
+    lower = np.lib.stride_tricks.sliding_window_view(padded, 2 * window + 1, axis=1).min(axis=2)
+    return upper, lower
+
+
+def lb_keogh(query, upper, lower):
+    """
+    LB_Keogh of the query against the envelopes of candidates, every sample of the query is matched
+    at least once within the band, so its distance to the envelope lower-bounds the accumulated cost.
+    """
+    return (np.maximum(query[np.newaxis, :] - upper, 0) + np.maximum(lower - query[np.newaxis, :], 0)).sum(axis=1)
+
+
+_dtw_worker = {}
+
+
+def _init_dtw_worker(series, window, condensed_path=None):
+    _dtw_worker['series'] = series
+    _dtw_worker['window'] = window
+    if condensed_path is not None:
+        _dtw_worker['condensed'] = np.load(condensed_path, mmap_mode='r+')
+    if 'envelope' in _dtw_worker:
+        del _dtw_worker['envelope']
+
+
+def _dtw_condensed_block(block):
+    """
+    DTW of condensed indices [start, end), written to the memory-mapped matrix of the worker.
+    """
+    start, end, batch_pairs = block
+    series, window = _dtw_worker['series'], _dtw_worker['window']
+    condensed = _dtw_worker['condensed']
+    for batch_start in range(start, end, batch_pairs):
+        batch_end = min(end, batch_start + batch_pairs)
+        i, j = condensed_pairs(series.shape[0], batch_start, batch_end)
+        condensed[batch_start:batch_end] = dtw_batch(series[i], series[j], window)
+    # for
+    condensed.flush()
+    return end - start
+
+
+def _dtw_knn_block(block):
+    """
+    k nearest neighbours of queries [start, end), candidates are visited in order of their lower bound
+    and the exact DTW is skipped once the lower bound exceeds the current k-th distance.
+    """
+    start, end, k, batch_pairs = block
+    series, window = _dtw_worker['series'], _dtw_worker['window']
+    if 'envelope' not in _dtw_worker:
+        _dtw_worker['envelope'] = dtw_envelope(series, window)
+    upper, lower = _dtw_worker['envelope']
+
+    num_series = series.shape[0]
+    knn_index = np.full((end - start, k), -1, dtype=np.int64)
+    knn_dist = np.full((end - start, k), np.inf)
+    num_computed = 0
+    for qq in range(start, end):
+        query = series[qq]
+        lower_bound = np.maximum(lb_kim(query, series), lb_keogh(query, upper, lower))
+        lower_bound[qq] = np.inf
+        order = np.argsort(lower_bound)[:num_series - 1]
+
+        best_index, best_dist = np.zeros(0, dtype=np.int64), np.zeros(0)
+        for batch_start in range(0, len(order), batch_pairs):
+            kth_dist = best_dist[k - 1] if len(best_dist) >= k else np.inf
+            batch = order[batch_start:batch_start + batch_pairs]
+            batch = batch[lower_bound[batch] < kth_dist]
+            if len(batch) == 0:
+                break
+
+            dist = dtw_batch(np.repeat(query[np.newaxis, :], len(batch), axis=0), series[batch], window)
+            num_computed += len(batch)
+            best_index = np.concatenate((best_index, batch))
+            best_dist = np.concatenate((best_dist, dist))
+            keep = np.argsort(best_dist, kind='stable')[:k]
+            best_index, best_dist = best_index[keep], best_dist[keep]
+        # for
+
+        knn_index[qq - start, :len(best_index)] = best_index
+        knn_dist[qq - start, :len(best_dist)] = best_dist
+    # for
+
+    return start, knn_index, knn_dist, num_computed
+
+
+def dtw_condensed_memmap(series, target_path, window=None, workers=None, block_pairs=200000, batch_pairs=4096):
+    """
+    Condensed DTW distance matrix (scipy pdist order) of all pairs of series, written to a .npy memmap.
+    Blocks of pairs are spread over a process pool, each worker writes its block in place.
+    :param series: np.array (num_series, length)
+    :param target_path: .npy file, open with np.load(target_path, mmap_mode='r')
+    :param window: Sakoe-Chiba band half width, None for no constraint
+    :return: np.memmap of the condensed matrix
+    """
+    series = np.ascontiguousarray(series, dtype=np.float64)
+    num_series = series.shape[0]
+    num_pairs = num_series * (num_series - 1) // 2
+
+    condensed = np.lib.format.open_memmap(target_path, mode='w+', dtype=np.float64, shape=(num_pairs,))
+    del condensed
+
+    blocks = [(start, min(num_pairs, start + block_pairs), batch_pairs) for start in range(0, num_pairs, block_pairs)]
+    start_time = time.time()
+    num_done = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_dtw_worker,
+                                                initargs=(series, window, target_path)) as executor:
+        for num_block_pairs in executor.map(_dtw_condensed_block, blocks):
+            num_done += num_block_pairs
+            print("### DTW {}/{} pairs, {:.0f} pairs/s".format(num_done, num_pairs,
+                                                                num_done / max(time.time() - start_time, 1e-6)))
+        # for
+    # with
+
+    return np.load(target_path, mmap_mode='r')
+
+
+def dtw_knn(series, k=5, window=None, workers=None, block_queries=64, batch_pairs=64):
+    """
+    k nearest neighbours of each series by DTW, pruned with LB_Kim and LB_Keogh.
+    :param series: np.array (num_series, length)
+    :return: (np.array (num_series, k) of neighbour indices, np.array (num_series, k) of distances)
+    """
+    series = np.ascontiguousarray(series, dtype=np.float64)
+    num_series = series.shape[0]
+    k = min(k, num_series - 1)
+
+    knn_index = np.zeros((num_series, k), dtype=np.int64)
+    knn_dist = np.zeros((num_series, k))
+    blocks = [(start, min(num_series, start + block_queries), k, batch_pairs)
+              for start in range(0, num_series, block_queries)]
+    num_computed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_dtw_worker,
+                                                initargs=(series, window)) as executor:
+        for start, block_index, block_dist, block_computed in executor.map(_dtw_knn_block, blocks):
+            knn_index[start:start + len(block_index)] = block_index
+            knn_dist[start:start + len(block_dist)] = block_dist
+            num_computed += block_computed
+        # for
+    # with
+
+    print("### DTW k-NN: {} of {} pairs computed after pruning".format(num_computed, num_series * (num_series - 1)))
+    return knn_index, knn_dist
+
+
+def dtw_matrix(data_array, window=None, workers=None, matrix_path=None):
     """
     DTW distance between two columns.
     :param data_array:
+    :param window: Sakoe-Chiba band half width, None for no constraint
+    :param workers: number of processes
+    :param matrix_path: .npy file of the condensed matrix, kept; a temporary file removed afterwards if None
     :return:
     """
     num_note = data_array.shape[1]
-    similar_matrix = np.zeros([num_note, num_note])
-    for c1 in range(0,num_note):
-        ts1 = data_array[:, c1].reshape(-1, 1)
-        for c2 in range(0,c1):
-            ts2 = data_array[:, c2].reshape(-1, 1)
-            dist = calculate_dtw(ts1, ts2)
-            similar_matrix[c1][c2] = dist
-            similar_matrix[c2][c1] = dist
-        # for
-    # for
+    series = np.asarray(data_array, dtype=np.float64).T
+
+    # the temporary folder (and the condensed matrix in it) is removed also when the computation fails
+    with tempfile.TemporaryDirectory(prefix='dtw_') as temp_folder:
+        condensed_path = matrix_path or os.path.join(temp_folder, 'dtw_condensed.npy')
+        condensed = dtw_condensed_memmap(series, condensed_path, window, workers)
+        try:
+            similar_matrix = np.zeros([num_note, num_note])
+            c1, c2 = np.triu_indices(num_note, 1)
+            similar_matrix[c1, c2] = condensed
+            similar_matrix[c2, c1] = condensed
+        finally:
+            # release the memmap before the folder is removed
+            del condensed
+    # with
     return similar_matrix
 
 
@@ -112,6 +328,10 @@ def correlation_matrix(data_array, method="pearson"):
 
 
 def write_similiarity_matrix(matrix_path, similiar_matrix):
+    # binary .npy is far smaller and faster than text for wide matrices, see similarity_matrix.py
+    if matrix_path.endswith('.npy'):
+        np.save(matrix_path, np.asarray(similiar_matrix, dtype=np.float32))
+        return
     np.savetxt(matrix_path, similiar_matrix, fmt='%.4f', delimiter=',')
 
 
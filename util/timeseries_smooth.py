@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+"""
+Savitzky-Golay smoothing of many time series at once, for raster stacks and tables
+
+Gaps are filled by linear interpolation, then the series are pulled up to the upper envelope
+of the fit (TIMESAT-style), as drops in NDVI are mostly clouds and other noise.
+
+Author: Zhou Ya'nan
+"""
+import os
+import sys
+import time
+import datetime
+import argparse
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from scipy.signal import savgol_filter
+from osgeo import gdal
+gdal.UseExceptions()
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'raster'))
+from block_io import DEFAULT_BLOCK_SIZE, block_windows, read_block
+from batch_runner import bounded_completed
+
+
+INT16_NODATA = -32768
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Savitzky-Golay smoothing of a raster stack or a CSV table')
+    parser.add_argument('--src-path', required=False, type=str, default="./data/ndvi_stack.tif",
+                        help='multi-band raster (one band for each date) or CSV (one row for each series)')
+    parser.add_argument('--target-path', required=False, type=str, default="./data/ndvi_stack_sg.tif",
+                        help='smoothed raster or CSV')
+    parser.add_argument('--window-length', required=False, type=int, default=7,
+                        help='window length of the filter, odd')
+    parser.add_argument('--polyorder', required=False, type=int, default=3,
+                        help='order of the fitted polynomial')
+    parser.add_argument('--iterations', required=False, type=int, default=3,
+                        help='upper envelope iterations, 0 for a plain filter of the gap filled series')
+    parser.add_argument('--dtype', required=False, type=str, default="float32",
+                        help='output type in [float32, int16]')
+    parser.add_argument('--int16-scale', required=False, type=float, default=10000,
+                        help='values are multiplied by this before rounding to int16, '
+                             '10000 for NDVI in [-1, 1], at most 100 for digital numbers up to 255')
+    parser.add_argument('--prefix-columns', required=False, type=int, default=7,
+                        help='leading non time series columns of the CSV')
+    parser.add_argument('--workers', required=False, type=int, default=4,
+                        help='processes, each working on one window at a time')
+    parser.add_argument('--block-size', required=False, type=int, default=DEFAULT_BLOCK_SIZE[0],
+                        help='window edge in pixels')
+    opts = parser.parse_args()
+    return opts
+
+
+def interpolate_gaps(data_array):
+    """
+    Linear interpolation of NaN along the rows, leading and trailing gaps take the nearest value.
+    Rows without any value stay NaN.
+    :param data_array: np.array (series, time)
+    """
+    data_array = np.array(data_array, dtype=np.float64)
+    num_series, num_time = data_array.shape
+    valid = ~np.isnan(data_array)
+    time_index = np.broadcast_to(np.arange(num_time), data_array.shape)
+
+    # index of the previous and next valid value of every position, -1 / num_time if none
+    prev_index = np.maximum.accumulate(np.where(valid, time_index, -1), axis=1)
+    next_index = np.minimum.accumulate(np.where(valid, time_index, num_time)[:, ::-1], axis=1)[:, ::-1]
+    prev_index = np.where(prev_index < 0, next_index, prev_index)
+    next_index = np.where(next_index >= num_time, prev_index, next_index)
+
+    empty = prev_index >= num_time
+    prev_index[empty], next_index[empty] = 0, 0
+    prev_value = np.take_along_axis(data_array, prev_index, axis=1)
+    next_value = np.take_along_axis(data_array, next_index, axis=1)
+    span = next_index - prev_index
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = np.where(span > 0, (time_index - prev_index) / span, 0)
+    filled = prev_value + fraction * (next_value - prev_value)
+    filled[empty] = np.nan
+    return filled
+
+
+def sg_smooth_block(data_array, window_length=7, polyorder=3, iterations=3):
+    """
+    Savitzky-Golay smoothing of a block of series along axis 1.
+    Gaps are interpolated first. In each iteration values below the fit (and all gap values) are
+    replaced by the fit and the series is filtered again, so the result follows the upper envelope.
+    :param data_array: np.array (series, time), NaN for missing observations
+    :return: np.array (series, time) of float64, NaN for series without any value
+    """
+    data_array = np.asarray(data_array, dtype=np.float64)
+    if data_array.shape[1] < window_length:
+        raise Exception("Window length {} longer than the series ({})".format(window_length, data_array.shape[1]))
+
+    observed = ~np.isnan(data_array)
+    series = interpolate_gaps(data_array)
+    empty = np.isnan(series[:, 0])
+    series[empty] = 0
+
+    fitted = savgol_filter(series, window_length, polyorder, axis=1)
+    for it in range(iterations):
+        series = np.where(observed & (series >= fitted), series, fitted)
+        fitted = savgol_filter(series, window_length, polyorder, axis=1)
+    # for
+
+    fitted[empty] = np.nan
+    return fitted
+
+
+def to_output_type(data_array, dtype='float32', int16_scale=10000):
+    """
+    float32, or int16 of round(value * int16_scale) with INT16_NODATA for NaN.
+    The default scale suits NDVI in [-1, 1], digital numbers (e.g. PROBA-V NDVI 0-250) need a scale of 100 or less;
+    values out of the int16 range raise instead of being clipped.
+    """
+    if dtype == 'float32':
+        return data_array.astype(np.float32)
+    if dtype != 'int16':
+        raise Exception("Output type {} not supported, use one of [float32, int16]".format(dtype))
+    scaled = np.round(data_array * int16_scale)
+    with np.errstate(invalid='ignore'):
+        num_clipped = int(np.sum((scaled < INT16_NODATA + 1) | (scaled > 32767)))
+    if num_clipped > 0:
+        raise Exception("{} values out of the int16 range with scale {} (data range {:.4g} to {:.4g}), "
+                        "use a smaller --int16-scale".format(num_clipped, int16_scale, np.nanmin(data_array),
+                                                             np.nanmax(data_array)))
+    return np.where(np.isnan(scaled), INT16_NODATA, scaled).astype(np.int16)
+
+
+def _smooth_window_job(src_path, window, window_length, polyorder, iterations, dtype, int16_scale):
+    # datasets can not be pickled, each task opens the stack itself
+    src_ds = gdal.Open(src_path, gdal.GA_ReadOnly)
+    nodata = src_ds.GetRasterBand(1).GetNoDataValue()
+    block_array = read_block(src_ds, window, with_halo=False).astype(np.float64)
+    del src_ds
+
+    num_dates, ysize, xsize = block_array.shape
+    if nodata is not None:
+        block_array[block_array == nodata] = np.nan
+    smoothed = sg_smooth_block(block_array.reshape(num_dates, -1).T, window_length, polyorder, iterations)
+    smoothed = to_output_type(smoothed, dtype, int16_scale)
+    return window, smoothed.T.reshape(num_dates, ysize, xsize)
+
+
+def sg_smooth_raster(src_path, target_path, window_length=7, polyorder=3, iterations=3, dtype='float32',
+                     int16_scale=10000, workers=4, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Smooth every pixel of a stack (one band for each date), windows are processed in parallel.
+    int16 outputs carry scale 1/int16_scale in the band metadata, a window out of the int16 range
+    aborts the run and removes the partial target instead of leaving nodata holes.
+    :return: dict with counts and seconds of the run
+    """
+    src_ds = gdal.Open(src_path, gdal.GA_ReadOnly)
+    if not src_ds:
+        raise Exception("Unable to open image {}".format(src_path))
+    num_dates = src_ds.RasterCount
+
+    file_driver = gdal.GetDriverByName('GTiff')
+    data_type = gdal.GDT_Int16 if dtype == 'int16' else gdal.GDT_Float32
+    dst_ds = file_driver.Create(target_path, xsize=src_ds.RasterXSize, ysize=src_ds.RasterYSize, bands=num_dates,
+                                eType=data_type, options=['TILED=YES', 'COMPRESS=DEFLATE', 'INTERLEAVE=BAND'])
+    if not dst_ds:
+        raise Exception("Fail to create image {}".format(target_path))
+    dst_ds.SetProjection(src_ds.GetProjection())
+    dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    for bb in range(1, num_dates + 1):
+        dst_band = dst_ds.GetRasterBand(bb)
+        if dtype == 'int16':
+            dst_band.SetNoDataValue(INT16_NODATA)
+            dst_band.SetScale(1.0 / int16_scale)
+        else:
+            dst_band.SetNoDataValue(np.nan)
+    # for
+    num_windows = len(list(block_windows(src_ds, block_size)))
+
+    start_time = time.time()
+    num_done, num_failed, num_pixels = 0, 0, 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # a few windows in flight for each worker, results are released once written
+        jobs = ((src_path, window, window_length, polyorder, iterations, dtype, int16_scale)
+                for window in block_windows(src_ds, block_size))
+        for job, future in bounded_completed(executor, _smooth_window_job, jobs, 2 * workers):
+            try:
+                window, smoothed = future.result()
+            except Exception as e:
+                print("### Error @ window {}: {}".format(job[1], e))
+                num_failed += 1
+                if dtype == 'int16':
+                    # values out of range would be lost silently as nodata
+                    del dst_ds
+                    os.remove(target_path)
+                    raise Exception("Smoothing of {} aborted, {} removed".format(src_path, target_path)) from e
+                continue
+            for bb in range(num_dates):
+                dst_ds.GetRasterBand(bb + 1).WriteArray(smoothed[bb], window.xoff, window.yoff)
+            num_done += 1
+            num_pixels += window.xsize * window.ysize
+            if num_done % 50 == 0:
+                print("### [{}/{}] windows, {:.0f} pixels/s".format(
+                    num_done, num_windows, num_pixels / max(time.time() - start_time, 1e-6)))
+        # for
+    # with
+    elapsed = max(time.time() - start_time, 1e-6)
+
+    dst_ds.FlushCache()
+    del dst_ds, src_ds
+
+    print("### Smoothing over: {} windows, {} failed, {} pixels x {} dates in {:.1f}s ({:.0f} pixels/s)".format(
+        num_done, num_failed, num_pixels, num_dates, elapsed, num_pixels / elapsed))
+    return {'done': num_done, 'failed': num_failed, 'pixels': num_pixels, 'seconds': elapsed}
+
+
+def sg_smooth_csv(src_csv, target_csv, prefix_columns=7, window_length=7, polyorder=3, iterations=3,
+                  dtype='float32', int16_scale=10000, chunk_rows=200000):
+    """
+    Smooth a table of series (one row for each series after prefix_columns), chunk by chunk.
+    Prefix columns are copied, empty cells count as gaps.
+    :return: number of series
+    """
+    num_rows = 0
+    start_time = time.time()
+    for data_pd in pd.read_csv(src_csv, header=0, chunksize=chunk_rows):
+        smoothed = sg_smooth_block(data_pd.iloc[:, prefix_columns:].to_numpy(dtype=np.float64), window_length,
+                                   polyorder, iterations)
+        smoothed_pd = pd.DataFrame(to_output_type(smoothed, dtype, int16_scale), index=data_pd.index,
+                                   columns=data_pd.columns[prefix_columns:])
+        data_pd = pd.concat((data_pd.iloc[:, :prefix_columns], smoothed_pd), axis=1)
+
+        data_pd.to_csv(target_csv, mode='w' if num_rows == 0 else 'a', header=(num_rows == 0), index=False)
+        num_rows += len(data_pd)
+        print("### {} series, {:.0f} series/s".format(num_rows, num_rows / max(time.time() - start_time, 1e-6)))
+    # for
+    return num_rows
+
+
+def main():
+    now = datetime.datetime.now()
+    print("###########################################################")
+    print("### Savitzky-Golay smoothing ##############################")
+    print("### ", now)
+    print("###########################################################")
+
+    opts = parse_args()
+    if opts.src_path.lower().endswith('.csv'):
+        sg_smooth_csv(opts.src_path, opts.target_path, opts.prefix_columns, opts.window_length, opts.polyorder,
+                      opts.iterations, opts.dtype, opts.int16_scale)
+    else:
+        sg_smooth_raster(opts.src_path, opts.target_path, opts.window_length, opts.polyorder, opts.iterations,
+                         opts.dtype, opts.int16_scale, opts.workers, (opts.block_size, opts.block_size))
+
+    print("### Task over #############################################")
+
+
+if __name__ == "__main__":
+    main()